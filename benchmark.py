@@ -0,0 +1,398 @@
+"""Замеры скорости telegram_analyzer на синтетических экспортах
+
+Скрипт генерирует экспорт Telegram заданного размера (result.json и
+многостраничный HTML), замеряет разбор, загрузку, фильтрацию и экспорт
+и сохраняет результаты в JSON. С --baseline результаты сравниваются с
+прошлым запуском; при замедлении больше порога код выхода 1.
+
+    python benchmark.py --messages 200000 --output after.json --baseline before.json
+"""
+import os
+import io
+import sys
+import json
+import html
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from time import perf_counter
+from datetime import datetime, timezone, timedelta
+from contextlib import redirect_stdout
+
+import telegram_analyzer as ta
+
+# Версия формата файла результатов
+RESULTS_VERSION = 1
+USERS = ['Алиса', 'Bob', 'Карл', 'Dana Smith', 'Евгений', 'Frank', 'Галина', 'Hiro', 'Ирина', 'José']
+WORDS = ('привет мир как дела сегодня завтра встреча проект отчет код релиз тест ошибка '
+         'hello world meeting release deploy review build straße Ünïcödé ok спасибо').split()
+HASHTAGS = ['#релиз', '#вопрос', '#news', '#важно']
+LINKS = ['https://t.me/durov', 'https://example.com/page', 'https://github.com/telegramdesktop/tdesktop']
+# Начало переписки в синтетическом экспорте
+START_DATE = datetime(2023, 1, 1, 9, 0)
+
+
+class _Message:
+    """Одно синтетическое сообщение: общее для JSON и HTML"""
+
+    __slots__ = ('id', 'date', 'author', 'user_id', 'parts', 'reply_to', 'service')
+
+
+def generate_messages(count, seed=1):
+    """Генерирует последовательность сообщений похожей на живой чат формы
+
+    Даты растут с паузами, авторы пишут сериями, часть сообщений - ответы
+    на недавние, часть - служебные. Текст - список строк и сущностей
+    (жирный, упоминания, хэштеги, ссылки), как в JSON-экспорте Telegram.
+    """
+    rnd = random.Random(seed)
+    date = START_DATE
+    author = 0
+    for message_id in range(1, count + 1):
+        date += timedelta(seconds=int(rnd.expovariate(1 / 300)))
+        if rnd.random() < 0.4:
+            author = rnd.randrange(len(USERS))
+
+        msg = _Message()
+        msg.id, msg.date, msg.author, msg.user_id = message_id, date, USERS[author], f'user{author + 1}'
+        msg.service = rnd.random() < 0.02
+        msg.reply_to = None
+        if not msg.service and message_id > 1 and rnd.random() < 0.25:
+            msg.reply_to = max(1, message_id - int(rnd.expovariate(1 / 20)) - 1)
+
+        parts = [' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 15)))]
+        if rnd.random() < 0.3:
+            entity = rnd.random()
+            if entity < 0.25:
+                parts += [' ', {'type': 'bold', 'text': rnd.choice(WORDS)}]
+            elif entity < 0.5:
+                parts += [' ', {'type': 'mention', 'text': '@' + USERS[rnd.randrange(len(USERS))].split()[0].lower()}]
+            elif entity < 0.75:
+                parts += [' ', {'type': 'hashtag', 'text': rnd.choice(HASHTAGS)}]
+            else:
+                parts += [' ', {'type': 'link', 'text': rnd.choice(LINKS)}, ' ', rnd.choice(WORDS)]
+        msg.parts = parts
+        yield msg
+
+
+def _json_text(parts):
+    """Поле text JSON-экспорта: строка или массив строк и сущностей"""
+    return parts[0] if len(parts) == 1 else parts
+
+
+def _json_entities(parts):
+    """Поле text_entities JSON-экспорта"""
+    return [{'type': 'plain', 'text': part} if isinstance(part, str) else part for part in parts]
+
+
+def generate_json_export(path, count, seed=1):
+    """Пишет result.json с count сообщениями в формате экспорта Telegram (отступ 1)"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{\n "name": "Синтетический чат",\n "type": "private_supergroup",\n "id": 1000000001,\n "messages": [')
+        for msg in generate_messages(count, seed):
+            record = {'id': msg.id, 'type': 'service' if msg.service else 'message',
+                      'date': msg.date.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'date_unixtime': str(int(msg.date.replace(tzinfo=timezone.utc).timestamp()))}
+            if msg.service:
+                record.update(actor=msg.author, actor_id=msg.user_id, action='pin_message', message_id=msg.id - 1,
+                              text='', text_entities=[])
+            else:
+                record.update({'from': msg.author, 'from_id': msg.user_id})
+                if msg.reply_to:
+                    record['reply_to_message_id'] = msg.reply_to
+                record.update(text=_json_text(msg.parts), text_entities=_json_entities(msg.parts))
+            separator = '\n  ' if msg.id == 1 else ',\n  '
+            f.write(separator + json.dumps(record, ensure_ascii=False, indent=1).replace('\n', '\n  '))
+        f.write('\n ]\n}\n')
+
+
+def _html_text(parts):
+    """Текст сообщения в разметке HTML-экспорта"""
+    out = []
+    for part in parts:
+        if isinstance(part, str):
+            out.append(html.escape(part))
+        elif part['type'] == 'bold':
+            out.append(f'<strong>{html.escape(part["text"])}</strong>')
+        elif part['type'] == 'hashtag':
+            out.append(f'<a href="" onclick="return ShowHashtag(&quot;{html.escape(part["text"][1:])}&quot;)">'
+                       f'{html.escape(part["text"])}</a>')
+        else:
+            out.append(f'<a href="{html.escape(part["text"])}">{html.escape(part["text"])}</a>')
+    return ''.join(out)
+
+
+def _html_message(msg, joined):
+    """Разметка одного сообщения HTML-экспорта"""
+    title = msg.date.strftime('%d.%m.%Y %H:%M:%S') + ' UTC+03:00'
+    if msg.service:
+        return (f'<div class="message service" id="message{msg.id}">\n<div class="body details">\n'
+                f'{html.escape(msg.author)} pinned a message\n</div>\n</div>\n')
+
+    out = [f'<div class="message default clearfix{" joined" if joined else ""}" id="message{msg.id}">\n']
+    if not joined:
+        out.append('<div class="pull_left userpic_wrap">\n<div class="userpic userpic1" style="width: 42px; '
+                   'height: 42px">\n<div class="initials" style="line-height: 42px">'
+                   f'{html.escape(msg.author[0])}</div>\n</div>\n</div>\n')
+    out.append(f'<div class="body">\n<div class="pull_right date details" title="{title}">\n'
+               f'{msg.date:%H:%M}\n</div>\n')
+    if not joined:
+        out.append(f'<div class="from_name">\n{html.escape(msg.author)}\n</div>\n')
+    if msg.reply_to:
+        out.append(f'<div class="reply_to details">\nIn reply to <a href="#go_to_message{msg.reply_to}" '
+                   f'onclick="return GoToMessage({msg.reply_to})">this message</a>\n</div>\n')
+    out.append(f'<div class="text">\n{_html_text(msg.parts)}\n</div>\n</div>\n</div>\n')
+    return ''.join(out)
+
+
+def generate_html_export(directory, count, pages=1, seed=1):
+    """Пишет многостраничный HTML-экспорт: messages.html, messages2.html, ...
+
+    Возвращает список файлов страниц. Как в экспорте Telegram, сообщения
+    одного автора подряд идут без имени (joined), а смена дня отмечается
+    служебным сообщением с отрицательным id.
+    """
+    per_page = -(-count // pages)
+    paths = []
+    f = None
+    last_author = last_day = None
+    service_id = 0
+    for index, msg in enumerate(generate_messages(count, seed)):
+        if index % per_page == 0:
+            if f:
+                f.write('</div>\n</div>\n</div>\n</body>\n</html>\n')
+                f.close()
+            page = len(paths) + 1
+            path = os.path.join(directory, 'messages.html' if page == 1 else f'messages{page}.html')
+            paths.append(path)
+            f = open(path, 'w', encoding='utf-8')
+            f.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8"/>\n<title>Exported Data</title>\n'
+                    '</head>\n<body>\n<div class="page_wrap">\n<div class="page_header">\n<div class="content">\n'
+                    '<div class="text bold">\nСинтетический чат\n</div>\n</div>\n</div>\n'
+                    '<div class="page_body chat_page">\n<div class="history">\n')
+            last_author = last_day = None
+
+        if msg.date.date() != last_day:
+            service_id -= 1
+            f.write(f'<div class="message service" id="message{service_id}">\n<div class="body details">\n'
+                    f'{msg.date:%d %B %Y}\n</div>\n</div>\n')
+            last_day, last_author = msg.date.date(), None
+        f.write(_html_message(msg, joined=msg.author == last_author))
+        last_author = None if msg.service else msg.author
+    if f:
+        f.write('</div>\n</div>\n</div>\n</body>\n</html>\n')
+        f.close()
+    return paths
+
+
+class Benchmark:
+    """Прогоняет замеры и копит их результаты"""
+
+    def __init__(self, repeat=3, memory=True):
+        self.repeat = repeat
+        self.memory = memory
+        self.results = {}
+
+    def measure(self, name, func, setup=None, messages=0, nbytes=0):
+        """Замеряет func: лучшее время из repeat прогонов и пик памяти отдельным прогоном
+
+        setup вызывается перед каждым прогоном и в замер не входит; его
+        результат передается в func. Пик памяти считается через tracemalloc,
+        который замедляет код, поэтому время в этом прогоне не учитывается.
+        """
+        best = None
+        for _ in range(self.repeat):
+            state = setup() if setup else None
+            with redirect_stdout(io.StringIO()):
+                started = perf_counter()
+                func(state)
+                elapsed = perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        peak = None
+        if self.memory:
+            state = setup() if setup else None
+            tracemalloc.start()
+            try:
+                with redirect_stdout(io.StringIO()):
+                    func(state)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        result = {
+            'seconds': best,
+            'messages': messages,
+            'bytes': nbytes,
+            'messages_per_second': messages / best if messages and best else None,
+            'mb_per_second': nbytes / 2**20 / best if nbytes and best else None,
+            'peak_memory_bytes': peak,
+        }
+        self.results[name] = result
+        print(format_result(name, result))
+        return result
+
+
+def format_result(name, result):
+    """Строка отчета по одному замеру"""
+    line = f"{name:<32} {result['seconds'] * 1000:10.3f} мс"
+    if result['messages_per_second']:
+        line += f" {result['messages_per_second']:12.0f} сообщ./с"
+    if result['mb_per_second']:
+        line += f" {result['mb_per_second']:8.1f} МБ/с"
+    if result['peak_memory_bytes'] is not None:
+        line += f"  пик {result['peak_memory_bytes'] / 2**20:.1f} МБ"
+    return line
+
+
+def _read(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _loaded_parser(files):
+    """Парсер с загруженными файлами (без вывода сообщений загрузки)"""
+    parser = ta.TelegramChatParser(workers=1)
+    with redirect_stdout(io.StringIO()):
+        parser.load_files(files)
+    return parser
+
+
+def run_benchmarks(workdir, count, pages, repeat, memory, seed):
+    """Генерирует экспорт в workdir и замеряет все этапы"""
+    json_path = os.path.join(workdir, 'result.json')
+    generate_json_export(json_path, count, seed)
+    html_paths = generate_html_export(workdir, count, pages, seed)
+    json_bytes = os.path.getsize(json_path)
+    html_bytes = sum(map(os.path.getsize, html_paths))
+    print(f"Сгенерировано: {count} сообщений, JSON {json_bytes / 2**20:.1f} МБ, "
+          f"HTML {len(html_paths)} стр. {html_bytes / 2**20:.1f} МБ\n")
+
+    bench = Benchmark(repeat, memory)
+    json_content = _read(json_path)
+    html_contents = [(path, _read(path)) for path in html_paths]
+
+    def parse_html(parser):
+        for path, content in html_contents:
+            parser.parse_html(content, path)
+
+    new_parser = lambda: ta.TelegramChatParser(workers=1)
+    bench.measure('parse_json', lambda parser: parser.parse_json(json_content, json_path), new_parser,
+                  count, json_bytes)
+    bench.measure('parse_html', parse_html, new_parser, count, html_bytes)
+    del json_content, html_contents
+
+    bench.measure('load_files_json', lambda parser: parser.load_files([json_path]), new_parser, count, json_bytes)
+    bench.measure('load_files_html', lambda parser: parser.load_files(html_paths), new_parser, count, html_bytes)
+    workers = os.cpu_count() or 1
+    if workers > 1:
+        bench.measure(f'load_files_parallel_{workers}', lambda parser: parser.load_files([json_path] + html_paths),
+                      lambda: ta.TelegramChatParser(workers=workers), 2 * count, json_bytes + html_bytes)
+
+    parser = _loaded_parser([json_path])
+    largest = parser.largest_threads(1)
+    thread_root = largest[0]['message_id'] if largest else 1
+    timestamps = parser.messages.timestamps
+    middle = (timestamps[0] + timestamps[-1]) // 2
+    filters = {
+        'user': {'target_user': USERS[0]},
+        'message_id': {'target_message_id': count // 2},
+        'keyword': {'keyword': 'встреча'},
+        'terms': {'terms': ['релиз', 'deploy', 'ошибка']},
+        'terms_regex': {'terms': [r'отч[её]т', r'\bbuild\b'], 'terms_regex': True},
+        'period': {'date_from': middle, 'date_to': middle + 7 * 86400},
+        'thread': {'target_message_id': thread_root, 'thread_depth': 0},
+        'combined': {'target_user': USERS[1], 'keyword': 'привет', 'date_from': middle},
+    }
+
+    def fresh():
+        # Кэш результатов сбрасывается, чтобы замерять саму фильтрацию
+        parser.query_cache.clear()
+        return parser
+
+    for name, kwargs in filters.items():
+        bench.measure(f'filter_{name}', lambda parser, kwargs=kwargs: parser.filter_messages(**kwargs), fresh, count)
+
+    results = parser.filter_messages(keyword='привет')
+    exported = sum(len(value) for value in results.values() if not isinstance(value, dict))
+    export_base = os.path.join(workdir, 'export')
+    bench.measure('export_json', lambda _: ta.export_results(results, 'json', filename=export_base), None, exported)
+    bench.measure('export_html', lambda _: ta.export_results(results, 'html', filename=export_base), None, exported)
+    bench.measure('export_html_pages', lambda _: ta.export_results(results, 'html', page_size=ta.EXPORT_PAGE_SIZE,
+                                                                   filename=export_base), None, exported)
+    return bench.results
+
+
+def compare(results, baseline, threshold):
+    """Сравнивает время с прошлым запуском; возвращает имена замедлившихся замеров"""
+    print(f"\nСравнение с базовым запуском (порог {threshold:.0%}):")
+    regressions = []
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if not before or not before['seconds']:
+            print(f"{name:<32} нет в базовом запуске")
+            continue
+        ratio = result['seconds'] / before['seconds']
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = '  ✗ медленнее'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            mark = '  ✓ быстрее'
+        print(f"{name:<32} {before['seconds'] * 1000:10.3f} -> {result['seconds'] * 1000:10.3f} мс "
+              f"(x{ratio:.2f}){mark}")
+    return regressions
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Замеры скорости telegram_analyzer на синтетических экспортах")
+    arg_parser.add_argument('--messages', type=int, default=100000, help="сообщений в экспорте")
+    arg_parser.add_argument('--html-pages', type=int, default=0,
+                            help="страниц HTML-экспорта (по умолчанию по 1000 сообщений, как в Telegram)")
+    arg_parser.add_argument('--repeat', type=int, default=3, help="прогонов каждого замера, берется лучший")
+    arg_parser.add_argument('--no-memory', action='store_true', help="не замерять пик памяти")
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--workdir', help="каталог для сгенерированных файлов (по умолчанию временный)")
+    arg_parser.add_argument('--output', help="файл для результатов в JSON")
+    arg_parser.add_argument('--baseline', help="результаты прошлого запуска для сравнения")
+    arg_parser.add_argument('--threshold', type=float, default=0.1, help="допустимое замедление, доля (0.1 = 10%%)")
+    args = arg_parser.parse_args(argv)
+
+    pages = args.html_pages or max(1, -(-args.messages // ta.EXPORT_PAGE_SIZE))
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args.workdir, args.messages, pages, args.repeat, not args.no_memory, args.seed)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(workdir, args.messages, pages, args.repeat, not args.no_memory, args.seed)
+
+    report = {
+        'version': RESULTS_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': ta.np is not None,
+        'parser_version': ta.PARSER_VERSION,
+        'config': {'messages': args.messages, 'html_pages': pages, 'repeat': args.repeat, 'seed': args.seed},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print("! Параметры базового запуска отличаются, сравнение может быть неточным")
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
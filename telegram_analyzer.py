@@ -1,173 +1,4235 @@
 import re
 import json
+import argparse
 import subprocess
 import platform
+import html
+from html.parser import HTMLParser
 from bs4 import BeautifulSoup
 import os
+import io
+import sys
+import mmap
+import sqlite3
+import threading
+import time
+import hashlib
+import heapq
+import math
+import unicodedata
+import cProfile
+import pstats
+import tracemalloc
+import bisect
+from array import array
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from collections import OrderedDict, Counter
+from collections.abc import Mapping, Sequence
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, wait as wait_futures
 from jinja2 import Template
 
-class TelegramChatParser:
+try:
+    import numpy as np
+except ImportError:
+    # Без NumPy аналитика считается обычными циклами
+    np = None
+
+# JSON-файлы больше этого размера читаются потоково, по одному сообщению
+JSON_STREAM_THRESHOLD = 64 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Файлы больше этого размера при параллельной загрузке режутся на куски
+CHUNK_PARALLEL_THRESHOLD = 128 * 1024 * 1024
+# Сколько байт от начала JSON-файла просматривается в поисках массива messages
+JSON_HEADER_LIMIT = 1024 * 1024
+# Версия разбора: при изменении формата записей старый кэш становится недействительным
+PARSER_VERSION = 4
+DEFAULT_CACHE_DIR = '.telegram_analyzer_cache'
+# Версия формата снимков для сборки архива с нескольких машин
+SNAPSHOT_VERSION = 1
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Ограничения кэша результатов фильтрации: число запросов и объем выборок в байтах
+QUERY_CACHE_ENTRIES = 32
+QUERY_CACHE_BYTES = 256 * 1024 * 1024
+# Сколько символов текста копится в сегменте индекса перед разбором на триграммы
+TRIGRAM_BATCH = 1 << 20
+# Подстрока из пакета запросов ищется по триграммному индексу, а не общим
+# проходом, если кандидатов не больше этой доли сообщений
+BATCH_INDEX_SHARE = 0.05
+# Сколько строк вставляется в базу SQLite одним пакетом
+SQLITE_BATCH_SIZE = 10000
+# Как часто (в сообщениях) фоновая загрузка обновляет прогресс и проверяет отмену
+PROGRESS_INTERVAL = 1024
+# Как часто (в секундах) фоновая загрузка проверяет отмену, пока ждет пул процессов
+PROGRESS_POLL = 0.1
+# Куда сохраняются профили этапов и сколько строк в их текстовом отчете
+PROFILE_DIR = 'telegram_analyzer_profiles'
+PROFILE_TOP = 40
+# Частоты слов, упоминаний и хэштегов: допустимая ошибка - доля от числа
+# токенов (None - точный подсчет). По авторам точность ниже, чтобы память
+# не росла вместе с числом участников
+FREQUENCY_ERROR = 0.0001
+FREQUENCY_USER_ERROR = 0.002
+FREQUENCY_MIN_WORD = 3
+# Сколько символов текста копится перед подсчетом частот
+FREQUENCY_BATCH = 1 << 20
+# Сколько частых слов показывается для каждого пользователя
+FREQUENCY_USER_TOP = 5
+# Сколько строк выводится в рейтингах аналитики
+ANALYTICS_TOP = 10
+# Сообщений на странице при постраничном HTML-экспорте, как в экспорте Telegram
+EXPORT_PAGE_SIZE = 1000
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONStreamReader:
+    """Инкрементальное чтение JSON-значений из буферизованного файла"""
+
+    def __init__(self, f, chunk_size=STREAM_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Дочитывает следующий кусок файла, отбрасывая уже разобранную часть"""
+        if self.eof:
+            return False
+        # Размер чтения растет вместе с недоразобранным хвостом, чтобы
+        # большие значения не разбирались заново квадратичное число раз
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Возвращает следующий значимый символ, не сдвигая позицию"""
+        while True:
+            self.pos = _JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """Читает один из ожидаемых символов-разделителей"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(f"Ожидался один из символов {chars!r}", self.buf, self.pos)
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Читает одно полное JSON-значение"""
+        while True:
+            self.peek()
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # Число в конце буфера могло оборваться на границе куска
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+
+def iter_json_messages(f, header=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Потоково перебирает элементы массива messages из экспорта Telegram
+
+    Остальные ключи верхнего уровня (name, type, id) складываются в header.
+    """
+    reader = _JSONStreamReader(f, chunk_size)
+    if reader.peek() != '{':
+        reader.value()
+        return
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+    else:
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key != 'messages':
+                value = reader.value()
+                if header is not None:
+                    header[key] = value
+            elif reader.peek() != '[':
+                yield from reader.value()
+            else:
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            if reader.expect(',}') == '}':
+                break
+
+    if reader.peek():
+        raise json.JSONDecodeError("Лишние данные после JSON-документа", reader.buf, reader.pos)
+
+
+# Поля записи сообщения
+MESSAGE_FIELDS = ('id', 'from', 'text', 'date', 'reply_to', 'source_file')
+# Фильтры по умолчанию (все выключены)
+DEFAULT_FILTERS = {
+    'target_user': None,
+    'target_message_id': None,
+    'keyword': None,
+    'source_file': None,
+    'terms': None,
+    'terms_regex': False,
+    'date_from': None,
+    'date_to': None,
+    'thread_depth': None
+}
+# Поля, по которым строятся индексы: значение -> список позиций в messages
+INDEXED_FIELDS = ('from', 'reply_to', 'source_file', 'id')
+# Сущности текста JSON-экспорта, границы которых сохраняются при разборе;
+# код сущности в хранилище - индекс в этом списке
+TEXT_ENTITY_TYPES = ('link', 'text_link', 'mention', 'mention_name', 'hashtag', 'cashtag', 'bot_command',
+                     'email', 'phone')
+_TEXT_ENTITY_CODES = {kind: code for code, kind in enumerate(TEXT_ENTITY_TYPES)}
+
+# Дата из заголовка сообщения HTML-экспорта: "15.09.2023 10:30:00 UTC+03:00"
+_HTML_DATE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?'
+                        r'(?:\s*UTC([+-])(\d{1,2}):?(\d{2}))?$')
+
+
+@lru_cache(maxsize=65536)
+def parse_date(value):
+    """Переводит дату сообщения в секунды Unix-времени (UTC) или None
+
+    Понимает ISO-даты JSON-экспорта и заголовки дат HTML-экспорта. Дата
+    без часового пояса (как в JSON) считается заданной в UTC. Результаты
+    кэшируются: одинаковые строки дат разбираются один раз.
+    """
+    if not isinstance(value, str) or not value:
+        return None
+    value = value.strip()
+    match = _HTML_DATE.match(value)
+    try:
+        if match:
+            day, month, year, hour, minute, second, sign, tz_hours, tz_minutes = match.groups()
+            offset = timedelta(hours=int(tz_hours), minutes=int(tz_minutes)) if sign else timedelta()
+            moment = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                              tzinfo=timezone(-offset if sign == '-' else offset))
+        else:
+            moment = datetime.fromisoformat(value)
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return int(moment.timestamp())
+
+
+def _date_bound(value, end=False):
+    """Граница фильтра по дате в секундах UTC: число, datetime или строка
+
+    Для конца периода дата без времени включает весь день.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp())
+    if isinstance(value, (int, float)):
+        return int(value)
+    timestamp = parse_date(value)
+    if timestamp is None:
+        raise ValueError(f"Не удалось разобрать дату: {value}")
+    if end and not re.search(r'\d[ T]\d', value.strip()):
+        timestamp += 24 * 60 * 60 - 1
+    return timestamp
+
+
+def _search_form(text):
+    """Форма текста для поиска без учета регистра: NFC и casefold"""
+    return unicodedata.normalize('NFC', text).casefold()
+
+
+def _flatten_text(value):
+    """Склеивает текст-массив JSON-экспорта в строку
+
+    Возвращает (текст, сущности). Сущности - кортежи (тип, начало, конец)
+    или (тип, начало, конец, адрес) для text_link с границами в символах
+    склеенного текста; сохраняются только типы из TEXT_ENTITY_TYPES.
+    Текст-строка возвращается как есть, без сущностей.
+    """
+    if not isinstance(value, list):
+        return value, None
+    parts = []
+    entities = []
+    length = 0
+    for item in value:
+        if isinstance(item, str):
+            part = item
+        elif isinstance(item, dict) and isinstance(item.get('text'), str):
+            part = item['text']
+            kind = item.get('type')
+            if kind in _TEXT_ENTITY_CODES and part:
+                entity = (kind, length, length + len(part))
+                if kind == 'text_link' and item.get('href'):
+                    entity += (item['href'],)
+                entities.append(entity)
+        else:
+            continue
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts), entities or None
+
+
+def _json_message_record(msg, filename):
+    """Собирает запись сообщения из элемента JSON-экспорта
+
+    Текст-массив склеивается в строку один раз здесь; ссылки, упоминания и
+    хэштеги передаются дальше в поле entities.
+    """
+    text, entities = _flatten_text(msg.get('text', ''))
+    record = {
+        'id': msg.get('id'),
+        'from': msg.get('from', 'Unknown'),
+        'text': text,
+        'date': msg.get('date', ''),
+        'reply_to': msg.get('reply_to_message_id'),
+        'source_file': filename
+    }
+    if entities:
+        record['entities'] = entities
+    return record
+
+
+class _UnsupportedHTML(Exception):
+    """Разметка, которую быстрый HTML-парсер не разбирает"""
+
+
+# Теги, внутри которых BeautifulSoup не сжимает пробельные текстовые узлы
+_HTML_PRESERVE_WHITESPACE = ('pre', 'textarea')
+
+
+class _TelegramHTMLScanner(HTMLParser):
+    """Однопроходный событийный разбор HTML-экспорта Telegram без построения DOM
+
+    Повторяет выборку parse_html на BeautifulSoup: первый div.from_name,
+    div.text и div.date внутри div.message и первую ссылку в div.reply_to.
+    Текстовые узлы, как и в BeautifulSoup, заканчиваются на любом теге или
+    комментарии, а узел только из пробельных символов ASCII сжимается до
+    одного перевода строки или пробела (кроме содержимого pre и textarea).
+    """
+
+    def __init__(self, filename):
+        super().__init__(convert_charrefs=True)
+        self.filename = filename
+        self.records = []
+        self.depth = 0
+        self.message = None
+        # Текущий текстовый узел и число открытых pre/textarea
+        self.data = []
+        self.preserve = 0
+
+    def _flush(self):
+        """Завершает текстовый узел и добавляет его в захватываемые поля"""
+        if not self.data:
+            return
+        data = ''.join(self.data)
+        self.data = []
+        if not self.preserve and not data.strip(' \n\t\x0c\r'):
+            data = '\n' if '\n' in data else ' '
+        for field, _ in self.message['captures']:
+            self.message[field].append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        if tag in _HTML_PRESERVE_WHITESPACE:
+            self.preserve += 1
+        if tag == 'div':
+            self._start_div(attrs)
+        elif self.depth:
+            if tag in ('script', 'style'):
+                raise _UnsupportedHTML(f"<{tag}> внутри сообщения")
+            message = self.message
+            if tag == 'a' and message['reply'] == 'open':
+                message['reply'] = 'done'
+                message['onclick'] = dict(attrs).get('onclick') or ''
+
+    def _start_div(self, attrs):
+        attrs = {name: '' if value is None else value for name, value in attrs}
+        classes = (attrs.get('class') or '').split()
+        if not self.depth:
+            if 'message' in classes:
+                self.depth = 1
+                self.message = {
+                    'id': attrs.get('id'),
+                    'from': None,
+                    'text': None,
+                    'date': None,
+                    'reply': None,
+                    'reply_depth': 0,
+                    'onclick': None,
+                    'captures': []
+                }
+            return
+
+        if 'message' in classes:
+            raise _UnsupportedHTML("вложенный div.message")
+        self.depth += 1
+        message = self.message
+        for field in ('from', 'text'):
+            if message[field] is None and ('from_name' if field == 'from' else field) in classes:
+                message[field] = []
+                message['captures'].append((field, self.depth))
+        if message['date'] is None and 'date' in classes:
+            message['date'] = (attrs.get('title'),)
+        if message['reply'] is None and 'reply_to' in classes:
+            message['reply'] = 'open'
+            message['reply_depth'] = self.depth
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if tag in _HTML_PRESERVE_WHITESPACE and self.preserve:
+            self.preserve -= 1
+        if tag != 'div' or not self.depth:
+            return
+        message = self.message
+        captures = message['captures']
+        while captures and captures[-1][1] == self.depth:
+            captures.pop()
+        if message['reply'] == 'open' and message['reply_depth'] == self.depth:
+            message['reply'] = 'done'
+        self.depth -= 1
+        if not self.depth:
+            self._finish_message()
+
+    def handle_data(self, data):
+        if self.depth and self.message['captures']:
+            self.data.append(data)
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def handle_decl(self, decl):
+        self._flush()
+
+    def handle_pi(self, data):
+        self._flush()
+
+    def unknown_decl(self, data):
+        if self.depth:
+            raise _UnsupportedHTML("CDATA внутри сообщения")
+
+    def _finish_message(self):
+        message = self.message
+        self.message = None
+
+        message_id = message['id']
+        if message_id:
+            try:
+                message_id = int(message_id.replace('message', ''))
+            except ValueError:
+                raise _UnsupportedHTML(f"нечисловой id {message_id!r}")
+
+        reply_to = None
+        if message['onclick']:
+            match = re.search(r'GoToMessage\((\d+)\)', message['onclick'])
+            if match:
+                reply_to = int(match.group(1))
+
+        self.records.append({
+            'id': message_id,
+            'from': ''.join(message['from']).strip() if message['from'] is not None else 'Unknown',
+            'text': ''.join(message['text']).strip() if message['text'] is not None else '',
+            'date': message['date'][0] if message['date'] is not None else '',
+            'reply_to': reply_to,
+            'source_file': self.filename
+        })
+
+    def close(self):
+        super().close()
+        if self.depth:
+            raise _UnsupportedHTML("незакрытый div.message в конце файла")
+
+
+def scan_html_messages(chunks, filename):
+    """Разбирает HTML-экспорт, подаваемый кусками, и возвращает записи сообщений"""
+    scanner = _TelegramHTMLScanner(filename)
+    for chunk in chunks:
+        scanner.feed(chunk)
+    scanner.close()
+    return scanner.records
+
+
+def _iter_chunks(f, chunk_size=STREAM_CHUNK_SIZE):
+    """Читает открытый файл кусками"""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+_HTML_MESSAGE_START = re.compile(rb'<div class="message[ "]')
+
+
+_JSON_INDENT = re.compile(rb'[ \t\r\n]*')
+_JSON_ELEMENT_ID = re.compile(rb'[ \t\r\n]*\{[ \t\r\n]*"id"[ \t\r\n]*:[ \t\r\n]*(-?\d+)[ \t\r\n]*[,}]')
+_HTML_CHAT_TITLE = re.compile(rb'<div class="page_header">.*?<div class="text bold">(.*?)</div>', re.S)
+_HTML_MESSAGE_ID = re.compile(rb'<div class="message[^"]*" id="message(\d+)"')
+
+
+def _json_messages_start(mm, header=None):
+    """Находит байтовое смещение сразу после '[' массива messages
+
+    Ключи верхнего уровня, идущие до messages, складываются в header.
+    """
+    prefix = mm[:JSON_HEADER_LIMIT].decode('utf-8', errors='ignore')
+    # Весь префикс читается одним куском, поэтому позиция в буфере абсолютна
+    reader = _JSONStreamReader(io.StringIO(prefix), chunk_size=len(prefix) + 1)
+    try:
+        reader.expect('{')
+        while reader.peek() != '}':
+            key = reader.value()
+            reader.expect(':')
+            if key == 'messages':
+                reader.expect('[')
+                return len(prefix[:reader.pos].encode('utf-8'))
+            value = reader.value()
+            if header is not None:
+                header[key] = value
+            reader.expect(',')
+    except json.JSONDecodeError:
+        pass
+    return None
+
+
+def _json_separator(mm, start):
+    """Разделитель элементов messages и сдвиг от его начала до начала элемента"""
+    indent = _JSON_INDENT.match(mm, start).group()
+    if b'\n' not in indent:
+        return None
+    return indent + b'},' + indent + b'{', len(indent) + 2
+
+
+def _json_chunk_bounds(mm, parts):
+    """Границы кусков массива messages между элементами верхнего уровня
+
+    Экспорт Telegram отформатирован с отступами, поэтому граница между
+    сообщениями выглядит как '}' + ',' + отступ + '{' с отступом первого
+    элемента. Внутри строк JSON переводов строк нет, а вложенные объекты
+    имеют больший отступ, так что такая граница однозначна.
+    """
+    start = _json_messages_start(mm)
+    if start is None or _json_separator(mm, start) is None:
+        return None
+
+    separator, shift = _json_separator(mm, start)
+    bounds = [start]
+    for k in range(1, parts):
+        pos = mm.find(separator, max(bounds[-1], start + (len(mm) - start) * k // parts))
+        if pos < 0:
+            break
+        bounds.append(pos + shift)
+    bounds.append(len(mm))
+    return bounds
+
+
+def _html_chunk_bounds(mm, parts):
+    """Границы кусков HTML-экспорта по открывающим тегам div.message"""
+    bounds = [0]
+    for k in range(1, parts):
+        match = _HTML_MESSAGE_START.search(mm, max(bounds[-1] + 1, len(mm) * k // parts))
+        if not match:
+            break
+        bounds.append(match.start())
+    bounds.append(len(mm))
+    return bounds
+
+
+def split_export(filename, parts):
+    """Делит большой файл экспорта на куски по границам сообщений
+
+    Возвращает список пар (начало, конец) в байтах или None, если файл
+    небольшой или безопасных границ в нем не найдено.
+    """
+    if parts < 2 or os.path.getsize(filename) <= CHUNK_PARALLEL_THRESHOLD:
+        return None
+
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if filename.endswith('.html'):
+            bounds = _html_chunk_bounds(mm, parts)
+        else:
+            bounds = _json_chunk_bounds(mm, parts)
+
+    if not bounds or len(bounds) < 3:
+        return None
+    return list(zip(bounds, bounds[1:]))
+
+
+def _json_tail(mm, last_id, loaded):
+    """Начало хвоста массива messages, который нужно разобрать
+
+    Telegram выгружает сообщения по возрастанию id, поэтому первое
+    сообщение с id больше last_id ищется двоичным поиском по границам
+    элементов. Пропускаются только первые элементы, которые все уже
+    загружены: loaded(ids) возвращает, сколько первых id из списка есть
+    в чате. Возвращает (смещение, число пропущенных элементов) или None,
+    если границы или id определить не удалось.
+    """
+    start = _json_messages_start(mm)
+    if start is None or _json_separator(mm, start) is None:
+        return None
+
+    separator, shift = _json_separator(mm, start)
+    bounds = array('Q', [start])
+    pos = mm.find(separator, start)
+    while pos >= 0:
+        bounds.append(pos + shift)
+        pos = mm.find(separator, pos + 1)
+
+    lo, hi = 0, len(bounds)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        match = _JSON_ELEMENT_ID.match(mm, bounds[mid])
+        if not match:
+            return None
+        if int(match.group(1)) <= last_id:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    # Id не выше last_id еще не значит, что сообщение загружено: в чате могут быть пропуски
+    ids = []
+    for bound in bounds[:lo]:
+        match = _JSON_ELEMENT_ID.match(mm, bound)
+        if not match:
+            return None
+        ids.append(int(match.group(1)))
+    skipped = loaded(ids)
+    return (bounds[skipped] if skipped < len(bounds) else len(mm)), skipped
+
+
+def _iter_json_tail(filename, offset, chunk_size=STREAM_CHUNK_SIZE):
+    """Потоково перебирает записи массива messages, начиная с байта offset
+
+    offset - граница элемента массива (или его конец), найденная
+    _json_tail; файл читается кусками, как в iter_json_messages.
+    """
+    with open(filename, 'rb') as raw:
+        raw.seek(offset)
+        reader = _JSONStreamReader(io.TextIOWrapper(raw, encoding='utf-8'), chunk_size)
+        if reader.peek() in ('', ']'):
+            return
+        while True:
+            msg = reader.value()
+            if not isinstance(msg, dict):
+                raise ValueError("Элемент messages не является объектом")
+            yield _json_message_record(msg, filename)
+            if reader.expect(',]') == ']':
+                return
+
+
+def _read_tail(filename, last_id, loaded):
+    """Записи файла после уже загруженного начала, без разбора этого начала
+
+    loaded(ids) возвращает, сколько первых id из списка уже загружено из
+    того же чата. Возвращает (записи, число пропущенных сообщений) или
+    None, если файл нужно разобрать целиком; записи JSON-хвоста читаются
+    потоково по мере перебора. HTML-страница пропускается, только если
+    все ее сообщения уже загружены.
+    """
+    try:
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if filename.endswith('.html'):
+                page_ids = [int(message_id) for message_id in _HTML_MESSAGE_ID.findall(mm)]
+                if page_ids and max(page_ids) <= last_id and loaded(page_ids) == len(page_ids):
+                    return [], len(page_ids)
+                return None
+
+            tail = _json_tail(mm, last_id, loaded)
+            if tail is None:
+                return None
+            offset, skipped = tail
+    except ValueError:
+        return None
+    return _iter_json_tail(filename, offset), skipped
+
+
+def export_chat_key(filename):
+    """Ключ чата, к которому относится файл экспорта
+
+    Берется название чата (name в JSON, заголовок HTML-страницы), чтобы
+    повторные экспорты одного чата совпадали в любом формате; без
+    названия - id чата, папка HTML-экспорта или сам файл.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(JSON_HEADER_LIMIT)
+
+    if filename.endswith('.html'):
+        match = _HTML_CHAT_TITLE.search(head)
+        if match:
+            return html.unescape(match.group(1).decode('utf-8', errors='ignore')).strip()
+        return os.path.dirname(os.path.abspath(filename))
+
+    header = {}
+    _json_messages_start(head, header)
+    return header.get('name') or header.get('id') or filename
+
+
+def _parse_json_chunk(text, filename):
+    """Разбирает кусок массива messages: элементы через запятую до ']' или конца"""
+    decoder = json.JSONDecoder()
+    records = []
+    pos = _JSON_WHITESPACE.match(text).end()
+    while pos < len(text) and text[pos] != ']':
+        msg, pos = decoder.raw_decode(text, pos)
+        if not isinstance(msg, dict):
+            raise ValueError("Элемент messages не является объектом")
+        records.append(_json_message_record(msg, filename))
+
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if text.startswith(',', pos):
+            pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+        elif not text.startswith(']', pos):
+            raise json.JSONDecodeError("Ожидалась ',' или ']'", text, pos)
+    return records
+
+
+def _is_chunked_candidate(filename):
+    """Достаточно ли велик файл, чтобы разбирать его по кускам"""
+    try:
+        return os.path.getsize(filename) > CHUNK_PARALLEL_THRESHOLD
+    except OSError:
+        return False
+
+
+def _compact_batch(parser, filename):
+    """Пакет для передачи между процессами: колоночное хранилище и информация о файле"""
+    return parser.messages, parser.file_sources.get(filename)
+
+
+def _load_file_worker(filename, stream_json):
+    """Разбирает один файл в отдельном процессе и возвращает компактный пакет"""
+    parser = TelegramChatParser(stream_json=stream_json, indexed=False)
+    parser._parse_file(filename)
+    return _compact_batch(parser, filename)
+
+
+def _submit_export(executor, filename, workers, stream_json):
+    """Отправляет разбор файла в пул процессов
+
+    Большой файл делится на куски split_export, остальные разбираются
+    одним процессом. Возвращает список пар (future, размер в байтах) в
+    порядке кусков файла.
+    """
+    try:
+        spans = split_export(filename, workers)
+    except (OSError, ValueError):
+        spans = None
+    if spans:
+        return [(executor.submit(_load_chunk_worker, filename, start, end), end - start) for start, end in spans]
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        size = 0
+    return [(executor.submit(_load_file_worker, filename, stream_json), size)]
+
+
+def _load_chunk_worker(filename, start, end):
+    """Разбирает кусок файла [start, end) в отдельном процессе"""
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode('utf-8')
+
+    if filename.endswith('.html'):
+        # Как при чтении в текстовом режиме: универсальные переводы строк
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        records = scan_html_messages([text], filename)
+    else:
+        records = _parse_json_chunk(text, filename)
+
+    parser = TelegramChatParser(indexed=False)
+    for msg_data in records:
+        parser._add_message(msg_data)
+    return _compact_batch(parser, filename)
+
+
+# Значение целочисленной колонки, означающее "нет значения"
+_NO_VALUE = -2 ** 63
+
+
+class _StringTable:
+    """Словарное кодирование повторяющихся значений (авторы, файлы)"""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        """Возвращает код значения, добавляя его в таблицу при первой встрече"""
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class _PackedStrings:
+    """Строки, упакованные в один буфер UTF-8 с массивом смещений"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+
+    def append(self, text):
+        self.data += text.encode('utf-8', 'surrogatepass')
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].decode('utf-8', 'surrogatepass')
+
+
+class MessageStore:
+    """Колоночное хранилище сообщений
+
+    id и reply_to лежат в целочисленных массивах, автор и файл - коды в
+    таблицах строк, текст и дата - в упакованных буферах. Рядом с текстом
+    хранится его форма для поиска (пустая, если совпадает с текстом), а
+    сущности текста - в параллельных массивах по возрастанию позиций.
+    Значения, не укладывающиеся в колонки (не-int id, текст не строкой),
+    хранятся в overflow. Доступ к сообщению - через легкую запись MessageRecord.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.reply_to = array('q')
+        self.authors = _StringTable()
+        self.author_codes = array('I')
+        self.sources = _StringTable()
+        self.source_codes = array('I')
+        self.texts = _PackedStrings()
+        self.search = _PackedStrings()
+        self.dates = _PackedStrings()
+        # Дата, разобранная в секунды UTC (_NO_VALUE - дату разобрать не удалось)
+        self.timestamps = array('q')
+        # Сущности: позиция сообщения, код типа, начало и конец; адреса text_link
+        # хранятся по номеру сущности
+        self.entity_positions = array('I')
+        self.entity_types = array('B')
+        self.entity_starts = array('I')
+        self.entity_ends = array('I')
+        self.entity_urls = {}
+        self.overflow = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for position in range(len(self.ids)):
+            yield MessageRecord(self, position)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [MessageRecord(self, position) for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("индекс сообщения вне диапазона")
+        return MessageRecord(self, index)
+
+    def append(self, msg_data):
+        """Добавляет сообщение из словаря с полями MESSAGE_FIELDS; возвращает форму текста для поиска"""
+        position = len(self.ids)
+        self.ids.append(self._int_cell(position, 'id', msg_data['id']))
+        self.reply_to.append(self._int_cell(position, 'reply_to', msg_data['reply_to']))
+        self.author_codes.append(self.authors.encode(msg_data['from']))
+        self.source_codes.append(self.sources.encode(msg_data['source_file']))
+        text = self._str_cell(position, 'text', msg_data['text'])
+        self.texts.append(text)
+        folded = _search_form(text)
+        self.search.append('' if folded == text else folded)
+        self.dates.append(self._str_cell(position, 'date', msg_data['date']))
+        timestamp = parse_date(msg_data['date'])
+        self.timestamps.append(_NO_VALUE if timestamp is None else timestamp)
+        
+        for entity in msg_data.get('entities') or ():
+            if len(entity) > 3:
+                self.entity_urls[len(self.entity_positions)] = entity[3]
+            self.entity_positions.append(position)
+            self.entity_types.append(_TEXT_ENTITY_CODES[entity[0]])
+            self.entity_starts.append(entity[1])
+            self.entity_ends.append(entity[2])
+        return folded
+
+    def _int_cell(self, position, field, value):
+        if type(value) is int and _NO_VALUE < value < 2 ** 63:
+            return value
+        if value is not None:
+            self.overflow[(position, field)] = value
+        return _NO_VALUE
+
+    def _str_cell(self, position, field, value):
+        if type(value) is str:
+            return value
+        self.overflow[(position, field)] = value
+        return ''
+
+    def value(self, position, field):
+        """Значение одного поля сообщения"""
+        if field == 'id' or field == 'reply_to':
+            value = (self.ids if field == 'id' else self.reply_to)[position]
+            if value == _NO_VALUE:
+                return self.overflow.get((position, field))
+            return value
+        if field == 'from':
+            return self.authors.values[self.author_codes[position]]
+        if field == 'source_file':
+            return self.sources.values[self.source_codes[position]]
+        if field == 'text' or field == 'date':
+            value = (self.texts if field == 'text' else self.dates)[position]
+            if not value:
+                return self.overflow.get((position, field), value)
+            return value
+        raise KeyError(field)
+
+    def search_text(self, position):
+        """Текст сообщения в форме для поиска, посчитанной при добавлении"""
+        return self.search[position] or self.texts[position]
+
+    def entities(self, position):
+        """Сущности текста сообщения: кортежи как у _flatten_text"""
+        first = bisect.bisect_left(self.entity_positions, position)
+        last = bisect.bisect_right(self.entity_positions, position, first)
+        entities = []
+        for i in range(first, last):
+            entity = (TEXT_ENTITY_TYPES[self.entity_types[i]], self.entity_starts[i], self.entity_ends[i])
+            if i in self.entity_urls:
+                entity += (self.entity_urls[i],)
+            entities.append(entity)
+        return entities
+
+    def record_data(self, position):
+        """Словарь сообщения вместе с сущностями - для переноса в другое хранилище"""
+        msg_data = dict(MessageRecord(self, position))
+        entities = self.entities(position)
+        if entities:
+            msg_data['entities'] = entities
+        return msg_data
+
+    def source_code(self, filename):
+        """Код файла-источника или None, если сообщений из него нет"""
+        return self.sources.codes.get(filename)
+
+    def export_range(self, start, end):
+        """Колонки сообщений [start, end) для записи на диск
+
+        Возвращает (секции, метаданные): секции - двоичные массивы,
+        метаданные - локальная таблица авторов и overflow в виде JSON.
+        """
+        local_codes = {}
+        author_codes = array('I', (local_codes.setdefault(code, len(local_codes))
+                                   for code in self.author_codes[start:end]))
+        sections = {
+            'ids': self.ids[start:end],
+            'reply_to': self.reply_to[start:end],
+            'timestamps': self.timestamps[start:end],
+            'author_codes': author_codes
+        }
+        for name, packed in (('text', self.texts), ('search', self.search), ('date', self.dates)):
+            first, last = packed.offsets[start], packed.offsets[end]
+            sections[f'{name}_data'] = packed.data[first:last]
+            sections[f'{name}_offsets'] = array('Q', (offset - first for offset in packed.offsets[start:end + 1]))
+
+        first = bisect.bisect_left(self.entity_positions, start)
+        last = bisect.bisect_left(self.entity_positions, end, first)
+        sections['entity_positions'] = array('I', (position - start for position in self.entity_positions[first:last]))
+        sections['entity_types'] = self.entity_types[first:last]
+        sections['entity_starts'] = self.entity_starts[first:last]
+        sections['entity_ends'] = self.entity_ends[first:last]
+
+        meta = {
+            'count': end - start,
+            'authors': [self.authors.values[code] for code in local_codes],
+            'overflow': [[position - start, field, value]
+                         for (position, field), value in self.overflow.items() if start <= position < end],
+            'entity_urls': [[i - first, url] for i, url in self.entity_urls.items() if first <= i < last]
+        }
+        return sections, meta
+
+    def import_range(self, sections, meta, source_file):
+        """Добавляет сообщения одного файла из секций, записанных export_range"""
+        base = len(self)
+        count = meta['count']
+        self.ids.frombytes(sections['ids'])
+        self.reply_to.frombytes(sections['reply_to'])
+        self.timestamps.frombytes(sections['timestamps'])
+        remap = [self.authors.encode(author) for author in meta['authors']]
+        self.author_codes.extend(array('I', (remap[code] for code in sections['author_codes'].cast('I'))))
+        self.source_codes.extend(array('I', [self.sources.encode(source_file)]) * count)
+        for name, packed in (('text', self.texts), ('search', self.search), ('date', self.dates)):
+            first = len(packed.data)
+            packed.data += sections[f'{name}_data']
+            packed.offsets.extend(array('Q', (first + offset for offset in sections[f'{name}_offsets'].cast('Q')[1:])))
+        for position, field, value in meta['overflow']:
+            self.overflow[(base + position, field)] = value
+
+        first = len(self.entity_positions)
+        self.entity_positions.extend(array('I', (base + position for position in sections['entity_positions'].cast('I'))))
+        self.entity_types.frombytes(sections['entity_types'])
+        self.entity_starts.frombytes(sections['entity_starts'])
+        self.entity_ends.frombytes(sections['entity_ends'])
+        for i, url in meta['entity_urls']:
+            self.entity_urls[first + i] = url
+
+    def truncate(self, length):
+        """Удаляет сообщения с позиции length и дальше - откат незавершенной загрузки
+
+        Значения, добавленные в таблицы авторов и файлов, остаются: без
+        сообщений они ни на что не влияют.
+        """
+        if length >= len(self):
+            return
+        for column in (self.ids, self.reply_to, self.author_codes, self.source_codes, self.timestamps):
+            del column[length:]
+        for packed in (self.texts, self.search, self.dates):
+            del packed.data[packed.offsets[length]:]
+            del packed.offsets[length + 1:]
+        first = bisect.bisect_left(self.entity_positions, length)
+        for column in (self.entity_positions, self.entity_types, self.entity_starts, self.entity_ends):
+            del column[first:]
+        self.entity_urls = {i: url for i, url in self.entity_urls.items() if i < first}
+        self.overflow = {key: value for key, value in self.overflow.items() if key[0] < length}
+
+
+def _truncate_postings(postings_map, position):
+    """Убирает из списков позиций (по возрастанию) позиции от position и дальше"""
+    for key in list(postings_map):
+        positions = postings_map[key]
+        if positions and positions[-1] >= position:
+            del positions[bisect.bisect_left(positions, position):]
+            if not positions:
+                del postings_map[key]
+
+
+class MessageRecord(Mapping):
+    """Легкое представление одного сообщения из MessageStore
+
+    Ведет себя как словарь с полями MESSAGE_FIELDS.
+    """
+
+    __slots__ = ('_store', '_position')
+
+    def __init__(self, store, position):
+        self._store = store
+        self._position = position
+
+    def __getitem__(self, field):
+        return self._store.value(self._position, field)
+
+    def __iter__(self):
+        return iter(MESSAGE_FIELDS)
+
+    def __len__(self):
+        return len(MESSAGE_FIELDS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _combine_positions(left, right, operation):
+    """Пересечение ('&'), объединение ('|') или разность ('-') возрастающих позиций
+
+    Списки уже отсортированы и без повторов, поэтому с NumPy используются
+    intersect1d/setdiff1d с assume_unique над буферами массивов, а без
+    него - линейное слияние двух списков. Короткий список пересекается с
+    длинным двоичным поиском. Возвращает array('I') по возрастанию.
+    """
+    combined = array('I')
+    left_count, right_count = len(left), len(right)
+    if operation == '&' and min(left_count, right_count) * 16 < max(left_count, right_count):
+        small, large = (left, right) if left_count < right_count else (right, left)
+        lo = 0
+        for position in small:
+            lo = bisect.bisect_left(large, position, lo)
+            if lo == len(large):
+                break
+            if large[lo] == position:
+                combined.append(position)
+        return combined
+
+    if np is not None and left_count and right_count:
+        left, right = (np.frombuffer(positions, dtype=np.uint32) if positions.typecode == 'I'
+                       else np.array(positions, dtype=np.uint32) for positions in (left, right))
+        if operation == '&':
+            result = np.intersect1d(left, right, assume_unique=True)
+        elif operation == '|':
+            # union1d ищет повторы через unique и заметно медленнее слияния двух готовых списков
+            result = np.concatenate((left, right))
+            result.sort(kind='stable')
+            keep = np.empty(len(result), dtype=bool)
+            keep[0] = True
+            np.not_equal(result[1:], result[:-1], out=keep[1:])
+            result = result[keep]
+        else:
+            result = np.setdiff1d(left, right, assume_unique=True)
+        return array('I', result.astype(np.uint32).tobytes())
+
+    i = j = 0
+    while i < left_count and j < right_count:
+        a, b = left[i], right[j]
+        if a < b:
+            if operation != '&':
+                combined.append(a)
+            i += 1
+        elif a > b:
+            if operation == '|':
+                combined.append(b)
+            j += 1
+        else:
+            if operation != '-':
+                combined.append(a)
+            i += 1
+            j += 1
+    if operation != '&':
+        combined.extend(islice(left, i, None))
+    if operation == '|':
+        combined.extend(islice(right, j, None))
+    return combined
+
+
+class ResultSet(Sequence):
+    """Ленивая выборка сообщений: позиции в MessageStore по возрастанию
+
+    Записи не копируются - при обходе и по индексу выдаются MessageRecord,
+    длина известна сразу. Выборки из одного хранилища объединяются (|),
+    пересекаются (&) и вычитаются (-) по позициям.
+    """
+
+    __slots__ = ('store', 'positions')
+
+    def __init__(self, store, positions=()):
+        self.store = store
+        self.positions = positions if isinstance(positions, array) else array('I', positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ResultSet(self.store, self.positions[index])
+        return self.store[self.positions[index]]
+
+    def __iter__(self):
+        store = self.store
+        return (store[p] for p in self.positions)
+
+    @property
+    def nbytes(self):
+        """Объем памяти под позиции выборки"""
+        return self.positions.itemsize * len(self.positions)
+
+    def _combine(self, other, operation):
+        if not isinstance(other, ResultSet):
+            return NotImplemented
+        if other.store is not self.store:
+            raise ValueError("Выборки относятся к разным хранилищам сообщений")
+        return ResultSet(self.store, _combine_positions(self.positions, other.positions, operation))
+
+    def __and__(self, other):
+        return self._combine(other, '&')
+
+    def __or__(self, other):
+        return self._combine(other, '|')
+
+    def __sub__(self, other):
+        return self._combine(other, '-')
+
+    def __repr__(self):
+        return f"<ResultSet: {len(self)} сообщений>"
+
+
+_TOKEN_RE = re.compile(r'\w+')
+FREQUENCY_KINDS = ('words', 'mentions', 'hashtags')
+# Ссылка (пропускается), упоминание или хэштег, либо слово
+_FREQUENCY_TOKEN_RE = re.compile(r'(?:https?://|www\.)\S*|(?<!\w)([@#]\w+)|(\w+)')
+
+
+def _numpy_trigrams(positions, texts):
+    """Триграммы пачки текстов векторными операциями: (ключи, границы, позиции)
+
+    Код триграммы - три 21-битных кода символов в одном uint64. Пары
+    (триграмма, позиция) сортируются устойчиво, поэтому позиции каждой
+    триграммы идут по возрастанию, а повторы внутри текста схлопываются.
+    Позиции триграммы keys[i] - positions[bounds[i]:bounds[i + 1]].
+    """
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    chars = np.frombuffer(''.join(texts).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32).astype(np.uint64)
+    owners = np.repeat(np.frombuffer(positions, dtype=np.uint32), lengths)
+    codes = (chars[:-2] << np.uint64(42)) | (chars[1:-1] << np.uint64(21)) | chars[2:]
+    # Тройки на стыке двух текстов - не триграммы
+    inside = owners[:-2] == owners[2:]
+    codes, owners = codes[inside], owners[:-2][inside]
+
+    order = np.argsort(codes, kind='stable')
+    codes, owners = codes[order], owners[order]
+    keep = np.empty(len(codes), dtype=bool)
+    keep[0] = True
+    np.logical_or(codes[1:] != codes[:-1], owners[1:] != owners[:-1], out=keep[1:])
+    codes, owners = codes[keep], owners[keep]
+
+    starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+    unique = codes[starts]
+    mask = np.uint64((1 << 21) - 1)
+    key_chars = np.empty((len(unique), 3), dtype=np.uint32)
+    key_chars[:, 0] = unique >> np.uint64(42)
+    key_chars[:, 1] = (unique >> np.uint64(21)) & mask
+    key_chars[:, 2] = unique & mask
+    joined = key_chars.tobytes().decode('utf-32-le', 'surrogatepass')
+    keys = [joined[i:i + 3] for i in range(0, len(joined), 3)]
+    return keys, np.append(starts, len(codes)), owners
+
+
+class _TextSegment:
+    """Сегмент текстового индекса, заполняемый при разборе
+
+    Позиции хранятся относительно base - позиции первого сообщения сегмента.
+    Тексты раскладываются на триграммы пачками по TRIGRAM_BATCH символов
+    (с NumPy - векторно), поэтому trigrams досчитывает накопленное при
+    обращении, а flush - сразу.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.tokens = {}
+        self._trigrams = {}
+        self.short = array('I')
+        # Тексты, еще не разложенные на триграммы, и их позиции
+        self._pending_positions = array('I')
+        self._pending_texts = []
+        self._pending_size = 0
+
+    @property
+    def trigrams(self):
+        self.flush()
+        return self._trigrams
+
+    def add(self, position, text):
+        position -= self.base
+        # Большинство ключей уже есть в индексе, поэтому новый ключ ловится по KeyError
+        tokens = self.tokens
+        for token in set(_TOKEN_RE.findall(text)):
+            try:
+                tokens[token].append(position)
+            except KeyError:
+                tokens[token] = array('I', (position,))
+
+        if len(text) < 3:
+            self.short.append(position)
+            return
+        self._pending_positions.append(position)
+        self._pending_texts.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= TRIGRAM_BATCH:
+            self.flush()
+
+    def flush(self):
+        """Раскладывает накопленные тексты по спискам позиций триграмм"""
+        if not self._pending_texts:
+            return
+        positions, texts = self._pending_positions, self._pending_texts
+        self._pending_positions, self._pending_texts, self._pending_size = array('I'), [], 0
+        trigrams = self._trigrams
+        if np is None:
+            for position, text in zip(positions, texts):
+                for trigram in {text[i:i + 3] for i in range(len(text) - 2)}:
+                    try:
+                        trigrams[trigram].append(position)
+                    except KeyError:
+                        trigrams[trigram] = array('I', (position,))
+            return
+
+        keys, bounds, owners = _numpy_trigrams(positions, texts)
+        for i, trigram in enumerate(keys):
+            chunk = owners[bounds[i]:bounds[i + 1]].tobytes()
+            postings = trigrams.get(trigram)
+            if postings is None:
+                trigrams[trigram] = array('I', chunk)
+            else:
+                postings.frombytes(chunk)
+
+    def close(self):
+        """Сегмент в памяти ничего не держит открытым"""
+
+
+class _MappedPostings:
+    """Списки позиций, отображенные в память: ключ -> срез общего массива"""
+
+    def __init__(self, keys, offsets, postings):
+        self.slots = {key: i for i, key in enumerate(keys)}
+        self.offsets = offsets
+        self.postings = postings
+
+    def get(self, key, default=None):
+        i = self.slots.get(key)
+        if i is None:
+            return default
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def keys(self):
+        return self.slots.keys()
+
+    def __contains__(self, key):
+        return key in self.slots
+
+
+class _MappedTextSegment:
+    """Сегмент текстового индекса, прочитанный из файла секций
+
+    Списки позиций читаются прямо из отображения source, поэтому сегмент
+    держит файл открытым до своего close().
+    """
+
+    def __init__(self, base, source, sections, prefix=''):
+        self.base = base
+        self.source = source.retain()
+        self.tokens = _MappedPostings(
+            json.loads(bytes(sections[prefix + 'token_keys'])),
+            sections[prefix + 'token_offsets'].cast('Q'),
+            sections[prefix + 'token_postings'].cast('I'))
+        self.trigrams = _MappedPostings(
+            json.loads(bytes(sections[prefix + 'trigram_keys'])),
+            sections[prefix + 'trigram_offsets'].cast('Q'),
+            sections[prefix + 'trigram_postings'].cast('I'))
+        self.short = sections[prefix + 'short'].cast('I')
+
+    def close(self):
+        """Отпускает срезы отображения и файл секций"""
+        if self.source is None:
+            return
+        for view in (self.tokens.offsets, self.tokens.postings,
+                     self.trigrams.offsets, self.trigrams.postings, self.short):
+            view.release()
+        self.source.close()
+        self.source = None
+
+
+def _segment_sections(segment, prefix=''):
+    """Секции для записи сегмента текстового индекса на диск"""
+    sections = {}
+    for kind, postings_map in (('token', segment.tokens), ('trigram', segment.trigrams)):
+        keys = list(postings_map.keys())
+        offsets = array('Q', [0])
+        postings = array('I')
+        for key in keys:
+            postings.extend(postings_map.get(key))
+            offsets.append(len(postings))
+        sections[f'{prefix}{kind}_keys'] = json.dumps(keys).encode('utf-8')
+        sections[f'{prefix}{kind}_offsets'] = offsets
+        sections[f'{prefix}{kind}_postings'] = postings
+    sections[prefix + 'short'] = array('I', segment.short)
+    return sections
+
+
+_SECTIONS_MAGIC = b'TGSECT01'
+
+
+def write_sections(path, header, sections):
+    """Записывает файл секций: JSON-заголовок и выровненные двоичные массивы
+
+    Файл пишется во временный и затем атомарно подменяет старый.
+    """
+    layout = {}
+    offset = 0
+    for name, data in sections.items():
+        size = memoryview(data).nbytes
+        layout[name] = [offset, size]
+        offset += size + (-size) % 8
+    header = dict(header, sections=layout, byteorder=sys.byteorder)
+    raw_header = json.dumps(header, ensure_ascii=False).encode('utf-8')
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_SECTIONS_MAGIC)
+        f.write(len(raw_header).to_bytes(8, 'little'))
+        f.write(raw_header)
+        f.write(b'\0' * ((-len(raw_header)) % 8))
+        for data in sections.values():
+            size = memoryview(data).nbytes
+            f.write(data)
+            f.write(b'\0' * ((-size) % 8))
+    os.replace(tmp_path, path)
+
+
+class SectionsFile:
+    """Файл секций, открытый через mmap: header и sections
+
+    Секции - срезы memoryview поверх отображенного файла, без копирования.
+    Отображение закрывается, когда close() вызвали все владельцы: тот, кто
+    открыл файл (или with), и каждый, кто взял его через retain() -
+    например, сегмент текстового индекса из кэша.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+        self._users = 1
+        self.sections = {}
+        try:
+            self.header = self._read_header(path)
+        except Exception:
+            self.close()
+            raise
+
+        view = self._view
+        header_size = int.from_bytes(view[8:16], 'little')
+        data_start = 16 + header_size + (-header_size) % 8
+        self.sections = {name: view[data_start + offset:data_start + offset + size]
+                         for name, (offset, size) in self.header['sections'].items()}
+
+    def _read_header(self, path):
+        view = self._view
+        if bytes(view[:8]) != _SECTIONS_MAGIC:
+            raise ValueError(f"{path}: неизвестный формат файла")
+        header_size = int.from_bytes(view[8:16], 'little')
+        header = json.loads(bytes(view[16:16 + header_size]))
+        if header.get('byteorder') != sys.byteorder:
+            raise ValueError(f"{path}: другой порядок байтов")
+        return header
+
+    def retain(self):
+        """Еще один владелец: файл не закроется до его close()"""
+        self._users += 1
+        return self
+
+    def close(self):
+        """Отпускает файл; последний владелец закрывает отображение"""
+        self._users -= 1
+        if self._users > 0 or self._mm is None:
+            return
+        for view in self.sections.values():
+            view.release()
+        self._view.release()
+        try:
+            self._mm.close()
+        except BufferError:
+            # Срез секции еще используется снаружи - отображение закроется вместе с ним
+            pass
+        self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ParseCache:
+    """Дисковый кэш разобранных файлов
+
+    Для каждого файла хранится файл секций с колонками сообщений и
+    сегментом текстового индекса. Ключ - путь, размер, время изменения и
+    версия разбора; устаревшие записи удаляются при обращении, а общий
+    размер кэша ограничен max_bytes (сначала удаляются давно не читанные).
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, filename):
+        """Ключ файла в его текущем состоянии"""
+        stat = os.stat(filename)
+        return {
+            'path': os.path.abspath(filename),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'version': PARSER_VERSION
+        }
+
+    def _entry_path(self, filename):
+        digest = hashlib.sha1(os.path.abspath(filename).encode('utf-8', 'surrogatepass')).hexdigest()
+        return os.path.join(self.directory, digest + '.tgc')
+
+    def open(self, filename):
+        """Возвращает открытый SectionsFile актуальной записи или None
+
+        Запись нужно закрыть (close() или with) после загрузки.
+        """
+        path = self._entry_path(filename)
+        if not os.path.exists(path):
+            return None
+        try:
+            entry = SectionsFile(path)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None:
+            try:
+                if entry.header.get('key') == self.key(filename):
+                    os.utime(path)
+                    return entry
+            except OSError:
+                pass
+            # Устаревшая запись закрывается до удаления: открытый файл не удалить в Windows
+            entry.close()
+        self._remove(path)
+        return None
+
+    def save(self, filename, key, store, start, end, segment, frequencies=None):
+        """Сохраняет сообщения [start, end) файла, его сегмент индекса и частоты слов"""
+        sections, meta = store.export_range(start, end)
+        header = {'key': key, 'messages': meta, 'segment_offset': None,
+                  'frequencies': frequencies.to_json() if frequencies else None}
+        if segment is not None:
+            header['segment_offset'] = segment.base - start
+            sections.update(_segment_sections(segment))
+        path = self._entry_path(filename)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_sections(path, header, sections)
+        except OSError:
+            return
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        """Удаляет самые старые записи, кроме keep, пока кэш больше max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tgc') and path != keep:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            try:
+                total += os.path.getsize(keep)
+            except OSError:
+                pass
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def read_snapshot(path):
+    """Открывает снимок; возвращает (SectionsFile, секции файлов по префиксу)
+
+    Снимок другой версии формата или разбора не читается: колонки
+    сообщений в нем могут быть устроены иначе. Снимок нужно закрыть.
+    """
+    snapshot = SectionsFile(path)
+    header = snapshot.header
+    if header.get('snapshot') != SNAPSHOT_VERSION or header.get('parser_version') != PARSER_VERSION:
+        snapshot.close()
+        raise ValueError(f"{path}: снимок другой версии, создайте его заново")
+    grouped = {}
+    for name, data in snapshot.sections.items():
+        prefix, _, section = name.partition('.')
+        grouped.setdefault(prefix + '.', {})[section] = data
+    return snapshot, grouped
+
+
+def merge_snapshots(paths, output):
+    """Сливает снимки узлов в один общий снимок
+
+    Секции сообщений и индексов переносятся как есть, без разбора.
+    Файл того же узла, встреченный повторно (например, в уже слитом
+    снимке), пропускается. Сообщения одного чата с одинаковыми id из
+    разных файлов считаются и печатаются как пересечения. Возвращает
+    заголовок общего снимка.
+    """
+    entries, sections, shards = [], {}, []
+    seen = set()
+    chat_ids = {}
+    overlaps = {}
+    opened = []
+    try:
+        for path in paths:
+            snapshot, grouped = read_snapshot(path)
+            opened.append(snapshot)
+            shards += [shard for shard in snapshot.header['shards'] if shard not in shards]
+            for entry in snapshot.header['files']:
+                key = (entry['shard'], entry['name'])
+                if key in seen:
+                    print(f"Файл {entry['name']} узла {entry['shard']} уже есть в снимке, пропущен ({path})")
+                    continue
+                seen.add(key)
+                file_sections = grouped.get(entry['prefix'], {})
+
+                # Пересечения ищутся по множествам id из сводки, колонки сообщений не читаются
+                chat = json.dumps(entry['chat'], ensure_ascii=False)
+                ids = chat_ids.setdefault(chat, set())
+                message_ids = set(file_sections['message_ids'].cast('q')) if 'message_ids' in file_sections else set()
+                repeated = len(ids & message_ids)
+                if repeated:
+                    overlaps[entry['chat']] = overlaps.get(entry['chat'], 0) + repeated
+                ids |= message_ids
+
+                prefix = f"{len(entries)}."
+                sections.update((prefix + name, data) for name, data in file_sections.items())
+                entries.append(dict(entry, prefix=prefix))
+
+        header = {'snapshot': SNAPSHOT_VERSION, 'parser_version': PARSER_VERSION, 'shards': shards,
+                  'created': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'files': entries}
+        write_sections(output, header, sections)
+    finally:
+        for snapshot in opened:
+            snapshot.close()
+    for chat, repeated in overlaps.items():
+        print(f"! Чат {chat}: {repeated} сообщений с одинаковыми id есть в нескольких файлах")
+    return header
+
+
+def _snapshot_file_name(entry, taken):
+    """Имя файла из снимка в общем архиве: если имя занято - с префиксом узла"""
+    name = entry['name']
+    if name not in taken:
+        return name
+    name = f"{entry['shard']}:{entry['name']}"
+    number = 2
+    while name in taken:
+        name = f"{entry['shard']}:{entry['name']} ({number})"
+        number += 1
+    return name
+
+
+class TimeIndex:
+    """Индекс времени сообщений: позиции, упорядоченные по секундам UTC
+
+    Новые сообщения копятся в хвосте и вливаются при первом запросе; если
+    хвост идет не раньше уже упорядоченной части (обычный случай для
+    экспорта Telegram), он просто дописывается без пересортировки.
+    """
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.positions = array('I')
+        self._pending = []
+
+    def add(self, position, timestamp):
+        """Добавляет сообщение; сообщения без даты не индексируются"""
+        if timestamp != _NO_VALUE:
+            self._pending.append((timestamp, position))
+
+    def _merge(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        pending.sort()
+        if self.timestamps and pending[0][0] < self.timestamps[-1]:
+            pending = sorted(list(zip(self.timestamps, self.positions)) + pending)
+            self.timestamps, self.positions = array('q'), array('I')
+        self.timestamps.extend(timestamp for timestamp, _ in pending)
+        self.positions.extend(position for _, position in pending)
+
+    def between(self, start=None, end=None):
+        """Позиции сообщений с временем в [start, end] по возрастанию позиций
+
+        Границы ищутся двоичным поиском; None - без ограничения.
+        """
+        self._merge()
+        first = 0 if start is None else bisect.bisect_left(self.timestamps, start)
+        last = len(self.timestamps) if end is None else bisect.bisect_right(self.timestamps, end)
+        return array('I', sorted(self.positions[first:last]))
+
+    def truncate(self, position):
+        """Убирает сообщения с позиции position и дальше"""
+        self._pending = [item for item in self._pending if item[1] < position]
+        if self.positions and max(self.positions) >= position:
+            kept = [(timestamp, p) for timestamp, p in zip(self.timestamps, self.positions) if p < position]
+            self.timestamps = array('q', (timestamp for timestamp, _ in kept))
+            self.positions = array('I', (p for _, p in kept))
+
+
+class QueryCache:
+    """LRU-кэш результатов filter_messages в памяти
+
+    Запись помнит поколение данных, для которого посчитана; запись
+    другого поколения не выдается и удаляется. Размер ограничен числом
+    записей и суммарным объемом массивов позиций выборок.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_ENTRIES, max_bytes=QUERY_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    @staticmethod
+    def _result_bytes(results):
+        result_sets = [value for value in results.values() if not isinstance(value, dict)]
+        result_sets += results['term_matches'].values()
+        return sum(rs.nbytes for rs in result_sets)
+
+    def get(self, key, generation):
+        """Результаты запроса key для поколения generation или None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != generation:
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, generation, results):
+        """Запоминает результаты, вытесняя давно не запрашивавшиеся"""
+        if key in self.entries:
+            self._drop(key)
+        size = self._result_bytes(results)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        self.entries[key] = (generation, results, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+
+    def clear(self):
+        """Удаляет все записи"""
+        self.entries.clear()
+        self.size = 0
+
+    def _drop(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+
+class PerformanceLog:
+    """Замеры этапов работы парсера
+
+    Для каждого этапа (read, parse, index, write, filter, render, ...) и
+    отдельно для каждого файла копятся число вызовов, время, процессорное
+    время потока, число сообщений и пик выделенной памяти. Пик памяти
+    считается, только пока включен tracemalloc. Работа процессов пула
+    параллельной загрузки в процессорное время не входит.
+
+    Можно заказать профиль следующего выполнения этапа: cProfile и снимок
+    tracemalloc сохраняются в каталог profile_dir.
+    """
+
+    def __init__(self, profile_dir=PROFILE_DIR):
+        self.stages = {}
+        self.files = {}
+        self.profile_dir = profile_dir
+        self.profile_stage = None
+        self.dumps = []
+        self._lock = threading.Lock()
+        # У каждого потока свой стек вложенных этапов
+        self._local = threading.local()
+
+    def clear(self):
+        """Сбрасывает накопленные замеры"""
+        with self._lock:
+            self.stages = {}
+            self.files = {}
+
+    @staticmethod
+    def tracing():
+        return tracemalloc.is_tracing()
+
+    @staticmethod
+    def set_tracing(enabled):
+        """Включает или выключает отслеживание памяти (заметно замедляет работу)"""
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name, filename=None):
+        """Замеряет этап; в выданный словарь можно записать число сообщений"""
+        stack = self._local.__dict__.setdefault('stack', [])
+        record = {'messages': 0}
+        
+        profiler = started_tracing = None
+        if self.profile_stage == name:
+            self.profile_stage = None
+            profiler = cProfile.Profile()
+            started_tracing = not tracemalloc.is_tracing()
+            self.set_tracing(True)
+        
+        frame = None
+        if tracemalloc.is_tracing():
+            # Пик памяти один на процесс: вложенный этап сбрасывает его,
+            # поэтому внешний этап забирает свой пик до сброса и после
+            current, peak = tracemalloc.get_traced_memory()
+            if stack and stack[-1]:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame = {'base': current, 'peak': current}
+        stack.append(frame)
+        
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            stack.pop()
+            
+            alloc = None
+            if frame and tracemalloc.is_tracing():
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if stack and stack[-1]:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+                alloc = peak - frame['base']
+            self._record(name, filename, wall, cpu, record['messages'], alloc)
+            
+            if profiler:
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracing:
+                    self.set_tracing(False)
+                self._dump(name, profiler, snapshot)
+
+    def _record(self, name, filename, wall, cpu, messages, alloc):
+        with self._lock:
+            tables = [self.stages]
+            if filename:
+                tables.append(self.files.setdefault(filename, {}))
+            for table in tables:
+                totals = table.get(name)
+                if totals is None:
+                    totals = table[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'messages': 0, 'alloc_peak': None}
+                totals['calls'] += 1
+                totals['wall'] += wall
+                totals['cpu'] += cpu
+                totals['messages'] += messages
+                if alloc is not None:
+                    totals['alloc_peak'] = max(totals['alloc_peak'] or 0, alloc)
+
+    def _dump(self, name, profiler, snapshot):
+        """Сохраняет профиль этапа: .prof для pstats/snakeviz, .txt с топом и снимок памяти"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        base = os.path.join(self.profile_dir, f"{name}_{datetime.now():%Y%m%d_%H%M%S_%f}")
+        profiler.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            f.write('\nНаибольшие выделения памяти:\n')
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                f.write(f'{stat}\n')
+        snapshot.dump(base + '.tracemalloc')
+        self.dumps.append(base)
+
+
+class FrequencySketch:
+    """Частоты токенов с ограниченной памятью: алгоритм Misra-Gries (Frequent)
+
+    Хранится не больше 2 * capacity счетчиков. При переполнении из всех
+    счетчиков вычитается (capacity + 1)-е по величине значение, и
+    обнулившиеся удаляются: оценка частоты занижена не больше чем на
+    error <= total / (capacity + 1). Пока вычитаний не было, подсчет
+    точный; capacity=None - всегда точный. Сводки сливаются (merge) с той
+    же гарантией, поэтому частичные результаты файлов можно объединять.
+    """
+
+    __slots__ = ('capacity', 'counts', 'total', 'error')
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.counts = Counter()
+        self.total = 0
+        self.error = 0
+
+    @classmethod
+    def for_error(cls, error):
+        """Сводка с ошибкой не больше доли error от числа токенов (None - точная)"""
+        return cls(None if error is None else math.ceil(1 / error))
+
+    def update(self, tokens):
+        """Учитывает список токенов"""
+        # Counter.update считает список в C, без цикла на каждый токен
+        self.counts.update(tokens)
+        self.total += len(tokens)
+        if self.capacity is not None and len(self.counts) > 2 * self.capacity:
+            self._prune()
+
+    def merge(self, other):
+        """Добавляет к сводке другую сводку"""
+        counts = self.counts
+        for token, count in other.counts.items():
+            counts[token] = counts.get(token, 0) + count
+        self.total += other.total
+        self.error += other.error
+        if self.capacity is not None and len(counts) > 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        cut = heapq.nlargest(self.capacity + 1, self.counts.values())[-1]
+        self.error += cut
+        self.counts = Counter({token: count - cut for token, count in self.counts.items() if count > cut})
+
+    def top(self, count):
+        """Самые частые токены: [(токен, оценка снизу)], истинная частота - не больше оценки + error"""
+        return heapq.nsmallest(count, self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def copy(self):
+        """Независимая копия: счетчики не разделяются с исходной сводкой"""
+        sketch = FrequencySketch(self.capacity)
+        sketch.total, sketch.error, sketch.counts = self.total, self.error, Counter(self.counts)
+        return sketch
+
+    def to_json(self):
+        return {'capacity': self.capacity, 'total': self.total, 'error': self.error, 'counts': self.counts}
+
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(data['capacity'])
+        sketch.total, sketch.error, sketch.counts = data['total'], data['error'], Counter(data['counts'])
+        return sketch
+
+
+class TokenFrequencies:
+    """Частоты слов, упоминаний (@) и хэштегов (#): по всему файлу и по авторам
+
+    Токены берутся из текста в форме для поиска; ссылки пропускаются, слова
+    короче FREQUENCY_MIN_WORD и числа не учитываются. Результаты файлов
+    сливаются через merge в частоты чата или всего архива. Тексты
+    сообщений копятся по авторам и разбираются на токены пачками примерно
+    по FREQUENCY_BATCH символов; chat и users отдают уже учтенные сводки.
+    """
+
+    def __init__(self, error=FREQUENCY_ERROR, user_error=FREQUENCY_USER_ERROR):
+        self.error = error
+        self.user_error = user_error
+        self._chat = {kind: FrequencySketch.for_error(error) for kind in FREQUENCY_KINDS}
+        self._users = {}
+        # Еще не учтенные тексты по авторам и их общая длина
+        self._pending = {}
+        self._pending_size = 0
+
+    @property
+    def chat(self):
+        self._flush()
+        return self._chat
+
+    @property
+    def users(self):
+        self._flush()
+        return self._users
+
+    def _user(self, author):
+        sketches = self._users.get(author)
+        if sketches is None:
+            sketches = self._users[author] = {kind: FrequencySketch.for_error(self.user_error)
+                                              for kind in FREQUENCY_KINDS}
+        return sketches
+
+    def add(self, author, text):
+        """Учитывает токены одного сообщения"""
+        texts = self._pending.get(author)
+        if texts is None:
+            texts = self._pending[author] = []
+        texts.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= FREQUENCY_BATCH:
+            self._flush()
+
+    def _flush(self):
+        """Разбирает накопленные тексты и учитывает токены в сводках чата и авторов
+
+        Тексты автора склеиваются через перевод строки - ни ссылка, ни
+        слово, ни тег его не пересекают, поэтому токены те же, что и по
+        одному сообщению, а регулярное выражение вызывается раз на автора.
+        """
+        if not self._pending:
+            return
+        pending, self._pending, self._pending_size = self._pending, {}, 0
+        for author, texts in pending.items():
+            text = '\n'.join(texts)
+            tokens = _FREQUENCY_TOKEN_RE.findall(text)
+            words = [word for _, word in tokens if len(word) >= FREQUENCY_MIN_WORD and not word.isdigit()]
+            mentions, hashtags = [], []
+            if '@' in text or '#' in text:
+                for tag, _ in tokens:
+                    if tag:
+                        (mentions if tag[0] == '@' else hashtags).append(tag)
+            if not (words or mentions or hashtags):
+                continue
+            user = self._user(author)
+            for kind, kind_tokens in zip(FREQUENCY_KINDS, (words, mentions, hashtags)):
+                if kind_tokens:
+                    self._chat[kind].update(kind_tokens)
+                    user[kind].update(kind_tokens)
+
+    def merge(self, other):
+        """Добавляет частоты другого файла"""
+        self._flush()
+        for kind in FREQUENCY_KINDS:
+            self._chat[kind].merge(other.chat[kind])
+        for author, sketches in other.users.items():
+            user = self._user(author)
+            for kind in FREQUENCY_KINDS:
+                user[kind].merge(sketches[kind])
+        return self
+
+    def top(self, kind, count, author=None):
+        """Самые частые токены вида kind и допустимая ошибка: ([(токен, частота)], ошибка)"""
+        if author is None:
+            sketch = self.chat[kind]
+        elif author in self.users:
+            sketch = self.users[author][kind]
+        else:
+            return [], 0
+        return sketch.top(count), sketch.error
+
+    def copy(self):
+        """Независимая копия с уже учтенными текстами - для отката загрузки"""
+        frequencies = TokenFrequencies(self.error, self.user_error)
+        frequencies._chat = {kind: sketch.copy() for kind, sketch in self.chat.items()}
+        frequencies._users = {author: {kind: sketch.copy() for kind, sketch in sketches.items()}
+                              for author, sketches in self.users.items()}
+        return frequencies
+
+    def to_json(self):
+        return {
+            'error': self.error,
+            'user_error': self.user_error,
+            'chat': {kind: sketch.to_json() for kind, sketch in self.chat.items()},
+            'users': {author: {kind: sketch.to_json() for kind, sketch in sketches.items()}
+                      for author, sketches in self.users.items()}
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        frequencies = cls(data['error'], data['user_error'])
+        frequencies._chat = {kind: FrequencySketch.from_json(sketch) for kind, sketch in data['chat'].items()}
+        frequencies._users = {author: {kind: FrequencySketch.from_json(sketch) for kind, sketch in sketches.items()}
+                              for author, sketches in data['users'].items()}
+        return frequencies
+
+
+class TextIndex:
+    """Полнотекстовый индекс по тексту сообщений в форме для поиска (_search_form)
+
+    tokens - слова -> позиции сообщений, trigrams - триграммы -> позиции
+    (для поиска подстрок), short - сообщения короче трех символов.
+    Индекс состоит из сегментов (обычно по одному на файл), каждый со
+    своими компактными списками позиций по возрастанию; сегменты из
+    дискового кэша читаются прямо из отображенного в память файла.
+    """
+
     def __init__(self):
-        self.messages = []
+        self.segments = []
+        self._open = None
+
+    def add(self, position, text):
+        """Добавляет в индекс текст сообщения, уже приведенный к форме для поиска"""
+        if not isinstance(text, str) or not text:
+            return
+        if self._open is None:
+            self._open = _TextSegment(position)
+            self.segments.append(self._open)
+        self._open.add(position, text)
+
+    def seal(self):
+        """Закрывает текущий сегмент и возвращает его (или None)
+
+        Следующие сообщения попадут в новый сегмент.
+        """
+        segment, self._open = self._open, None
+        if segment is not None:
+            segment.flush()
+        return segment
+
+    def attach(self, segment):
+        """Добавляет готовый сегмент, например прочитанный из кэша"""
+        self.seal()
+        self.segments.append(segment)
+
+    def truncate(self, position):
+        """Убирает сегменты, начатые с позиции position и дальше
+
+        Каждый файл начинает свой сегмент, поэтому так откатывается файл целиком.
+        """
+        self._open = None
+        for segment in self.segments:
+            if segment.base >= position:
+                segment.close()
+        self.segments = [segment for segment in self.segments if segment.base < position]
+
+    def close(self):
+        """Закрывает сегменты, прочитанные из файлов секций"""
+        for segment in self.segments:
+            segment.close()
+
+    def substring_candidates(self, query, limit=None):
+        """Позиции сообщений, которые могут содержать подстроку query (в форме для поиска)
+
+        Кандидаты нужно проверить по самому тексту: триграммы не учитывают порядок.
+        Если кандидатов больше limit, возвращается None.
+        """
+        found = [(segment.base, self._segment_candidates(segment, query)) for segment in self.segments]
+        if limit is not None and sum(len(candidates) for _, candidates in found) > limit:
+            return None
+        positions = []
+        for base, candidates in found:
+            positions.extend(base + p for p in candidates)
+        return positions
+
+    @staticmethod
+    def _segment_candidates(segment, query):
+        trigrams = segment.trigrams
+        if len(query) >= 3:
+            postings = []
+            for trigram in {query[i:i + 3] for i in range(len(query) - 2)}:
+                found = trigrams.get(trigram)
+                if found is None:
+                    return ()
+                postings.append(found)
+            return min(postings, key=len)
+
+        # Короткий запрос содержится в одной из триграмм текста или в коротком тексте
+        positions = set(segment.short)
+        for trigram in trigrams.keys():
+            if query in trigram:
+                positions.update(trigrams.get(trigram))
+        return sorted(positions)
+
+    def word_positions(self, words):
+        """Позиции сообщений, содержащих все слова из words"""
+        tokens = set(_TOKEN_RE.findall(_search_form(words)))
+        if not tokens:
+            return []
+        positions = []
+        for segment in self.segments:
+            postings = sorted((segment.tokens.get(token, ()) for token in tokens), key=len)
+            found = set(postings[0])
+            for other in postings[1:]:
+                found.intersection_update(other)
+            positions.extend(segment.base + p for p in sorted(found))
+        return positions
+
+
+class MultiPatternMatcher:
+    """Автомат Ахо-Корасик: поиск многих подстрок за один проход по тексту
+
+    Термины сравниваются в форме для поиска, как и поиск по ключевому слову.
+    """
+
+    def __init__(self, terms):
+        self.terms = [term for term in dict.fromkeys(terms) if term]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for term_index, term in enumerate(self.terms):
+            state = 0
+            for char in _search_form(term):
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] += (term_index,)
+
+        # Суффиксные ссылки строятся обходом бора в ширину
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.output[next_state] += self.output[fail]
+
+    def find(self, text):
+        """Индексы терминов, встречающихся в тексте (текст уже в форме для поиска)"""
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+# Ссылки на группы по номеру или имени: в объединенном выражении номера групп сдвигаются
+_REGEX_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+class RegexPatternMatcher:
+    """Поиск по списку регулярных выражений
+
+    Выражения, если можно, объединены в одно: сообщения без совпадений
+    отсеиваются одним проходом, отдельные выражения проверяются
+    только на найденных.
+    """
+
+    def __init__(self, terms):
+        self.terms = [term for term in dict.fromkeys(terms) if term]
+        self.patterns = [re.compile(term, re.IGNORECASE) for term in self.terms]
+        self.combined = self._combine(self.patterns)
+
+    @staticmethod
+    def _combine(patterns):
+        """Объединенное выражение или None, если выражения нужно проверять по отдельности
+
+        Не объединяются выражения с обратными ссылками (\\1, (?P=имя),
+        (?(1)...)) и с собственными флагами вроде (?x): в общем выражении
+        ссылки указали бы на чужие группы, а флаги подействовали бы на все.
+        """
+        default_flags = re.compile('', re.IGNORECASE).flags
+        for pattern in patterns:
+            if pattern.flags != default_flags:
+                return None
+            if pattern.groups and _REGEX_GROUP_REFERENCE.search(pattern.pattern):
+                return None
+        try:
+            return re.compile('|'.join(f'(?:{pattern.pattern})' for pattern in patterns), re.IGNORECASE)
+        except re.error:
+            # Например, одинаковые имена групп в разных выражениях
+            return None
+
+    def find(self, text):
+        """Индексы выражений, совпавших в тексте"""
+        if not self.terms or (self.combined is not None and not self.combined.search(text)):
+            return set()
+        return {i for i, pattern in enumerate(self.patterns) if pattern.search(text)}
+
+
+class TelegramChatParser:
+    def __init__(self, stream_json=None, workers=1, indexed=True, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES,
+                 query_cache_entries=QUERY_CACHE_ENTRIES, query_cache_bytes=QUERY_CACHE_BYTES,
+                 frequency_error=FREQUENCY_ERROR):
+        self.messages = MessageStore()
+        self.file_sources = {}
+        # Рабочие процессы загрузки индексы не строят: это делает основной процесс
+        self.indexed = indexed
+        self.indexes = {field: {} for field in INDEXED_FIELDS}
+        self.text_index = TextIndex()
+        self.time_index = TimeIndex()
+        # Граф ответов: (чат, id сообщения) -> позиции ответов на него
+        self.reply_graph = {}
+        self._thread_stats = None
+        # Частоты слов, упоминаний и хэштегов по файлам (частичные результаты,
+        # сливаются при запросе); frequency_error=None - точный подсчет
+        self.frequencies = {}
+        self.frequency_error = frequency_error
+        # None - потоковое чтение включается автоматически для больших файлов
+        self.stream_json = stream_json
+        # Число процессов для параллельной загрузки файлов
+        self.workers = workers
+        # Дисковый кэш разобранных файлов (None - без кэша)
+        self.cache = ParseCache(cache_dir, cache_max_bytes) if cache_dir else None
+        # Чат каждого файла и наибольший загруженный из файла id
+        self.file_chats = {}
+        self.file_last_ids = {}
+        # Итоги последней инкрементальной загрузки: файл -> новых/дубликатов
+        self.ingest_report = {}
+        # Поколение данных растет при каждой загрузке и очистке; по нему
+        # кэш результатов отличает устаревшие записи
+        self.data_generation = 0
+        self.query_cache = QueryCache(query_cache_entries, query_cache_bytes)
+        # Фоновая загрузка вливает файлы в парсер под этой блокировкой
+        self.lock = threading.RLock()
+        # Замеры этапов загрузки, фильтрации и экспорта
+        self.perf = PerformanceLog()
+        self.current_filters = dict(DEFAULT_FILTERS)
+        self.current_results = None
+    
+    def parse_html(self, html_content, filename):
+        """Парсит HTML файл Telegram чата"""
+        try:
+            records = scan_html_messages([html_content], filename)
+        except _UnsupportedHTML:
+            self._parse_html_soup(html_content, filename)
+            return
+        
+        for msg_data in records:
+            self._add_message(msg_data)
+    
+    def parse_html_stream(self, f, filename):
+        """Парсит HTML файл Telegram чата, читая его кусками"""
+        try:
+            records = scan_html_messages(_iter_chunks(f), filename)
+        except _UnsupportedHTML:
+            f.seek(0)
+            self._parse_html_soup(f.read(), filename)
+            return
+        
+        for msg_data in records:
+            self._add_message(msg_data)
+    
+    def _parse_html_soup(self, html_content, filename):
+        """Парсит HTML через дерево BeautifulSoup (запасной путь)"""
+        soup = BeautifulSoup(html_content, 'html.parser')
+        messages = soup.find_all('div', class_='message')
+        
+        for message in messages:
+            message_id = message.get('id')
+            if message_id:
+                message_id = int(message_id.replace('message', ''))
+            
+            from_name_elem = message.find('div', class_='from_name')
+            from_name = from_name_elem.text.strip() if from_name_elem else 'Unknown'
+            
+            text_elem = message.find('div', class_='text')
+            text = text_elem.text.strip() if text_elem else ''
+            
+            date_elem = message.find('div', class_='date')
+            date = date_elem.get('title') if date_elem else ''
+            
+            reply_to = None
+            reply_to_elem = message.find('div', class_='reply_to')
+            if reply_to_elem and reply_to_elem.find('a'):
+                reply_link = reply_to_elem.find('a')
+                if 'onclick' in reply_link.attrs:
+                    match = re.search(r'GoToMessage\((\d+)\)', reply_link['onclick'])
+                    if match:
+                        reply_to = int(match.group(1))
+            
+            msg_data = {
+                'id': message_id,
+                'from': from_name,
+                'text': text,
+                'date': date,
+                'reply_to': reply_to,
+                'source_file': filename
+            }
+            
+            self._add_message(msg_data)
+    
+    def parse_json(self, json_content, filename):
+        """Парсит JSON файл Telegram чата"""
+        data = json.loads(json_content)
+        
+        if 'messages' in data:
+            for msg in data['messages']:
+                self._add_message(_json_message_record(msg, filename))
+    
+    def parse_json_stream(self, f, filename):
+        """Потоково парсит JSON файл Telegram чата из открытого файла"""
+        for msg in iter_json_messages(f):
+            self._add_message(_json_message_record(msg, filename))
+    
+    def _store_message(self, msg_data):
+        """Сохраняет запись сообщения и добавляет ее в индексы"""
+        position = len(self.messages)
+        search_text = self.messages.append(msg_data)
+        if not self.indexed:
+            return
+        self._index_fields(position, msg_data)
+        self.text_index.add(position, search_text)
+        self._count_tokens(msg_data, search_text)
+    
+    def _count_tokens(self, msg_data, search_text):
+        """Добавляет токены сообщения в частоты его файла"""
+        frequencies = self.frequencies.get(msg_data['source_file'])
+        if frequencies is None:
+            user_error = None if self.frequency_error is None else FREQUENCY_USER_ERROR
+            frequencies = self.frequencies[msg_data['source_file']] = TokenFrequencies(self.frequency_error, user_error)
+        frequencies.add(msg_data['from'], search_text)
+    
+    def token_frequencies(self, source_file=None, chat=None):
+        """Частоты по файлу, чату или всему архиву - слияние частичных результатов файлов"""
+        user_error = None if self.frequency_error is None else FREQUENCY_USER_ERROR
+        merged = TokenFrequencies(self.frequency_error, user_error)
+        for filename, frequencies in self.frequencies.items():
+            if source_file and filename != source_file:
+                continue
+            if chat is not None and self._chat_of(filename) != chat:
+                continue
+            merged.merge(frequencies)
+        return merged
+    
+    def _index_fields(self, position, msg):
+        """Добавляет сообщение в индексы полей"""
+        for field, index in self.indexes.items():
+            value = msg[field]
+            if value is not None:
+                positions = index.get(value)
+                if positions is None:
+                    positions = index[value] = array('I')
+                positions.append(position)
+        self.time_index.add(position, self.messages.timestamps[position])
+        
+        reply_to = msg['reply_to']
+        if reply_to is not None:
+            key = (self._chat_of(msg['source_file']), reply_to)
+            children = self.reply_graph.get(key)
+            if children is None:
+                children = self.reply_graph[key] = array('I')
+            children.append(position)
+        
+        # Наибольший id файла нужен, чтобы дочитывать только хвост обновленного экспорта
+        message_id = msg['id']
+        if type(message_id) is int and message_id > self.file_last_ids.get(msg['source_file'], 0):
+            self.file_last_ids[msg['source_file']] = message_id
+    
+    def _add_message(self, msg_data):
+        """Добавляет сообщение и обновляет информацию о файле"""
+        self._store_message(msg_data)
+        # Сохраняем информацию о файле
+        stats = self._source_stats(msg_data['source_file'])
+        stats['message_count'] += 1
+        stats['users'].add(msg_data['from'])
+        if msg_data['id']:
+            stats['message_ids'].add(msg_data['id'])
+    
+    def _source_stats(self, filename):
+        """Возвращает (создавая при необходимости) информацию о файле"""
+        if filename not in self.file_sources:
+            self.file_sources[filename] = {
+                'message_count': 0,
+                'users': set(),
+                'message_ids': set()
+            }
+        return self.file_sources[filename]
+    
+    def _use_json_stream(self, filename):
+        """Решает, читать ли JSON файл потоково"""
+        if self.stream_json is not None:
+            return self.stream_json
+        return os.path.getsize(filename) > JSON_STREAM_THRESHOLD
+    
+    def _parse_file(self, filename):
+        """Разбирает один файл в зависимости от его формата"""
+        before = self._file_messages(filename)
+        if filename.endswith('.html') or self._use_json_stream(filename):
+            # Файл читается кусками по ходу разбора, поэтому чтение входит в этап parse
+            with self.perf.stage('parse', filename) as stage, self._open_source(filename) as f:
+                if filename.endswith('.html'):
+                    self.parse_html_stream(f, filename)
+                else:
+                    self.parse_json_stream(f, filename)
+                stage['messages'] = self._file_messages(filename) - before
+        else:
+            with self.perf.stage('read', filename), self._open_source(filename) as f:
+                content = f.read()
+            with self.perf.stage('parse', filename) as stage:
+                self.parse_json(content, filename)
+                stage['messages'] = self._file_messages(filename) - before
+    
+    def _file_messages(self, filename):
+        """Сколько сообщений файла уже загружено"""
+        stats = self.file_sources.get(filename)
+        return stats['message_count'] if stats else 0
+    
+    def _open_source(self, filename):
+        """Открывает файл экспорта для разбора"""
+        return open(filename, 'r', encoding='utf-8')
+    
+    def _prepare_file(self, filename):
+        """Проверяет файл перед загрузкой: False - загружать его не нужно"""
+        return True
+    
+    def _discard_failed(self, filenames):
+        """Убирает следы файлов, загрузка которых прервалась"""
+    
+    def _file_mark(self, filename):
+        """Состояние перед загрузкой файла - чтобы откатить ее при ошибке"""
+        stats = self.file_sources.get(filename)
+        frequencies = self.frequencies.get(filename)
+        return {
+            'position': self._mark_position(),
+            'stats': None if stats is None else {key: set(value) if isinstance(value, set) else value
+                                                 for key, value in stats.items()},
+            'frequencies': frequencies.copy() if frequencies else None,
+            'last_id': self.file_last_ids.get(filename),
+            'chat': self.file_chats.get(filename)
+        }
+    
+    def _mark_position(self):
+        return len(self.messages)
+    
+    def _rollback_file(self, filename, mark):
+        """Откатывает незавершенную загрузку файла: сообщения, индексы и сведения о файле"""
+        position = mark['position']
+        self.messages.truncate(position)
+        for index in self.indexes.values():
+            _truncate_postings(index, position)
+        _truncate_postings(self.reply_graph, position)
+        self.text_index.truncate(position)
+        self.time_index.truncate(position)
+        self._restore_file_state(filename, mark)
+    
+    def _restore_file_state(self, filename, mark):
+        """Возвращает сведения о файле к отметке mark"""
+        for mapping, value in ((self.file_sources, mark['stats']), (self.file_last_ids, mark['last_id']),
+                               (self.file_chats, mark['chat'])):
+            if value is None:
+                mapping.pop(filename, None)
+            else:
+                mapping[filename] = value
+        if mark['frequencies'] is None:
+            self.frequencies.pop(filename, None)
+        else:
+            self.frequencies[filename] = mark['frequencies']
+        self._bump_generation()
+    
+    def _merge_batch(self, filename, store, stats):
+        """Добавляет пакет, разобранный в другом процессе"""
+        for position in range(len(store)):
+            self._store_message(store.record_data(position))
+        
+        if stats is None:
+            return
+        merged = self._source_stats(filename)
+        merged['message_count'] += stats['message_count']
+        merged['users'].update(stats['users'])
+        merged['message_ids'].update(stats['message_ids'])
+    
+    def _load_cached(self, filename, header, sections, source):
+        """Загружает файл из записи дискового кэша без повторного разбора
+        
+        Колонки сообщений копируются, а сегмент индекса остается в файле
+        source и держит его открытым.
+        """
+        meta = header['messages']
+        with self.perf.stage('cache', filename) as stage:
+            start = self._begin_file()
+            self.messages.import_range(sections, meta, filename)
+            end = len(self.messages)
+            
+            for position in range(start, end):
+                self._index_fields(position, self.messages[position])
+            if header['segment_offset'] is not None:
+                self.text_index.attach(_MappedTextSegment(start + header['segment_offset'], source, sections))
+            else:
+                # Снимок без сегментов индекса: индекс строится по форме для поиска, без разбора
+                for position in range(start, end):
+                    self.text_index.add(position, self.messages.search_text(position))
+                self.text_index.seal()
+            
+            if meta['count']:
+                stats = self._source_stats(filename)
+                stats['message_count'] += meta['count']
+                stats['users'].update(meta['authors'])
+                message_ids = (self.messages.value(p, 'id') for p in range(start, end))
+                stats['message_ids'].update(message_id for message_id in message_ids if message_id)
+            if header.get('frequencies'):
+                self._merge_frequencies(filename, TokenFrequencies.from_json(header['frequencies']))
+            stage['messages'] = meta['count']
+    
+    def _merge_frequencies(self, filename, frequencies):
+        """Добавляет готовые частоты файла (из кэша или базы)"""
+        if filename in self.frequencies:
+            self.frequencies[filename].merge(frequencies)
+        else:
+            self.frequencies[filename] = frequencies
+    
+    def _begin_file(self):
+        """Начинает новый файл: свой сегмент текстового индекса"""
+        self.text_index.seal()
+        return len(self.messages)
+    
+    def _finish_file(self, filename, start, cache_key):
+        """Завершает файл и сохраняет результат разбора в кэш"""
+        with self.perf.stage('index', filename):
+            segment = self.text_index.seal()
+        if self.cache and cache_key:
+            with self.perf.stage('write', filename):
+                self.cache.save(filename, cache_key, self.messages, start, len(self.messages), segment,
+                                self.frequencies.get(filename))
+    
+    def load_files(self, filenames, workers=None, incremental=False):
+        """Загружает несколько файлов
+        
+        В режиме incremental добавляются только сообщения, которых еще нет.
+        """
+        with self.perf.stage('load') as stage:
+            self._load_files(filenames, workers, incremental)
+            if incremental:
+                stage['messages'] = sum(self.ingest_report.get(filename, {}).get('new', 0) for filename in filenames)
+            else:
+                stage['messages'] = sum(map(self._file_messages, filenames))
+    
+    def _load_files(self, filenames, workers, incremental):
+        """Загрузка файлов без замера этапа load"""
+        self._bump_generation()
+        if incremental:
+            self._load_files_incremental(filenames)
+            return
+        
+        workers = self.workers if workers is None else workers
+        if workers > 1 and (len(filenames) > 1 or any(map(_is_chunked_candidate, filenames))):
+            self._load_files_parallel(filenames, workers)
+            return
+        
+        for filename in filenames:
+            mark = self._file_mark(filename)
+            try:
+                self.file_chats[filename] = export_chat_key(filename)
+                entry = self.cache.open(filename) if self.cache else None
+                if entry:
+                    with entry:
+                        self._load_cached(filename, entry.header, entry.sections, entry)
+                    print(f"✓ Файл {filename} загружен из кэша ({self.file_sources[filename]['message_count']} сообщений)")
+                    continue
+                
+                cache_key = self.cache.key(filename) if self.cache else None
+                start = self._begin_file()
+                self._parse_file(filename)
+                self._finish_file(filename, start, cache_key)
+                
+                print(f"✓ Файл {filename} загружен ({self.file_sources[filename]['message_count']} сообщений)")
+                
+            except Exception as e:
+                # Потоковый разбор успевает добавить часть сообщений - они убираются
+                self._rollback_file(filename, mark)
+                print(f"✗ Ошибка при чтении файла {filename}: {e}")
+    
+    def _load_files_parallel(self, filenames, workers):
+        """Разбирает файлы в пуле процессов и сливает результаты в исходном порядке
+        
+        Большие файлы делятся на куски по границам сообщений и разбираются
+        на нескольких ядрах; если кусок не разобрался, файл целиком
+        разбирается заново одним процессом. Файлы из кэша в пул не попадают.
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = []
+            for filename in filenames:
+                entry = cache_key = None
+                if self.cache:
+                    try:
+                        entry = self.cache.open(filename)
+                        cache_key = self.cache.key(filename)
+                    except OSError:
+                        pass
+                if entry:
+                    jobs.append((filename, entry, None, []))
+                    continue
+                
+                futures = [future for future, _ in _submit_export(executor, filename, workers, self.stream_json)]
+                jobs.append((filename, None, cache_key, futures))
+            
+            for filename, entry, cache_key, futures in jobs:
+                mark = self._file_mark(filename)
+                try:
+                    self.file_chats[filename] = export_chat_key(filename)
+                    if entry:
+                        with entry:
+                            self._load_cached(filename, entry.header, entry.sections, entry)
+                        print(f"✓ Файл {filename} загружен из кэша ({self.file_sources[filename]['message_count']} сообщений)")
+                        continue
+                    
+                    # Здесь видно только ожидание процессов пула, их собственное время не замеряется
+                    with self.perf.stage('parse', filename):
+                        try:
+                            batches = [future.result() for future in futures]
+                        except Exception:
+                            if len(futures) == 1:
+                                raise
+                            batches = [executor.submit(_load_file_worker, filename, self.stream_json).result()]
+                    
+                    start = self._begin_file()
+                    with self.perf.stage('merge', filename) as stage:
+                        for store, stats in batches:
+                            self._merge_batch(filename, store, stats)
+                        stage['messages'] = self._file_messages(filename)
+                    self._finish_file(filename, start, cache_key)
+                    
+                    print(f"✓ Файл {filename} загружен ({self.file_sources[filename]['message_count']} сообщений)")
+                    
+                except Exception as e:
+                    self._rollback_file(filename, mark)
+                    print(f"✗ Ошибка при чтении файла {filename}: {e}")
+    
+    def _load_files_incremental(self, filenames):
+        """Загружает файлы, пропуская сообщения, которые уже загружены
+        
+        Дубликаты определяются по паре (чат, id сообщения) через индекс id.
+        Если из чата уже загружены сообщения, из обновленного экспорта не
+        разбирается начало, все сообщения которого уже загружены.
+        """
+        for filename in filenames:
+            mark = self._file_mark(filename)
+            try:
+                new, duplicates = self._ingest_new(filename)
+                self.ingest_report[filename] = {'new': new, 'duplicates': duplicates}
+                print(f"✓ Файл {filename}: новых сообщений {new}, уже загруженных {duplicates}")
+            except Exception as e:
+                self._rollback_file(filename, mark)
+                print(f"✗ Ошибка при чтении файла {filename}: {e}")
+    
+    def _ingest_new(self, filename):
+        """Добавляет из файла только новые сообщения; возвращает (новых, дубликатов)"""
+        chat, records, duplicates = self._new_source(filename)
+        if records is None:
+            staging = TelegramChatParser(stream_json=self.stream_json, indexed=False)
+            staging.perf = self.perf
+            staging._parse_file(filename)
+            records = map(staging.messages.record_data, range(len(staging.messages)))
+        return self._merge_new(filename, chat, records, duplicates)
+    
+    def _new_source(self, filename):
+        """Откуда брать новые сообщения файла: (чат, записи хвоста, пропущено)
+        
+        Записи - потоковый хвост после уже загруженного начала; None -
+        файл нужно разобрать целиком (тогда пропущенных 0).
+        """
+        chat = export_chat_key(filename)
+        self.file_chats[filename] = chat
+        last_id = max((message_id for source, message_id in self.file_last_ids.items()
+                       if self.file_chats.get(source, source) == chat), default=None)
+        
+        with self.perf.stage('read', filename):
+            tail = (_read_tail(filename, last_id, lambda ids: self._loaded_prefix(chat, ids))
+                    if last_id is not None else None)
+        if tail is None:
+            return chat, None, 0
+        return (chat, *tail)
+    
+    def _merge_new(self, filename, chat, records, duplicates):
+        """Добавляет записи, которых еще нет в чате; возвращает (новых, дубликатов)"""
+        new = 0
+        self._begin_file()
+        with self.perf.stage('merge', filename) as stage:
+            for msg in records:
+                msg_data = dict(msg)
+                if self._is_duplicate(chat, msg_data['id']):
+                    duplicates += 1
+                    continue
+                self._add_message(msg_data)
+                new += 1
+            stage['messages'] = new
+        with self.perf.stage('index', filename):
+            self.text_index.seal()
+        return new, duplicates
+    
+    def _is_duplicate(self, chat, message_id):
+        """Есть ли уже сообщение с таким id из того же чата"""
+        # Служебные разделители дат в HTML имеют отрицательные id и не сравниваются
+        if type(message_id) is not int or message_id <= 0:
+            return False
+        for p in self.indexes['id'].get(message_id, ()):
+            source = self.messages.value(p, 'source_file')
+            if self.file_chats.get(source, source) == chat:
+                return True
+        return False
+    
+    def _loaded_prefix(self, chat, ids):
+        """Сколько первых id из списка уже загружено из того же чата"""
+        for count, message_id in enumerate(ids):
+            if not self._is_duplicate(chat, message_id):
+                return count
+        return len(ids)
+    
+    def save_snapshot(self, path, shard=None, index=True):
+        """Записывает снимок загруженных файлов для сборки общего архива
+        
+        Для каждого файла в заголовке - сводка как в file_sources (число
+        сообщений, чат), сообщения по пользователям и частоты слов; в
+        секциях - множество числовых id, колонки сообщений и, если index,
+        сегмент текстового индекса. shard - имя узла (по умолчанию
+        имя машины). Возвращает заголовок снимка.
+        """
+        shard = shard or platform.node() or 'shard'
+        entries, sections = [], {}
+        with self.perf.stage('write') as stage:
+            for number, filename in enumerate(self.file_sources):
+                store, start, end = self._snapshot_range(filename)
+                prefix = f"{number}."
+                file_sections, meta = store.export_range(start, end)
+                sections.update((prefix + name, data) for name, data in file_sections.items())
+                
+                message_ids = {store.ids[p] for p in range(start, end)}
+                message_ids.difference_update((0, _NO_VALUE))
+                sections[prefix + 'message_ids'] = array('q', sorted(message_ids))
+                user_counts = Counter(store.author_codes[start:end])
+                
+                if index:
+                    segment = _TextSegment(start)
+                    for p in range(start, end):
+                        text = store.search_text(p)
+                        if text:
+                            segment.add(p, text)
+                    sections.update(_segment_sections(segment, prefix))
+                
+                frequencies = self.frequencies.get(filename)
+                entries.append({
+                    'name': filename,
+                    'shard': shard,
+                    'prefix': prefix,
+                    'chat': self._chat_of(filename),
+                    'message_count': end - start,
+                    'user_counts': [[store.authors.values[code], count] for code, count in user_counts.most_common()],
+                    'frequencies': frequencies.to_json() if frequencies else None,
+                    'messages': meta,
+                    'segment': index
+                })
+            
+            header = {'snapshot': SNAPSHOT_VERSION, 'parser_version': PARSER_VERSION, 'shards': [shard],
+                      'created': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'files': entries}
+            write_sections(path, header, sections)
+            stage['messages'] = sum(entry['message_count'] for entry in entries)
+        return header
+    
+    def _snapshot_range(self, filename):
+        """Хранилище и диапазон [start, end) с сообщениями файла для снимка
+        
+        Обычно сообщения файла лежат подряд; после инкрементальной
+        загрузки они копируются во временное хранилище.
+        """
+        positions = self.indexes['source_file'].get(filename, array('I'))
+        if not positions or positions[-1] - positions[0] + 1 == len(positions):
+            start = positions[0] if positions else 0
+            return self.messages, start, start + len(positions)
+        store = MessageStore()
+        for p in positions:
+            store.append(self.messages.record_data(p))
+        return store, 0, len(store)
+    
+    def load_snapshot(self, path):
+        """Добавляет файлы из снимка (одного узла или общего) без разбора экспортов
+        
+        Файлы загружаются так же, как из дискового кэша; если в снимке нет
+        сегментов индекса, индекс строится заново по сохраненной форме текста.
+        Файл с уже занятым именем получает префикс своего узла.
+        Возвращает заголовок снимка.
+        """
+        snapshot, grouped = read_snapshot(path)
+        header = snapshot.header
+        with snapshot, self.perf.stage('load') as stage:
+            self._bump_generation()
+            for entry in header['files']:
+                filename = _snapshot_file_name(entry, self.file_sources)
+                chat = entry['chat']
+                # Чат без названия в экспорте назван по файлу - переименовывается вместе с ним
+                self.file_chats[filename] = filename if chat == entry['name'] else chat
+                cached = {'messages': entry['messages'], 'segment_offset': 0 if entry['segment'] else None,
+                          'frequencies': entry['frequencies']}
+                self._load_cached(filename, cached, grouped.get(entry['prefix'], {}), snapshot)
+            stage['messages'] = sum(entry['message_count'] for entry in header['files'])
+        print(f"✓ Снимок {path} загружен (узлов: {len(header['shards'])}, файлов: {len(header['files'])}, "
+              f"сообщений: {stage['messages']})")
+        return header
+    
+    def clear_data(self, confirm=False):
+        """Очищает все данные сессии
+        
+        Сообщения живут только в памяти, поэтому подтверждение confirm
+        не требуется (оно нужно SQLiteChatParser, который чистит базу).
+        """
+        self.messages = MessageStore()
         self.file_sources = {}
-        self.current_filters = {
-            'target_user': None,
-            'target_message_id': None,
-            'keyword': None,
-            'source_file': None
-        }
+        self.indexes = {field: {} for field in INDEXED_FIELDS}
+        self.text_index.close()
+        self.text_index = TextIndex()
+        self.time_index = TimeIndex()
+        self.reply_graph = {}
+        self.frequencies = {}
+        self.file_chats = {}
+        self.file_last_ids = {}
+        self.ingest_report = {}
+        self._bump_generation()
+        self.current_filters = dict(DEFAULT_FILTERS)
         self.current_results = None
     
-    def clear_data(self):
-        """Очищает все данные"""
-        self.messages = []
-        self.file_sources = {}
+    def _bump_generation(self):
+        """Отмечает изменение данных: закэшированные результаты устаревают"""
+        self.data_generation += 1
+        self.query_cache.clear()
+        self._thread_stats = None
+    
+    def filter_messages(self, target_user=None, target_message_id=None, keyword=None, source_file=None,
+                        terms=None, terms_regex=False, date_from=None, date_to=None, thread_depth=None):
+        """Фильтрует сообщения и сохраняет параметры
+        
+        date_from и date_to (секунды UTC, datetime или строка даты) задают
+        период: остальные выборки ограничиваются им, а все сообщения за
+        период попадают в date_messages. Если задан thread_depth, в
+        thread_messages попадает вся ветка ответов на target_message_id
+        до этой глубины (0 - без ограничения).
+        """
+        # Сохраняем текущие фильтры
         self.current_filters = {
-            'target_user': None,
-            'target_message_id': None,
-            'keyword': None,
-            'source_file': None
+            'target_user': target_user,
+            'target_message_id': target_message_id,
+            'keyword': keyword,
+            'source_file': source_file,
+            'terms': terms,
+            'terms_regex': terms_regex,
+            'date_from': date_from,
+            'date_to': date_to,
+            'thread_depth': thread_depth
         }
-        self.current_results = None
+        start, end = _date_bound(date_from), _date_bound(date_to, end=True)
+        if not target_message_id:
+            thread_depth = None
         
-    def parse_html(self, html_content, filename):
-        """Парсит HTML файл Telegram чата"""
-        soup = BeautifulSoup(html_content, 'html.parser')
-        messages = soup.find_all('div', class_='message')
+        key = (target_user or None, target_message_id or None, _search_form(keyword) if keyword else None,
+               source_file or None, tuple(terms) if terms else None, bool(terms and terms_regex), start, end,
+               thread_depth)
+        results = self.query_cache.get(key, self.data_generation)
+        if results is None:
+            # Замеряется только настоящая фильтрация, ответы из кэша - нет
+            with self.perf.stage('filter'):
+                results = self._run_filters(target_user, target_message_id, keyword, source_file, terms,
+                                            terms_regex, start, end, thread_depth)
+            self.query_cache.put(key, self.data_generation, results)
         
-        for message in messages:
-            message_id = message.get('id')
-            if message_id:
-                message_id = int(message_id.replace('message', ''))
-            
-            from_name_elem = message.find('div', class_='from_name')
-            from_name = from_name_elem.text.strip() if from_name_elem else 'Unknown'
-            
-            text_elem = message.find('div', class_='text')
-            text = text_elem.text.strip() if text_elem else ''
-            
-            date_elem = message.find('div', class_='date')
-            date = date_elem.get('title') if date_elem else ''
-            
-            reply_to = None
-            reply_to_elem = message.find('div', class_='reply_to')
-            if reply_to_elem and reply_to_elem.find('a'):
-                reply_link = reply_to_elem.find('a')
-                if 'onclick' in reply_link.attrs:
-                    match = re.search(r'GoToMessage\((\d+)\)', reply_link['onclick'])
-                    if match:
-                        reply_to = int(match.group(1))
-            
-            msg_data = {
-                'id': message_id,
-                'from': from_name,
-                'text': text,
-                'date': date,
-                'reply_to': reply_to,
-                'source_file': filename
-            }
-            
-            self.messages.append(msg_data)
-            # Сохраняем информацию о файле
-            if filename not in self.file_sources:
-                self.file_sources[filename] = {
-                    'message_count': 0,
-                    'users': set(),
-                    'message_ids': set()
-                }
-            
-            self.file_sources[filename]['message_count'] += 1
-            self.file_sources[filename]['users'].add(from_name)
-            if message_id:
-                self.file_sources[filename]['message_ids'].add(message_id)
+        # Словари у каждого вызова свои; сами выборки неизменяемы и общие с кэшем
+        results = dict(results, term_matches=dict(results['term_matches']))
+        self.current_results = results
+        return results
     
-    def parse_json(self, json_content, filename):
-        """Парсит JSON файл Telegram чата"""
-        data = json.loads(json_content)
+    def _run_filters(self, target_user, target_message_id, keyword, source_file, terms, terms_regex,
+                     start=None, end=None, thread_depth=None):
+        """Выполняет фильтрацию без кэша"""
+        empty = ResultSet(self.messages)
+        results = {
+            'user_messages': empty,
+            'message_comments': empty,
+            'keyword_matches': empty,
+            'term_matches': {},
+            'date_messages': empty,
+            'thread_messages': empty
+        }
         
-        if 'messages' in data:
-            for msg in data['messages']:
-                msg_data = {
-                    'id': msg.get('id'),
-                    'from': msg.get('from', 'Unknown'),
-                    'text': msg.get('text', ''),
-                    'date': msg.get('date', ''),
-                    'reply_to': msg.get('reply_to_message_id'),
-                    'source_file': filename
+        # Фильтр по периоду: двоичный поиск по индексу времени
+        period = None
+        if start is not None or end is not None:
+            period = self.search_period(start, end, source_file)
+            results['date_messages'] = period
+        
+        # Фильтр по пользователю
+        if target_user:
+            results['user_messages'] = self._lookup('from', target_user, source_file)
+        
+        # Фильтр по комментариям
+        if target_message_id:
+            results['message_comments'] = self._lookup('reply_to', target_message_id, source_file)
+        
+        # Вся ветка ответов по графу ответов
+        if target_message_id and thread_depth is not None:
+            results['thread_messages'] = self.get_thread(target_message_id, source_file, thread_depth or None)
+        
+        # Поиск по ключевому слову
+        if keyword:
+            results['keyword_matches'] = self._search_substring(keyword, source_file)
+        
+        if period is not None:
+            for section in ('user_messages', 'message_comments', 'thread_messages', 'keyword_matches'):
+                if results[section]:
+                    results[section] = results[section] & period
+        
+        # Поиск по списку слов за один проход
+        if terms:
+            results['term_matches'] = self.search_terms(terms, source_file, regex=terms_regex, within=period)
+        
+        return results
+    
+    def filter_batch(self, queries):
+        """Выполняет много наборов фильтров вместе
+        
+        queries - словари с параметрами filter_messages. Выборки по
+        пользователю, ответам, ветке и периоду берутся из индексов по одному
+        разу на каждое различное значение в пакете, а ключевые слова и
+        термины всех запросов ищутся за один проход по сообщениям: одним
+        автоматом по форме текста для поиска, посчитанной при загрузке, и
+        одним объединенным выражением для терминов-регулярок. Редкие подстроки
+        (кандидатов в триграммном индексе не больше BATCH_INDEX_SHARE от
+        числа сообщений) берутся из индекса, минуя проход. Возвращает
+        результаты в том же виде, что и filter_messages, в порядке запросов;
+        текущие фильтры и результаты парсера не меняются.
+        """
+        shared = {}
+        
+        def once(method, *args):
+            """Выборка, общая для всех запросов пакета с теми же аргументами"""
+            key = (method,) + args
+            if key not in shared:
+                shared[key] = method(*args)
+            return shared[key]
+        
+        with self.perf.stage('filter') as stage:
+            plans = []
+            buckets = {}
+            for query in queries:
+                filters = dict(DEFAULT_FILTERS, **query)
+                source_file = filters['source_file'] or None
+                keyword = filters['keyword'] or None
+                terms = [term for term in dict.fromkeys(filters['terms'] or ()) if term]
+                kind = 'r' if terms and filters['terms_regex'] else 's'
+                # Корзина - (вид, термин, файл): совпадения собираются в нее при проходе
+                if keyword:
+                    buckets.setdefault(('s', keyword, source_file), len(buckets))
+                for term in terms:
+                    buckets.setdefault((kind, term, source_file), len(buckets))
+                plans.append((filters, source_file, keyword, terms, kind))
+            
+            found = self._scan_buckets(list(buckets))
+            
+            batch = []
+            for filters, source_file, keyword, terms, kind in plans:
+                empty = ResultSet(self.messages)
+                results = {
+                    'user_messages': empty,
+                    'message_comments': empty,
+                    'keyword_matches': empty,
+                    'term_matches': {},
+                    'date_messages': empty,
+                    'thread_messages': empty
                 }
+                start, end = _date_bound(filters['date_from']), _date_bound(filters['date_to'], end=True)
+                target_user, target_message_id = filters['target_user'], filters['target_message_id']
+                thread_depth = filters['thread_depth'] if target_message_id else None
                 
-                self.messages.append(msg_data)
-                # Сохраняем информацию о файле
-                if filename not in self.file_sources:
-                    self.file_sources[filename] = {
-                        'message_count': 0,
-                        'users': set(),
-                        'message_ids': set()
-                    }
+                period = None
+                if start is not None or end is not None:
+                    period = results['date_messages'] = once(self.search_period, start, end, source_file)
+                if target_user:
+                    results['user_messages'] = once(self._lookup, 'from', target_user, source_file)
+                if target_message_id:
+                    results['message_comments'] = once(self._lookup, 'reply_to', target_message_id, source_file)
+                if target_message_id and thread_depth is not None:
+                    results['thread_messages'] = once(self.get_thread, target_message_id, source_file,
+                                                      thread_depth or None)
+                if keyword:
+                    results['keyword_matches'] = found[buckets[('s', keyword, source_file)]]
+                results['term_matches'] = {term: found[buckets[(kind, term, source_file)]] for term in terms}
                 
-                self.file_sources[filename]['message_count'] += 1
-                self.file_sources[filename]['users'].add(msg_data['from'])
-                if msg_data['id']:
-                    self.file_sources[filename]['message_ids'].add(msg_data['id'])
+                if period is not None:
+                    for section in ('user_messages', 'message_comments', 'thread_messages', 'keyword_matches'):
+                        if results[section]:
+                            results[section] = once(self._intersect, results[section], period)
+                    results['term_matches'] = {term: once(self._intersect, matches, period)
+                                               for term, matches in results['term_matches'].items()}
+                batch.append(results)
+            stage['messages'] = len(self.messages)
+        return batch
+    
+    @staticmethod
+    def _intersect(results, other):
+        return results & other
+    
+    def _scan_buckets(self, buckets):
+        """Один проход по сообщениям для корзин пакета запросов
+        
+        buckets - ключи (вид, термин, файл): вид 's' - подстрока в форме для
+        поиска, 'r' - регулярное выражение по исходному тексту без учета
+        регистра; файл None - все файлы. Корзины подстрок, которые триграммный
+        индекс сужает до немногих кандидатов, заполняются по индексу; для
+        остальных просматриваются только нужные им файлы. Возвращает выборки
+        в порядке ключей.
+        """
+        limit = len(self.messages) * BATCH_INDEX_SHARE
+        found = [self._index_matches(term, source_file, limit) if kind == 's' else None
+                 for kind, term, source_file in buckets]
+        scanned = [bucket for bucket, positions in enumerate(found) if positions is None]
+        
+        matchers = {'s': MultiPatternMatcher(buckets[bucket][1] for bucket in scanned if buckets[bucket][0] == 's'),
+                    'r': RegexPatternMatcher([buckets[bucket][1] for bucket in scanned if buckets[bucket][0] == 'r'])}
+        # Для каждого термина автомата - корзины, в которые попадают его совпадения
+        targets = {kind: [[] for _ in matcher.terms] for kind, matcher in matchers.items()}
+        term_indexes = {kind: {term: i for i, term in enumerate(matcher.terms)} for kind, matcher in matchers.items()}
+        for bucket in scanned:
+            kind, term, source_file = buckets[bucket]
+            targets[kind][term_indexes[kind][term]].append((bucket, source_file))
+            found[bucket] = array('I')
+        
+        if scanned:
+            source_files = {buckets[bucket][2] for bucket in scanned}
+            substrings, patterns = matchers['s'], matchers['r']
+            rows = self._batch_rows(None if None in source_files else source_files, bool(patterns.terms))
+            for p, search, text, source_file in rows:
+                matched = []
+                if substrings.terms:
+                    matched.append((targets['s'], substrings.find(search)))
+                if text is not None:
+                    matched.append((targets['r'], patterns.find(text)))
+                for kind_targets, term_indexes in matched:
+                    for i in term_indexes:
+                        for bucket, wanted in kind_targets[i]:
+                            if wanted is None or wanted == source_file:
+                                found[bucket].append(p)
+        return self._batch_results(found)
+    
+    def _batch_rows(self, source_files, with_text):
+        """Сообщения для прохода пакета по возрастанию позиций
+        
+        Выдает (позиция, форма для поиска, текст, файл); текст - только если
+        with_text и он строка, иначе None. source_files None - все файлы.
+        """
+        store = self.messages
+        if source_files is None:
+            positions = range(len(store))
+        else:
+            positions = heapq.merge(*(self.indexes['source_file'].get(source_file, ()) for source_file in source_files))
+        sources = store.sources.values
+        for p in positions:
+            text = store.value(p, 'text') if with_text else None
+            yield p, store.search_text(p), text if isinstance(text, str) else None, sources[store.source_codes[p]]
+    
+    def _batch_results(self, found):
+        """Выборки из массивов позиций, собранных проходом пакета"""
+        return [ResultSet(self.messages, positions) for positions in found]
+    
+    def available_users(self, source_file=None):
+        """Авторы сообщений (всех или одного файла) по алфавиту"""
+        if source_file is None:
+            users = self.indexes['from']
+        else:
+            users = self.file_sources.get(source_file, {}).get('users', ())
+        return sorted(user for user in users if user)
+    
+    def available_message_ids(self, source_file=None):
+        """ID сообщений по возрастанию, с повторами из разных файлов"""
+        if source_file is None:
+            index = self.indexes['id']
+            return [message_id for message_id in sorted(index) for _ in index[message_id]]
+        
+        message_ids = (self.messages.value(p, 'id') for p in self.indexes['source_file'].get(source_file, ()))
+        return sorted(message_id for message_id in message_ids if message_id is not None)
+    
+    def activity_counters(self, source_file=None):
+        """Счетчики активности для compute_analytics: (имена авторов, счетчики по кодам)"""
+        positions = None
+        if source_file:
+            positions = self.indexes['source_file'].get(source_file, array('I'))
+        counters = (_activity_python if np is None else _activity_numpy)(self.messages, positions)
+        return self.messages.authors.values, counters
+    
+    def _chat_of(self, source_file):
+        """Чат, к которому относится файл-источник"""
+        return self.file_chats.get(source_file, source_file)
+    
+    def _message_positions(self, chat, message_id):
+        """Позиции сообщения с данным id в данном чате"""
+        store = self.messages
+        return [p for p in self.indexes['id'].get(message_id, ())
+                if self._chat_of(store.value(p, 'source_file')) == chat]
+    
+    def _walk_replies(self, chat, message_id, max_depth=None):
+        """Обходит ответы на сообщение в ширину, выдавая (позиция, глубина)"""
+        store = self.messages
+        seen = set()
+        frontier, depth = [message_id], 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_frontier = []
+            for parent_id in frontier:
+                for p in self.reply_graph.get((chat, parent_id), ()):
+                    if p not in seen:
+                        seen.add(p)
+                        yield p, depth
+                        child_id = store.value(p, 'id')
+                        if child_id is not None:
+                            next_frontier.append(child_id)
+            frontier = next_frontier
+    
+    def get_thread(self, message_id, source_file=None, max_depth=None):
+        """Ветка обсуждения: сообщение и все ответы на него, включая ответы на ответы
+        
+        Обход идет по графу ответов в ширину, поэтому время пропорционально
+        размеру ветки. max_depth ограничивает глубину (1 - только прямые
+        ответы). Без source_file ищется во всех чатах, где есть такой id.
+        """
+        store = self.messages
+        if source_file:
+            chats = {self._chat_of(source_file)}
+        else:
+            chats = {self._chat_of(store.value(p, 'source_file'))
+                     for field in ('id', 'reply_to') for p in self.indexes[field].get(message_id, ())}
+        
+        found = set()
+        for chat in chats:
+            found.update(self._message_positions(chat, message_id))
+            found.update(p for p, depth in self._walk_replies(chat, message_id, max_depth))
+        
+        if source_file:
+            source_code = store.source_code(source_file)
+            found = (p for p in found if store.source_codes[p] == source_code)
+        return ResultSet(store, sorted(found))
+    
+    def get_thread_root(self, message_id, source_file=None):
+        """Корень ветки, в которой находится сообщение: запись или None, если сообщения нет"""
+        store = self.messages
+        positions = self.indexes['id'].get(message_id, ())
+        if source_file:
+            source_code = store.source_code(source_file)
+            positions = [p for p in positions if store.source_codes[p] == source_code]
+        if not positions:
+            return None
+        
+        position = positions[0]
+        chat = self._chat_of(store.value(position, 'source_file'))
+        seen = {position}
+        while True:
+            parent_id = store.value(position, 'reply_to')
+            parents = self._message_positions(chat, parent_id) if parent_id is not None else ()
+            # Родитель не загружен или ссылки зациклены - корнем считается текущее сообщение
+            if not parents or parents[0] in seen:
+                return store[position]
+            position = parents[0]
+            seen.add(position)
+    
+    def thread_stats(self):
+        """Размер и глубина каждой ветки с ответами
+        
+        Список словарей {'chat', 'message_id', 'size', 'depth'}; size - число
+        ответов в ветке. Считается одним обходом графа и запоминается до
+        следующего изменения данных.
+        """
+        if self._thread_stats is not None:
+            return self._thread_stats
+        
+        store = self.messages
+        stats = []
+        for chat, message_id in self.reply_graph:
+            # Корень - сообщение, которое само не является ответом (или не загружено)
+            parents = self._message_positions(chat, message_id)
+            if parents and store.value(parents[0], 'reply_to') is not None:
+                continue
+            size = depth = 0
+            for p, depth in self._walk_replies(chat, message_id):
+                size += 1
+            stats.append({'chat': chat, 'message_id': message_id, 'size': size, 'depth': depth})
+        
+        self._thread_stats = stats
+        return stats
+    
+    def largest_threads(self, count=ANALYTICS_TOP):
+        """Ветки с наибольшим числом ответов"""
+        return sorted(self.thread_stats(), key=lambda thread: -thread['size'])[:count]
+    
+    def deepest_threads(self, count=ANALYTICS_TOP):
+        """Ветки с наибольшей глубиной вложенности ответов"""
+        return sorted(self.thread_stats(), key=lambda thread: (-thread['depth'], -thread['size']))[:count]
+    
+    def search_period(self, start=None, end=None, source_file=None):
+        """Сообщения с датой в [start, end] (секунды UTC) по индексу времени"""
+        store = self.messages
+        positions = self.time_index.between(start, end)
+        if source_file:
+            source_code = store.source_code(source_file)
+            positions = array('I', (p for p in positions if store.source_codes[p] == source_code))
+        return ResultSet(store, positions)
+    
+    def _search_substring(self, keyword, source_file=None):
+        """Сообщения, содержащие keyword без учета регистра, по триграммному индексу"""
+        keyword = _search_form(keyword)
+        candidates = self.text_index.substring_candidates(keyword)
+        return ResultSet(self.messages, self._substring_matches(keyword, candidates, source_file))
+    
+    def _substring_matches(self, keyword, candidates, source_file=None):
+        """Позиции кандидатов, в тексте которых действительно есть keyword (в форме для поиска)"""
+        store = self.messages
+        source_code = store.source_code(source_file) if source_file else None
+        matches = array('I')
+        if source_file and source_code is None:
+            return matches
+        for p in candidates:
+            if source_code is not None and store.source_codes[p] != source_code:
+                continue
+            if keyword in store.search_text(p):
+                matches.append(p)
+        return matches
+    
+    def _index_matches(self, keyword, source_file, limit):
+        """Совпадения подстроки keyword по триграммному индексу - для пакета запросов
+        
+        None, если индекс не сужает поиск: запрос короче трех символов или
+        кандидатов больше limit.
+        """
+        keyword = _search_form(keyword)
+        if len(keyword) < 3:
+            return None
+        candidates = self.text_index.substring_candidates(keyword, limit)
+        if candidates is None:
+            return None
+        return self._substring_matches(keyword, candidates, source_file)
+    
+    def search_terms(self, terms, source_file=None, regex=False, within=None):
+        """Ищет все термины за один проход по сообщениям
+        
+        Возвращает словарь термин -> выборка сообщений в том же виде, что и
+        keyword_matches. В режиме regex термины - регулярные выражения,
+        они проверяются по исходному тексту без учета регистра. within -
+        выборка, которой ограничивается поиск.
+        """
+        matcher = (RegexPatternMatcher if regex else MultiPatternMatcher)(terms)
+        grouped = [array('I') for _ in matcher.terms]
+        store = self.messages
+        if within is not None:
+            positions = within.positions
+        elif source_file:
+            positions = self.indexes['source_file'].get(source_file, ())
+        else:
+            positions = range(len(store))
+        
+        for p in positions:
+            if regex:
+                text = store.value(p, 'text')
+                if not isinstance(text, str):
+                    continue
+            else:
+                text = store.search_text(p)
+            for term_index in matcher.find(text):
+                grouped[term_index].append(p)
+        return {term: ResultSet(store, found) for term, found in zip(matcher.terms, grouped)}
+    
+    def search_words(self, words, source_file=None):
+        """Сообщения, содержащие все слова из words целиком, по индексу слов"""
+        store = self.messages
+        source_code = store.source_code(source_file) if source_file else None
+        if source_file and source_code is None:
+            return ResultSet(store)
+        return ResultSet(store, [p for p in self.text_index.word_positions(words)
+                                 if source_code is None or store.source_codes[p] == source_code])
+    
+    def _lookup(self, field, value, source_file=None):
+        """Сообщения с заданным значением поля по индексу, в порядке загрузки"""
+        store = self.messages
+        positions = self.indexes[field].get(value, array('I'))
+        if source_file:
+            # Проверяем тот из двух списков позиций, что короче
+            file_positions = self.indexes['source_file'].get(source_file, ())
+            if len(file_positions) < len(positions):
+                return ResultSet(store, [p for p in file_positions if store.value(p, field) == value])
+            source_code = store.source_code(source_file)
+            return ResultSet(store, [p for p in positions if store.source_codes[p] == source_code])
+        # Копия массива, чтобы выборка не менялась при загрузке новых файлов
+        return ResultSet(store, positions[:])
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    version INTEGER,
+    chat,
+    message_count INTEGER,
+    frequencies TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    pos INTEGER PRIMARY KEY,
+    id,
+    author TEXT,
+    text TEXT,
+    date TEXT,
+    reply_to,
+    source_file TEXT,
+    chat,
+    ts INTEGER,
+    overflow TEXT,
+    search TEXT,
+    entities TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_author ON messages(author, source_file);
+CREATE INDEX IF NOT EXISTS messages_reply_to ON messages(reply_to, chat);
+CREATE INDEX IF NOT EXISTS messages_id ON messages(id, chat);
+CREATE INDEX IF NOT EXISTS messages_source ON messages(source_file);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages(ts);
+"""
+_SQLITE_FTS = ("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+               "text, content='messages', content_rowid='pos', tokenize='trigram')")
+_SQLITE_COLUMNS = 'id, author, text, date, reply_to, source_file, overflow'
+# Колонки записи сообщения в таблице messages
+_SQLITE_FIELDS = {'from': 'author', 'reply_to': 'reply_to', 'id': 'id', 'source_file': 'source_file'}
+# Предел глубины обхода веток в SQL на случай зацикленных ссылок
+SQLITE_THREAD_DEPTH_LIMIT = 1000
+# SQL-выражение floor(x / n) для целых: деление в SQLite округляет к нулю
+_SQL_FLOOR_DIV = '(({x}) - ((({x}) % {n}) + {n}) % {n}) / {n}'
+
+
+def _sqlite_record(row):
+    """Запись сообщения из строки таблицы messages"""
+    message_id, author, text, date, reply_to, source_file, overflow = row
+    record = {'id': message_id, 'from': author, 'text': text, 'date': date,
+              'reply_to': reply_to, 'source_file': source_file}
+    if overflow:
+        record.update(json.loads(overflow))
+    return record
+
+
+@lru_cache(maxsize=256)
+def _sqlite_pattern(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _sqlite_regexp(pattern, text):
+    return isinstance(text, str) and _sqlite_pattern(pattern).search(text) is not None
+
+
+def _sqlite_words(text, words):
+    return isinstance(text, str) and set(_TOKEN_RE.findall(words)) <= set(_TOKEN_RE.findall(text))
+
+
+class SQLiteResultSet(Sequence):
+    """Выборка сообщений из базы SQLite, заданная запросом позиций
+
+    Как и ResultSet, ничего не читает заранее: длина считается одним
+    COUNT и запоминается, записи читаются курсором при обходе, а
+    объединение, пересечение и разность строятся как составной SQL.
+    """
+
+    def __init__(self, db, sql='SELECT pos FROM messages WHERE 0', params=()):
+        self.db = db
+        self.sql = sql
+        self.params = tuple(params)
+        self._length = None
+
+    # В памяти выборка занимает только текст запроса
+    nbytes = 0
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self.db.execute(f'SELECT COUNT(*) FROM ({self.sql})', self.params).fetchone()[0]
+        return self._length
+
+    def __iter__(self):
+        cursor = self.db.execute(
+            f'SELECT {_SQLITE_COLUMNS} FROM messages WHERE pos IN ({self.sql}) ORDER BY pos', self.params)
+        return map(_sqlite_record, cursor)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return SQLiteResultSet(self.db, f'SELECT pos FROM ({self.sql}) ORDER BY pos LIMIT ? OFFSET ?',
+                                   self.params + (max(stop - start, 0), start))
+        if index < 0:
+            index += len(self)
+        row = None
+        if index >= 0:
+            row = self.db.execute(
+                f'SELECT {_SQLITE_COLUMNS} FROM messages WHERE pos IN ({self.sql}) ORDER BY pos LIMIT 1 OFFSET ?',
+                self.params + (index,)).fetchone()
+        if row is None:
+            raise IndexError("индекс сообщения вне диапазона")
+        return _sqlite_record(row)
+
+    def _combine(self, other, operator):
+        if not isinstance(other, SQLiteResultSet):
+            return NotImplemented
+        return SQLiteResultSet(self.db, f'SELECT pos FROM ({self.sql}) {operator} SELECT pos FROM ({other.sql})',
+                               self.params + other.params)
+
+    def __and__(self, other):
+        return self._combine(other, 'INTERSECT')
+
+    def __or__(self, other):
+        return self._combine(other, 'UNION')
+
+    def __sub__(self, other):
+        return self._combine(other, 'EXCEPT')
+
+    def __repr__(self):
+        return f"<SQLiteResultSet: {len(self)} сообщений>"
+
+
+class SQLiteMessages(SQLiteResultSet):
+    """Все сообщения базы; длина не запоминается, так как база пополняется"""
+
+    def __init__(self, db):
+        super().__init__(db, 'SELECT pos FROM messages')
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+
+class SQLiteChatParser(TelegramChatParser):
+    """Парсер, хранящий сообщения в базе SQLite вместо памяти
+
+    Записи вставляются пакетами, каждый файл - одной транзакцией; поиск
+    по ключевому слову идет через FTS5 с триграммами, остальные фильтры -
+    через индексы таблицы. Фильтры, списки пользователей и ID, экспорт и
+    статистика работают так же, как с обычным парсером. Уже загруженные и
+    не изменившиеся файлы при повторной загрузке не разбираются, поэтому
+    открытая заново база сразу готова к запросам.
+    """
+
+    def __init__(self, db_path, stream_json=None, workers=1, batch_size=SQLITE_BATCH_SIZE,
+                 query_cache_entries=QUERY_CACHE_ENTRIES, query_cache_bytes=QUERY_CACHE_BYTES,
+                 frequency_error=FREQUENCY_ERROR):
+        super().__init__(stream_json=stream_json, workers=workers, query_cache_entries=query_cache_entries,
+                         query_cache_bytes=query_cache_bytes, frequency_error=frequency_error)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        # Фоновая загрузка работает с базой из своего потока под self.lock
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(_SQLITE_SCHEMA)
+        try:
+            self.db.execute(_SQLITE_FTS)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite без FTS5 или без токенизатора trigram: поиск перебором
+            self.fts = False
+        self.db.create_function('tg_regexp', 2, _sqlite_regexp, deterministic=True)
+        self.db.create_function('tg_words', 2, _sqlite_words, deterministic=True)
+        self.db.commit()
+        
+        self.messages = SQLiteMessages(self.db)
+        self._rows = []
+        self._pending_keys = set()
+        self._batch_buckets = 0
+        self._read_files()
+    
+    def _read_files(self):
+        """Восстанавливает сведения о загруженных файлах из базы"""
+        self.file_sources = {}
+        self.file_chats = {}
+        self.frequencies = {}
+        for name, chat, message_count, frequencies in self.db.execute(
+                'SELECT name, chat, message_count, frequencies FROM files'):
+            self.file_chats[name] = chat
+            self._source_stats(name)['message_count'] = message_count
+            if frequencies:
+                self.frequencies[name] = TokenFrequencies.from_json(json.loads(frequencies))
+        for source_file, author in self.db.execute('SELECT DISTINCT source_file, author FROM messages'):
+            self._source_stats(source_file)['users'].add(author)
+        self.file_last_ids = dict(self.db.execute(
+            "SELECT source_file, MAX(id) FROM messages WHERE typeof(id) = 'integer' AND id > 0 GROUP BY source_file"))
+    
+    def close(self):
+        """Закрывает базу"""
+        self.db.close()
+    
+    def clear_data(self, confirm=False):
+        """Удаляет все сообщения и файлы из базы на диске
+        
+        В отличие от парсера в памяти, очищается не сессия, а сама база:
+        загруженное в прошлых запусках пропадет и при следующем открытии.
+        Поэтому без confirm=True база не трогается.
+        """
+        if not confirm:
+            raise ValueError(f"Очистка удалит все сообщения из базы {self.db_path}, нужно подтверждение")
+        self._rows, self._pending_keys = [], set()
+        self.db.rollback()
+        if self.fts:
+            self.db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('delete-all')")
+        self.db.execute('DELETE FROM messages')
+        self.db.execute('DELETE FROM files')
+        self.db.execute('DROP TABLE IF EXISTS temp.batch_matches')
+        self.db.commit()
+        self.file_sources = {}
+        self.frequencies = {}
+        self.file_chats = {}
+        self.file_last_ids = {}
+        self.ingest_report = {}
+        self._bump_generation()
+        self.current_filters = dict(DEFAULT_FILTERS)
+        self.current_results = None
+    
+    @staticmethod
+    def _file_key(filename):
+        stat = os.stat(filename)
+        return stat.st_size, stat.st_mtime_ns, PARSER_VERSION
+    
+    def _load_files(self, filenames, workers, incremental):
+        """Загружает файлы в базу; не изменившиеся с прошлой загрузки пропускаются"""
+        self._bump_generation()
+        if incremental:
+            super()._load_files(filenames, workers, incremental=True)
+            return
+        
+        changed = []
+        for filename in filenames:
+            if self._prepare_file(filename):
+                changed.append(filename)
+            else:
+                print(f"✓ Файл {filename} уже в базе ({self.file_sources[filename]['message_count']} сообщений)")
+        
+        super()._load_files(changed, workers, False)
+        self._discard_failed(changed)
+    
+    def _prepare_file(self, filename):
+        """Проверяет файл перед загрузкой: False - он уже в базе и не менялся
+        
+        Сообщения изменившегося файла удаляются, чтобы загрузить его заново.
+        """
+        stored = self.db.execute('SELECT size, mtime_ns, version FROM files WHERE name = ?', (filename,)).fetchone()
+        try:
+            key = self._file_key(filename)
+        except OSError:
+            # Ошибку отсутствующего файла покажет сама загрузка
+            return True
+        if stored == key:
+            return False
+        if stored:
+            self._remove_file(filename)
+        return True
+    
+    def _discard_failed(self, filenames):
+        """Файл, разбор которого прервался, не оставляет ни строк в базе, ни сведений о себе"""
+        self._rows, self._pending_keys = [], set()
+        self.db.rollback()
+        stored = {name for name, in self.db.execute('SELECT name FROM files')}
+        for filename in filenames:
+            if filename not in stored:
+                self.file_sources.pop(filename, None)
+                self.frequencies.pop(filename, None)
+    
+    def _mark_position(self):
+        # Откат идет через транзакцию, позиция не нужна
+        return None
+    
+    def _rollback_file(self, filename, mark):
+        """Отменяет транзакцию файла и возвращает сведения о нем"""
+        self._rows, self._pending_keys = [], set()
+        self.db.rollback()
+        self._restore_file_state(filename, mark)
+    
+    def _remove_file(self, filename):
+        """Удаляет из базы сообщения файла, который изменился"""
+        if self.fts:
+            self.db.execute("INSERT INTO messages_fts(messages_fts, rowid, text) "
+                            "SELECT 'delete', pos, COALESCE(search, text) FROM messages "
+                            "WHERE source_file = ? AND text IS NOT NULL",
+                            (filename,))
+        self.db.execute('DELETE FROM messages WHERE source_file = ?', (filename,))
+        self.db.execute('DELETE FROM files WHERE name = ?', (filename,))
+        self.db.commit()
+        self.file_sources.pop(filename, None)
+        self.frequencies.pop(filename, None)
+        self.file_last_ids.pop(filename, None)
+    
+    def _store_message(self, msg_data):
+        """Добавляет запись в пакет строк для вставки"""
+        overflow = {}
+        row = []
+        for field in ('id', 'from', 'text', 'date', 'reply_to', 'source_file'):
+            value = msg_data[field]
+            if isinstance(value, (list, dict)) or (type(value) is int and not _NO_VALUE < value < 2 ** 63):
+                overflow[field] = value
+                value = None
+            row.append(value)
+        source_file = msg_data['source_file']
+        chat = self._chat_of(source_file)
+        text = row[2]
+        search = _search_form(text) if text is not None else None
+        self._count_tokens(msg_data, search or '')
+        entities = msg_data.get('entities')
+        row += [chat, parse_date(msg_data['date']), json.dumps(overflow, ensure_ascii=False) if overflow else None,
+                search if search != text else None, json.dumps(entities, ensure_ascii=False) if entities else None]
+        self._rows.append(row)
+        
+        message_id = msg_data['id']
+        if type(message_id) is int and message_id > 0:
+            self._pending_keys.add((chat, message_id))
+            if message_id > self.file_last_ids.get(source_file, 0):
+                self.file_last_ids[source_file] = message_id
+        if len(self._rows) >= self.batch_size:
+            self._flush()
+    
+    def _flush(self):
+        """Вставляет накопленный пакет строк в текущую транзакцию"""
+        if self._rows:
+            self.db.executemany('INSERT INTO messages (id, author, text, date, reply_to, source_file, chat, ts, overflow, '
+                                'search, entities) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self._rows)
+            self._rows = []
+        self._pending_keys = set()
+    
+    def _add_message(self, msg_data):
+        """Добавляет сообщение и обновляет информацию о файле"""
+        self._store_message(msg_data)
+        # Множество ID в памяти не хранится: ID берутся из базы
+        stats = self._source_stats(msg_data['source_file'])
+        stats['message_count'] += 1
+        stats['users'].add(msg_data['from'])
+    
+    def _merge_batch(self, filename, store, stats):
+        """Добавляет пакет, разобранный в другом процессе"""
+        for position in range(len(store)):
+            self._store_message(store.record_data(position))
+        if stats is not None:
+            merged = self._source_stats(filename)
+            merged['message_count'] += stats['message_count']
+            merged['users'].update(stats['users'])
+    
+    def _begin_file(self):
+        """Начинает файл: отбрасывает незавершенную транзакцию и запоминает последнюю позицию"""
+        self._rows, self._pending_keys = [], set()
+        self.db.rollback()
+        return self.db.execute('SELECT COALESCE(MAX(pos), 0) FROM messages').fetchone()[0]
+    
+    def _finish_file(self, filename, start, cache_key=None):
+        """Завершает файл: дописывает строки, индекс FTS и сведения о файле одной транзакцией"""
+        with self.perf.stage('write', filename):
+            self._flush()
+        if self.fts:
+            with self.perf.stage('index', filename):
+                self.db.execute('INSERT INTO messages_fts(rowid, text) '
+                                'SELECT pos, COALESCE(search, text) FROM messages WHERE pos > ? AND text IS NOT NULL',
+                                (start,))
+        stats = self.file_sources.get(filename, {'message_count': 0})
+        with self.perf.stage('write', filename):
+            frequencies = self.frequencies.get(filename)
+            self.db.execute('INSERT OR REPLACE INTO files (name, size, mtime_ns, version, chat, message_count, '
+                            'frequencies) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (filename, *self._file_key(filename), self._chat_of(filename), stats['message_count'],
+                             json.dumps(frequencies.to_json(), ensure_ascii=False) if frequencies else None))
+            self.db.commit()
+    
+    def _merge_new(self, filename, chat, records, duplicates):
+        """Добавляет только новые сообщения и фиксирует их в базе"""
+        start = self._begin_file()
+        new, duplicates = super()._merge_new(filename, chat, records, duplicates)
+        self._finish_file(filename, start)
+        return new, duplicates
+    
+    def _is_duplicate(self, chat, message_id):
+        """Есть ли уже сообщение с таким id из того же чата"""
+        if type(message_id) is not int or message_id <= 0:
+            return False
+        if (chat, message_id) in self._pending_keys:
+            return True
+        return self.db.execute('SELECT 1 FROM messages WHERE id = ? AND chat IS ? LIMIT 1',
+                               (message_id, chat)).fetchone() is not None
+    
+    def _loaded_prefix(self, chat, ids):
+        """Сколько первых id из списка уже загружено из того же чата - одним запросом"""
+        if not ids:
+            return 0
+        loaded = {row[0] for row in self.db.execute('SELECT id FROM messages WHERE chat IS ? AND id BETWEEN ? AND ?',
+                                                    (chat, min(ids), max(ids)))}
+        for count, message_id in enumerate(ids):
+            if message_id not in loaded and (chat, message_id) not in self._pending_keys:
+                return count
+        return len(ids)
+    
+    def _select(self, where, params=(), source_file=None):
+        """Выборка позиций сообщений по условию"""
+        if source_file:
+            where += ' AND source_file = ?'
+            params = tuple(params) + (source_file,)
+        return SQLiteResultSet(self.db, f'SELECT pos FROM messages WHERE {where}', params)
+    
+    def _lookup(self, field, value, source_file=None):
+        """Сообщения с заданным значением поля по индексу таблицы"""
+        return self._select(f'{_SQLITE_FIELDS[field]} = ?', (value,), source_file)
+    
+    def _search_substring(self, keyword, source_file=None):
+        """Сообщения, содержащие keyword без учета регистра; кандидаты - из FTS5
+        
+        FTS5 и проверка совпадения работают с формой текста для поиска,
+        сохраненной при загрузке, поэтому текст при запросе не преобразуется.
+        """
+        keyword = _search_form(keyword)
+        where, params = 'instr(COALESCE(search, text), ?) > 0', (keyword,)
+        # Триграммам нужно не меньше трех символов
+        if self.fts and len(keyword) >= 3:
+            where = 'pos IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) AND ' + where
+            params = ('"' + keyword.replace('"', '""') + '"',) + params
+        return self._select(where, params, source_file)
+    
+    def _index_matches(self, keyword, source_file, limit):
+        """Совпадения подстроки keyword по FTS5 - для пакета запросов
+        
+        None, если FTS5 нет, запрос короче трех символов или кандидатов
+        больше limit.
+        """
+        keyword = _search_form(keyword)
+        if not self.fts or len(keyword) < 3:
+            return None
+        phrase = '"' + keyword.replace('"', '""') + '"'
+        count, = self.db.execute('SELECT count(*) FROM messages_fts WHERE messages_fts MATCH ?', (phrase,)).fetchone()
+        if count > limit:
+            return None
+        sql = ('SELECT pos FROM messages WHERE pos IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) '
+               'AND instr(COALESCE(search, text), ?) > 0')
+        params = (phrase, keyword)
+        if source_file:
+            sql, params = sql + ' AND source_file = ?', params + (source_file,)
+        return array('I', (pos for pos, in self.db.execute(sql + ' ORDER BY pos', params)))
+    
+    def search_terms(self, terms, source_file=None, regex=False, within=None):
+        """Ищет термины: каждый - запросом к FTS5 (или регулярным выражением)"""
+        matcher_terms = [term for term in dict.fromkeys(terms) if term]
+        if regex:
+            for term in matcher_terms:
+                re.compile(term)
+        results = {}
+        for term in matcher_terms:
+            if regex:
+                found = self._select('tg_regexp(?, text)', (term,), source_file)
+            else:
+                found = self._search_substring(term, source_file)
+            results[term] = found & within if within is not None else found
+        return results
+    
+    def search_words(self, words, source_file=None):
+        """Сообщения, содержащие все слова из words целиком"""
+        tokens = set(_TOKEN_RE.findall(_search_form(words)))
+        if not tokens:
+            return SQLiteResultSet(self.db)
+        where, params = 'tg_words(COALESCE(search, text), ?)', (' '.join(tokens),)
+        long_tokens = [token for token in tokens if len(token) >= 3]
+        if self.fts and long_tokens:
+            where = 'pos IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) AND ' + where
+            params = (' AND '.join('"' + token + '"' for token in long_tokens),) + params
+        return self._select(where, params, source_file)
+    
+    def search_period(self, start=None, end=None, source_file=None):
+        """Сообщения с датой в [start, end] (секунды UTC) по индексу времени"""
+        return self._select('ts BETWEEN ? AND ?', (-2 ** 63 if start is None else start,
+                                                   2 ** 63 - 1 if end is None else end), source_file)
+    
+    def _snapshot_range(self, filename):
+        """Сообщения файла из базы, собранные для снимка во временное хранилище"""
+        store = MessageStore()
+        for row in self.db.execute(f'SELECT {_SQLITE_COLUMNS}, entities FROM messages WHERE source_file = ? ORDER BY pos',
+                                   (filename,)):
+            msg_data = _sqlite_record(row[:-1])
+            if row[-1]:
+                msg_data['entities'] = json.loads(row[-1])
+            store.append(msg_data)
+        return store, 0, len(store)
+    
+    def load_snapshot(self, path):
+        """Снимки открываются парсером в памяти: в базу они не переносятся"""
+        raise ValueError("снимки открываются без базы SQLite (без --db)")
+    
+    def _batch_rows(self, source_files, with_text):
+        """Строки сообщений для прохода пакета - одним запросом по возрастанию pos"""
+        sql, params = 'SELECT pos, COALESCE(search, text), text, source_file FROM messages', ()
+        if source_files is not None:
+            params = tuple(source_files)
+            sql += f' WHERE source_file IN ({", ".join("?" * len(params))})'
+        for pos, search, text, source_file in self.db.execute(sql + ' ORDER BY pos', params):
+            yield pos, search or '', text if with_text and isinstance(text, str) else None, source_file
+    
+    def _batch_results(self, found):
+        """Совпадения пакета записываются во временную таблицу: выборки - запросы к ней
+        
+        Номера корзин сквозные, поэтому выборки прошлых пакетов остаются верными.
+        """
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS batch_matches '
+                        '(bucket INTEGER, pos INTEGER, PRIMARY KEY (bucket, pos)) WITHOUT ROWID')
+        first = self._batch_buckets
+        self._batch_buckets += len(found)
+        self.db.executemany('INSERT INTO batch_matches VALUES (?, ?)',
+                            ((first + i, p) for i, positions in enumerate(found) for p in positions))
+        self.db.commit()
+        return [SQLiteResultSet(self.db, 'SELECT pos FROM batch_matches WHERE bucket = ?', (first + i,))
+                for i in range(len(found))]
+    
+    def _thread_sql(self, chat, message_id, max_depth=None):
+        """Запрос позиций ветки одного чата через рекурсивный CTE по (reply_to, chat)"""
+        if max_depth is None:
+            # UNION по одному id сам останавливает обход на циклах
+            walk = ('WITH RECURSIVE walk(id) AS (SELECT ? UNION '
+                    'SELECT m.id FROM walk w JOIN messages m ON m.reply_to = w.id AND m.chat IS ? '
+                    'WHERE m.id IS NOT NULL) ')
+            params = (message_id, chat)
+        else:
+            walk = ('WITH RECURSIVE walk(id, depth) AS (SELECT ?, 0 UNION '
+                    'SELECT m.id, w.depth + 1 FROM walk w JOIN messages m ON m.reply_to = w.id AND m.chat IS ? '
+                    'WHERE m.id IS NOT NULL AND w.depth + 1 < ?) ')
+            params = (message_id, chat, min(max_depth, SQLITE_THREAD_DEPTH_LIMIT))
+        sql = (f'SELECT pos FROM ({walk}SELECT pos FROM messages '
+               f'WHERE chat IS ? AND (id = ? OR reply_to IN (SELECT id FROM walk)))')
+        return sql, params + (chat, message_id)
+    
+    def get_thread(self, message_id, source_file=None, max_depth=None):
+        """Ветка обсуждения: сообщение и все ответы на него, включая ответы на ответы"""
+        if source_file:
+            chats = [self._chat_of(source_file)]
+        else:
+            chats = [chat for chat, in self.db.execute(
+                'SELECT chat FROM messages WHERE id = ? UNION SELECT chat FROM messages WHERE reply_to = ?',
+                (message_id, message_id))]
+        if max_depth is not None and max_depth < 1:
+            parts = [('SELECT pos FROM messages WHERE chat IS ? AND id = ?', (chat, message_id)) for chat in chats]
+        else:
+            parts = [self._thread_sql(chat, message_id, max_depth) for chat in chats]
+        if not parts:
+            return SQLiteResultSet(self.db)
+        
+        sql = ' UNION '.join(part for part, _ in parts)
+        params = tuple(param for _, part_params in parts for param in part_params)
+        thread = SQLiteResultSet(self.db, sql, params)
+        return thread & self._select('1', (), source_file) if source_file else thread
+    
+    def get_thread_root(self, message_id, source_file=None):
+        """Корень ветки, в которой находится сообщение: запись или None, если сообщения нет"""
+        where, params = 'id = ?', (message_id,)
+        if source_file:
+            where, params = where + ' AND source_file = ?', params + (source_file,)
+        row = self.db.execute(f'SELECT pos, reply_to, chat FROM messages WHERE {where} ORDER BY pos LIMIT 1',
+                              params).fetchone()
+        if row is None:
+            return None
+        
+        position, parent_id, chat = row
+        seen = {position}
+        while parent_id is not None:
+            parent = self.db.execute('SELECT pos, reply_to FROM messages WHERE id = ? AND chat IS ? '
+                                     'ORDER BY pos LIMIT 1', (parent_id, chat)).fetchone()
+            # Родитель не загружен или ссылки зациклены - корнем считается текущее сообщение
+            if parent is None or parent[0] in seen:
+                break
+            position, parent_id = parent
+            seen.add(position)
+        return _sqlite_record(self.db.execute(f'SELECT {_SQLITE_COLUMNS} FROM messages WHERE pos = ?',
+                                              (position,)).fetchone())
+    
+    def thread_stats(self):
+        """Размер и глубина каждой ветки с ответами одним рекурсивным запросом"""
+        if self._thread_stats is not None:
+            return self._thread_stats
+        
+        rows = self.db.execute(
+            'WITH RECURSIVE walk(chat, root, id, depth) AS ('
+            ' SELECT DISTINCT m.chat, m.reply_to, m.reply_to, 0 FROM messages m'
+            ' WHERE m.reply_to IS NOT NULL AND NOT EXISTS (SELECT 1 FROM messages p'
+            '  WHERE p.id = m.reply_to AND p.chat IS m.chat AND p.reply_to IS NOT NULL)'
+            ' UNION'
+            ' SELECT w.chat, w.root, m.id, w.depth + 1 FROM walk w'
+            ' JOIN messages m ON m.reply_to = w.id AND m.chat IS w.chat'
+            ' WHERE m.id IS NOT NULL AND w.depth < ?)'
+            'SELECT w.chat, w.root, COUNT(DISTINCT m.pos), MAX(w.depth) + 1 FROM walk w'
+            ' JOIN messages m ON m.reply_to = w.id AND m.chat IS w.chat'
+            ' GROUP BY w.chat, w.root ORDER BY MIN(m.pos)', (SQLITE_THREAD_DEPTH_LIMIT,))
+        self._thread_stats = [{'chat': chat, 'message_id': message_id, 'size': size, 'depth': depth}
+                              for chat, message_id, size, depth in rows]
+        return self._thread_stats
     
-    def load_files(self, filenames):
-        """Загружает несколько файлов"""
-        for filename in filenames:
-            try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                if filename.endswith('.html'):
-                    self.parse_html(content, filename)
-                else:
-                    self.parse_json(content, filename)
-                
-                print(f"✓ Файл {filename} загружен ({self.file_sources[filename]['message_count']} сообщений)")
-                
-            except Exception as e:
-                print(f"✗ Ошибка при чтении файла {filename}: {e}")
+    def available_users(self, source_file=None):
+        """Авторы сообщений (всех или одного файла) по алфавиту"""
+        where, params = ('WHERE source_file = ?', (source_file,)) if source_file is not None else ('', ())
+        users = (user for user, in self.db.execute(f'SELECT DISTINCT author FROM messages {where}', params))
+        return sorted(user for user in users if user)
     
-    def clear_data(self):
-        """Очищает все данные"""
-        self.messages = []
-        self.file_sources = {}
-        self.current_file = None
+    def available_message_ids(self, source_file=None):
+        """ID сообщений по возрастанию, с повторами из разных файлов"""
+        where, params = 'WHERE id IS NOT NULL', ()
+        if source_file is not None:
+            where, params = where + ' AND source_file = ?', (source_file,)
+        return sorted(message_id for message_id, in self.db.execute(f'SELECT id FROM messages {where}', params))
     
-    def filter_messages(self, target_user=None, target_message_id=None, keyword=None, source_file=None):
-        """Фильтрует сообщения и сохраняет параметры"""
-        # Сохраняем текущие фильтры
-        self.current_filters = {
-            'target_user': target_user,
-            'target_message_id': target_message_id,
-            'keyword': keyword,
-            'source_file': source_file
-        }
+    def activity_counters(self, source_file=None):
+        """Счетчики активности для compute_analytics группировками в SQL"""
+        where, params = ('WHERE source_file = ?', (source_file,)) if source_file else ('', ())
+        dated = (where + ' AND' if where else 'WHERE') + ' ts IS NOT NULL'
+        names, counters = [], {'messages': [], 'replies': [], 'first': [], 'last': [],
+                               'days': {}, 'hour_of_week': [0] * (7 * 24), 'replied': {}}
+        for author, messages, replies, first, last in self.db.execute(
+                f'SELECT author, COUNT(*), COUNT(reply_to), MIN(ts), MAX(ts) FROM messages {where} '
+                f'GROUP BY author ORDER BY MIN(pos)', params):
+            names.append(author)
+            counters['messages'].append(messages)
+            counters['replies'].append(replies)
+            counters['first'].append(2 ** 63 - 1 if first is None else first)
+            counters['last'].append(-2 ** 63 if last is None else last)
         
-        results = {
-            'user_messages': [],
-            'message_comments': [],
-            'keyword_matches': []
+        day = _SQL_FLOOR_DIV.format(x='ts', n=86400)
+        counters['days'] = dict(self.db.execute(
+            f'SELECT {day} AS day, COUNT(*) FROM messages {dated} GROUP BY day ORDER BY day', params))
+        hour = _SQL_FLOOR_DIV.format(x='ts', n=3600)
+        for hours, count in self.db.execute(f'SELECT {hour} AS hour, COUNT(*) FROM messages {dated} GROUP BY hour',
+                                            params):
+            counters['hour_of_week'][(hours // 24 + 3) % 7 * 24 + hours % 24] += count
+        replied = (where + ' AND' if where else 'WHERE') + ' reply_to IS NOT NULL'
+        counters['replied'] = dict(self.db.execute(
+            f'SELECT reply_to, COUNT(*) FROM messages {replied} GROUP BY reply_to ORDER BY reply_to', params))
+        return names, counters
+
+
+class LoadCancelled(Exception):
+    """Фоновая загрузка отменена"""
+
+
+class _StagingParser(TelegramChatParser):
+    """Промежуточный парсер одного файла фоновой загрузки
+
+    Ведет счетчики прогресса файла и прерывает разбор, если загрузку отменили.
+    """
+
+    def __init__(self, stream_json, progress, cancelled, perf):
+        super().__init__(stream_json=stream_json, indexed=False)
+        # Замеры чтения и разбора попадают в журнал основного парсера
+        self.perf = perf
+        self.progress = progress
+        self.cancelled = cancelled
+        self.source = None
+
+    def _open_source(self, filename):
+        self.source = super()._open_source(filename)
+        return self.source
+
+    def _add_message(self, msg_data):
+        super()._add_message(msg_data)
+        progress = self.progress
+        progress['messages'] += 1
+        if progress['messages'] % PROGRESS_INTERVAL == 0:
+            if self.source is not None and not self.source.closed:
+                progress['bytes'] = self.source.buffer.tell()
+            if self.cancelled.is_set():
+                raise LoadCancelled()
+
+
+class BackgroundLoader:
+    """Загрузка файлов в фоновом потоке с прогрессом и отменой
+
+    Каждый файл разбирается вне parser.lock - в промежуточный парсер или,
+    если у парсера больше одного процесса (parser.workers), в пуле
+    процессов по кускам split_export, как в load_files, - и вливается в
+    основной под parser.lock только целиком, с откатом при ошибке.
+    Поэтому при отмене или ошибке file_sources и индексы не бывают
+    обновлены наполовину, а сведения об уже загруженных файлах можно
+    смотреть во время загрузки. Прогресс обновляется и отмена
+    проверяется по ходу разбора и после каждого куска.
+    """
+
+    def __init__(self, parser, filenames, incremental=False):
+        self.parser = parser
+        self.incremental = incremental
+        self.files = []
+        for filename in filenames:
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0
+            self.files.append({'filename': filename, 'size': size, 'bytes': 0, 'messages': 0, 'status': 'ожидает'})
+        self.cancelled = threading.Event()
+        self.started = self.finished = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Запускает загрузку и сразу возвращает управление"""
+        self.started = time.monotonic()
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """Просит остановить загрузку: текущий файл отбрасывается целиком"""
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        """Ждет окончания загрузки; True - загрузка завершена"""
+        self._thread.join(timeout)
+        return self.done()
+
+    def done(self):
+        return self.started is not None and not self._thread.is_alive()
+
+    def progress(self):
+        """Сводка: байты и сообщения, скорость и оценка оставшегося времени"""
+        elapsed = ((self.finished or time.monotonic()) - self.started) if self.started else 0.0
+        total_bytes = sum(entry['size'] for entry in self.files)
+        done_bytes = sum(entry['bytes'] for entry in self.files)
+        messages = sum(entry['messages'] for entry in self.files)
+        speed = done_bytes / elapsed if elapsed > 0 else 0.0
+        return {
+            'files_done': sum(1 for entry in self.files if entry['status'] not in ('ожидает', 'загружается')),
+            'files_total': len(self.files),
+            'bytes': done_bytes,
+            'bytes_total': total_bytes,
+            'messages': messages,
+            'elapsed': elapsed,
+            'bytes_per_second': speed,
+            'messages_per_second': messages / elapsed if elapsed > 0 else 0.0,
+            'eta': (total_bytes - done_bytes) / speed if speed > 0 and not self.done() else None,
         }
+
+    def _run(self):
+        parser = self.parser
+        executor = ProcessPoolExecutor(max_workers=parser.workers) if parser.workers > 1 else None
+        jobs = {}
+        try:
+            with parser.perf.stage('load') as stage:
+                if executor is not None and not self.incremental:
+                    # Все файлы сразу уходят в пул, чтобы процессы не простаивали между файлами
+                    for entry in self.files:
+                        jobs[entry['filename']] = self._prepare(entry, executor)
+                for entry in self.files:
+                    if self.cancelled.is_set():
+                        entry['status'] = 'отменен'
+                        continue
+                    entry['status'] = 'загружается'
+                    try:
+                        if self.incremental:
+                            self._load_new(entry, executor)
+                        else:
+                            job = jobs.pop(entry['filename'], None) or self._prepare(entry)
+                            self._load_file(entry, job, executor)
+                    except LoadCancelled:
+                        entry['status'] = 'отменен'
+                    except Exception as e:
+                        entry['status'] = f'ошибка: {e}'
+                stage['messages'] = sum(entry['messages'] for entry in self.files)
+        finally:
+            for job in jobs.values():
+                if job.get('cached'):
+                    job['cached'].close()
+            if executor is not None:
+                # После отмены не ждем куски, которые уже разбираются: их результат не нужен
+                executor.shutdown(wait=not self.cancelled.is_set(), cancel_futures=True)
+            with parser.lock:
+                parser._discard_failed([entry['filename'] for entry in self.files])
+            self.finished = time.monotonic()
+
+    def _prepare(self, entry, executor=None):
+        """Решает, как загружать файл: пропустить, взять из кэша или разобрать
+
+        С executor разбор сразу отправляется в пул процессов.
+        """
+        parser = self.parser
+        filename = entry['filename']
+        with parser.lock:
+            if not parser._prepare_file(filename):
+                return {'skip': True}
+            cached = parser.cache.open(filename) if parser.cache else None
+        if cached:
+            return {'cached': cached}
+        cache_key = parser.cache.key(filename) if parser.cache else None
+        futures = _submit_export(executor, filename, parser.workers, parser.stream_json) if executor else None
+        return {'cache_key': cache_key, 'futures': futures}
+
+    def _parse(self, entry, futures, executor):
+        """Разбирает файл вне блокировки; возвращает пакеты (хранилище, сведения о файле)"""
+        filename = entry['filename']
+        if futures is None:
+            staging = _StagingParser(self.parser.stream_json, entry, self.cancelled, self.parser.perf)
+            staging.file_chats[filename] = export_chat_key(filename)
+            staging._parse_file(filename)
+            batches = [(staging.messages, staging.file_sources.get(filename))]
+        else:
+            # Здесь видно только ожидание процессов пула, их собственное время не замеряется
+            with self.parser.perf.stage('parse', filename):
+                try:
+                    batches = self._collect(entry, futures)
+                except LoadCancelled:
+                    raise
+                except Exception:
+                    if len(futures) == 1:
+                        raise
+                    # Кусок не разобрался - файл целиком разбирается заново одним процессом
+                    entry.update(bytes=0, messages=0)
+                    retry = executor.submit(_load_file_worker, filename, self.parser.stream_json)
+                    batches = self._collect(entry, [(retry, entry['size'])])
+        entry['bytes'] = entry['size']
+        if self.cancelled.is_set():
+            raise LoadCancelled()
+        return batches
+
+    def _collect(self, entry, futures):
+        """Ждет куски из пула по порядку, обновляя прогресс и проверяя отмену"""
+        batches = []
+        for future, size in futures:
+            while not wait_futures([future], timeout=PROGRESS_POLL).done:
+                if self.cancelled.is_set():
+                    for pending, _ in futures:
+                        pending.cancel()
+                    raise LoadCancelled()
+            store, stats = future.result()
+            batches.append((store, stats))
+            entry['bytes'] += size
+            entry['messages'] += len(store)
+        return batches
+
+    def _load_file(self, entry, job, executor):
+        """Разбирает один файл и вливает его в парсер одним шагом"""
+        parser = self.parser
+        filename = entry['filename']
+        chat = export_chat_key(filename)
         
-        for msg in self.messages:
-            # Фильтр по исходному файлу
-            if source_file and msg['source_file'] != source_file:
-                continue
-            
-            # Фильтр по пользователю
-            if target_user and msg['from'] == target_user:
-                results['user_messages'].append(msg)
-            
-            # Фильтр по комментариям
-            if target_message_id and msg['reply_to'] == target_message_id:
-                results['message_comments'].append(msg)
-            
-            # Поиск по ключевому слову
-            if keyword and keyword.lower() in msg['text'].lower():
-                results['keyword_matches'].append(msg)
+        if job.get('skip'):
+            entry.update(bytes=entry['size'], status='уже в базе')
+            return
+        cached = job.get('cached')
+        if cached:
+            with parser.lock, cached:
+                parser._bump_generation()
+                parser.file_chats[filename] = chat
+                parser._load_cached(filename, cached.header, cached.sections, cached)
+            entry.update(bytes=entry['size'], messages=parser.file_sources[filename]['message_count'],
+                         status='из кэша')
+            return
         
-        self.current_results = results
-        return results
+        batches = self._parse(entry, job['futures'], executor)
+        with parser.lock:
+            mark = parser._file_mark(filename)
+            try:
+                parser._bump_generation()
+                parser.file_chats[filename] = chat
+                start = parser._begin_file()
+                with parser.perf.stage('merge', filename) as stage:
+                    for store, stats in batches:
+                        parser._merge_batch(filename, store, stats)
+                    stage['messages'] = sum(len(store) for store, _ in batches)
+                parser._finish_file(filename, start, job['cache_key'])
+            except Exception:
+                parser._rollback_file(filename, mark)
+                raise
+        entry['status'] = 'загружен'
+
+    def _load_new(self, entry, executor):
+        """Инкрементальная загрузка: новые сообщения читаются вне блокировки, вливаются под ней
+
+        Под блокировкой берется отметка для отката и ищется начало хвоста;
+        хвост (или весь файл, если начало не найдено) разбирается во
+        временное хранилище с прогрессом и отменой, а дубликаты
+        отбрасываются уже при слиянии.
+        """
+        parser = self.parser
+        filename = entry['filename']
+        with parser.lock:
+            mark = parser._file_mark(filename)
+            try:
+                chat, records, duplicates = parser._new_source(filename)
+            except Exception:
+                parser._rollback_file(filename, mark)
+                raise
+        
+        try:
+            if records is None:
+                futures = _submit_export(executor, filename, parser.workers, parser.stream_json) if executor else None
+                batches = self._parse(entry, futures, executor)
+            else:
+                store = MessageStore()
+                with parser.perf.stage('parse', filename):
+                    for msg_data in records:
+                        store.append(msg_data)
+                        entry['messages'] += 1
+                        if entry['messages'] % PROGRESS_INTERVAL == 0 and self.cancelled.is_set():
+                            raise LoadCancelled()
+                entry['bytes'] = entry['size']
+                if self.cancelled.is_set():
+                    raise LoadCancelled()
+                batches = [(store, None)]
+            
+            staged = (store.record_data(p) for store, _ in batches for p in range(len(store)))
+            with parser.lock:
+                parser._bump_generation()
+                new, duplicates = parser._merge_new(filename, chat, staged, duplicates)
+                parser.ingest_report[filename] = {'new': new, 'duplicates': duplicates}
+        except BaseException:
+            with parser.lock:
+                parser._rollback_file(filename, mark)
+            raise
+        entry.update(messages=new, status=f'новых {new}, дубликатов {duplicates}')
 
 
 def clear_console():
@@ -187,19 +4249,11 @@ def clear_console():
 
 def get_available_users(parser, source_file=None):
     """Получает список уникальных пользователей"""
-    users = set()
-    for msg in parser.messages:
-        if (source_file is None or msg['source_file'] == source_file) and msg['from']:
-            users.add(msg['from'])
-    return sorted(users)
+    return parser.available_users(source_file)
 
 def get_available_message_ids(parser, source_file=None):
     """Получает список доступных ID сообщений"""
-    message_ids = []
-    for msg in parser.messages:
-        if (source_file is None or msg['source_file'] == source_file) and msg['id'] is not None:
-            message_ids.append(msg['id'])
-    return sorted(message_ids)
+    return parser.available_message_ids(source_file)
 
 def get_available_files(parser):
     """Получает список загруженных файлов"""
@@ -289,12 +4343,21 @@ def configure_filters(parser):
         print(f"\n--- НАСТРОЙКА ФИЛЬТРОВ ---")
         print(f"Файл: {filters['source_file'] or 'Все файлы'}")
         print("1. Пользователь: {}".format(filters['target_user'] or 'Не выбрано'))
-        print("2. ID сообщения для комментариев: {}".format(filters['target_message_id'] or 'Не выбрано'))
+        print("2. ID сообщения для комментариев: {}{}".format(
+            filters['target_message_id'] or 'Не выбрано',
+            '' if filters['thread_depth'] is None or not filters['target_message_id']
+            else f" (ветка, глубина {filters['thread_depth'] or 'без ограничения'})"))
         print("3. Ключевое слово: {}".format(filters['keyword'] or 'Не выбрано'))
         print("4. Файл для фильтрации: {}".format(filters['source_file'] or 'Все файлы'))
-        print("5. Применить фильтры и выйти")
-        print("6. Сбросить все фильтры")
-        print("7. Выйти без сохранения")
+        print("5. Список слов для поиска: {}".format(
+            f"{len(filters['terms'])} шт.{' (регулярные выражения)' if filters['terms_regex'] else ''}"
+            if filters['terms'] else 'Не выбрано'))
+        print("6. Период: {}".format(
+            f"{filters['date_from'] or '...'} - {filters['date_to'] or '...'}"
+            if filters['date_from'] or filters['date_to'] else 'Не выбрано'))
+        print("7. Применить фильтры и выйти")
+        print("8. Сбросить все фильтры")
+        print("9. Выйти без сохранения")
         
         choice = input("\nВыберите опцию: ")
         
@@ -340,6 +4403,10 @@ def configure_filters(parser):
                     filters['target_message_id'] = None
             except ValueError:
                 print("ID должно быть числом! Сохраняется текущее значение.")
+            
+            if filters['target_message_id']:
+                depth = input("Глубина ветки ответов (Enter - только прямые комментарии, 0 - вся ветка): ")
+                filters['thread_depth'] = int(depth) if depth.isdigit() else None
         
         elif choice == '3':
             clear_console()
@@ -369,19 +4436,47 @@ def configure_filters(parser):
                 print("Введите число! Сохраняется текущее значение.")
         
         elif choice == '5':
+            clear_console()
+            print(f"Текущий список: {', '.join(filters['terms']) if filters['terms'] else 'Не выбрано'}")
+            terms_input = input("Введите слова через запятую или путь к файлу (по одному на строке): ")
+            if not terms_input:
+                filters['terms'] = None
+            elif os.path.isfile(terms_input):
+                with open(terms_input, 'r', encoding='utf-8') as f:
+                    filters['terms'] = [line.strip() for line in f if line.strip()] or None
+            else:
+                filters['terms'] = [term.strip() for term in terms_input.split(',') if term.strip()] or None
+            filters['terms_regex'] = bool(filters['terms']) and input("Это регулярные выражения? (y/N): ").lower() == 'y'
+        
+        elif choice == '6':
+            clear_console()
+            print("Даты в формате ДД.ММ.ГГГГ [ЧЧ:ММ] или ГГГГ-ММ-ДД [ЧЧ:ММ], время в UTC")
+            for field, prompt in (('date_from', "Начало периода"), ('date_to', "Конец периода")):
+                value = input(f"{prompt} [текущее: {filters[field] or 'не задано'}, Enter - без ограничения]: ").strip()
+                try:
+                    _date_bound(value)
+                    filters[field] = value or None
+                except ValueError as e:
+                    print(f"{e}. Сохраняется текущее значение.")
+        
+        elif choice == '7':
             # Применяем фильтры и выходим
-            parser.filter_messages(**filters)
+            try:
+                parser.filter_messages(**filters)
+            except re.error as e:
+                print(f"Ошибка в регулярном выражении: {e}")
+                continue
             print("Фильтры применены!")
             break
         
-        elif choice == '6':
+        elif choice == '8':
             # Сброс фильтров
-            filters = {'target_user': None, 'target_message_id': None, 'keyword': None, 'source_file': None}
+            filters = dict(DEFAULT_FILTERS)
             parser.filter_messages(**filters)
             print("Фильтры сброшены!")
             break
         
-        elif choice == '7':
+        elif choice == '9':
             # Выход без сохранения (восстанавливаем старые фильтры)
             print("Изменения отменены.")
             break
@@ -391,24 +4486,12 @@ def configure_filters(parser):
     
     return filters
 
-def export_results(results, format_type):
-    """Экспорт результатов"""
-    filename = input("Введите имя файла для экспорта (без расширения): ")
-    
-    if format_type == 'json':
-        filename += '.json'
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
-        print(f"Результаты сохранены в {filename}")
-    
-    elif format_type == 'html':
-        filename += '.html'
-        html_template = """
+_HTML_EXPORT_HEAD = """
         <!DOCTYPE html>
         <html>
         <head>
             <meta charset="utf-8">
-            <title>Telegram Chat Analysis</title>
+            <title>{{ title }}</title>
             <style>
                 body { font-family: Arial, sans-serif; margin: 20px; }
                 .section { margin-bottom: 40px; border-bottom: 2px solid #333; padding-bottom: 20px; }
@@ -418,16 +4501,14 @@ def export_results(results, format_type):
                 .text { margin-top: 5px; line-height: 1.4; }
                 .count { background: #3498db; color: white; padding: 2px 6px; border-radius: 3px; }
                 .source { color: #e74c3c; font-size: 0.8em; margin-top: 5px; }
+                .pages a { margin-right: 10px; }
             </style>
         </head>
         <body>
-            <h1>Анализ Telegram Чата</h1>
-            <p><strong>Общее количество сообщений:</strong> {{ total_messages }}</p>
-            
-            {% if user_messages %}
-            <div class="section">
-                <h2>Сообщения пользователя <span class="count">{{ user_messages|length }}</span></h2>
-                {% for msg in user_messages %}
+"""
+
+_HTML_EXPORT_MESSAGES = """
+                {% for msg in messages %}
                 <div class="message">
                     <div class="user">{{ msg.from }}</div>
                     <div class="date">{{ msg.date }}</div>
@@ -435,48 +4516,332 @@ def export_results(results, format_type):
                     <div class="source">Источник: {{ msg.source_file }}</div>
                 </div>
                 {% endfor %}
-            </div>
-            {% endif %}
+"""
+
+_HTML_EXPORT_TEMPLATE = _HTML_EXPORT_HEAD + """
+            <h1>Анализ Telegram Чата</h1>
+            <p><strong>Общее количество сообщений:</strong> {{ total_messages }}</p>
             
-            {% if message_comments %}
+            {% for heading, messages in sections %}
             <div class="section">
-                <h2>Комментарии к сообщению <span class="count">{{ message_comments|length }}</span></h2>
-                {% for msg in message_comments %}
-                <div class="message">
-                    <div class="user">{{ msg.from }}</div>
-                    <div class="date">{{ msg.date }}</div>
-                    <div class="text">{{ msg.text }}</div>
-                    <div class="source">Источник: {{ msg.source_file }}</div>
-                </div>
-                {% endfor %}
+                <h2>{{ heading }} <span class="count">{{ messages|length }}</span></h2>
+""" + _HTML_EXPORT_MESSAGES + """
             </div>
-            {% endif %}
+            {% endfor %}
+        </body>
+        </html>
+"""
+
+_HTML_INDEX_TEMPLATE = _HTML_EXPORT_HEAD + """
+            <h1>Анализ Telegram Чата</h1>
+            <p><strong>Общее количество сообщений:</strong> {{ total_messages }}</p>
             
-            {% if keyword_matches %}
+            {% for heading, count, pages in sections %}
             <div class="section">
-                <h2>Сообщения с ключевым словом <span class="count">{{ keyword_matches|length }}</span></h2>
-                {% for msg in keyword_matches %}
-                <div class="message">
-                    <div class="user">{{ msg.from }}</div>
-                    <div class="date">{{ msg.date }}</div>
-                    <div class="text">{{ msg.text }}</div>
-                    <div class="source">Источник: {{ msg.source_file }}</div>
+                <h2>{{ heading }} <span class="count">{{ count }}</span></h2>
+                <div class="pages">
+                    {% for page in pages %}<a href="{{ page }}">Страница {{ loop.index }}</a>{% endfor %}
                 </div>
-                {% endfor %}
             </div>
-            {% endif %}
+            {% endfor %}
         </body>
         </html>
-        """
-        
-        template = Template(html_template)
-        total_messages = len(results.get('user_messages', [])) + len(results.get('message_comments', [])) + len(results.get('keyword_matches', []))
-        rendered_html = template.render(total_messages=total_messages, **results)
+"""
+
+_HTML_PAGE_TEMPLATE = _HTML_EXPORT_HEAD + """
+            <p class="pages"><a href="{{ index }}">Оглавление</a>
+            {% if previous %}<a href="{{ previous }}">Назад</a>{% endif %}
+            {% if next %}<a href="{{ next }}">Вперед</a>{% endif %}</p>
+            <div class="section">
+                <h2>{{ heading }} <span class="count">{{ number }} / {{ pages }}</span></h2>
+""" + _HTML_EXPORT_MESSAGES + """
+            </div>
+        </body>
+        </html>
+"""
+
+
+def _export_sections(results):
+    """Непустые разделы результатов: (заголовок, сообщения)"""
+    sections = [
+        ("Сообщения пользователя", results.get('user_messages')),
+        ("Комментарии к сообщению", results.get('message_comments')),
+        ("Ветка обсуждения сообщения", results.get('thread_messages')),
+        ("Сообщения с ключевым словом", results.get('keyword_matches')),
+    ]
+    sections += [(f"Сообщения со словом «{term}»", matches)
+                 for term, matches in (results.get('term_matches') or {}).items()]
+    sections.append(("Сообщения за период", results.get('date_messages')))
+    return [(heading, messages) for heading, messages in sections if messages]
+
+
+def _write_json_value(f, value, level=0):
+    """Пишет значение в JSON с отступом 2, перебирая списки по одному элементу"""
+    indent = '\n' + '  ' * (level + 1)
+    if isinstance(value, dict):
+        if not value:
+            f.write('{}')
+            return
+        separator = '{'
+        for key, item in value.items():
+            f.write(separator + indent + json.dumps(key, ensure_ascii=False) + ': ')
+            _write_json_value(f, item, level + 1)
+            separator = ','
+        f.write(indent[:-2] + '}')
+    elif isinstance(value, (str, int, float, bool, Mapping)) or value is None:
+        text = json.dumps(value, ensure_ascii=False, indent=2, default=dict)
+        f.write(text.replace('\n', indent[:-2]))
+    else:
+        separator = '['
+        for item in value:
+            f.write(separator + indent)
+            _write_json_value(f, item, level + 1)
+            separator = ','
+        f.write('[]' if separator == '[' else indent[:-2] + ']')
+
+
+def _write_html_pages(filename, results, total_messages, page_size):
+    """Пишет HTML по страницам: оглавление filename.html и страницы filename2.html, filename3.html...
+
+    Как в экспорте Telegram, каждая страница содержит не больше page_size
+    сообщений, поэтому в памяти одновременно находится только одна страница.
+    """
+    base, ext = os.path.splitext(filename)
+    index_name = os.path.basename(filename)
+    page_template = Template(_HTML_PAGE_TEMPLATE)
+    
+    def page_name(number):
+        return f"{os.path.basename(base)}{number}{ext}"
+    
+    contents = []
+    number = 1
+    for heading, messages in _export_sections(results):
+        count = len(messages)
+        pages = -(-count // page_size)
+        first = number + 1
+        iterator = iter(messages)
+        for k in range(pages):
+            number += 1
+            chunk = list(islice(iterator, page_size))
+            with open(base + str(number) + ext, 'w', encoding='utf-8') as f:
+                page_template.stream(
+                    title=f"{heading} ({k + 1}/{pages})", heading=heading, messages=chunk,
+                    number=k + 1, pages=pages, index=index_name,
+                    previous=page_name(number - 1) if k else None,
+                    next=page_name(number + 1) if k + 1 < pages else None,
+                ).dump(f)
+        contents.append((heading, count, [page_name(n) for n in range(first, number + 1)]))
+    
+    with open(filename, 'w', encoding='utf-8') as f:
+        Template(_HTML_INDEX_TEMPLATE).stream(
+            title="Telegram Chat Analysis", total_messages=total_messages, sections=contents
+        ).dump(f)
+    return number - 1
+
+
+def export_results(results, format_type, page_size=None, filename=None, perf=None):
+    """Экспорт результатов
+    
+    Файл пишется по мере обхода результатов; для HTML с page_size
+    разделы разбиваются на страницы с оглавлением. Если имя файла
+    (без расширения) не передано, оно запрашивается у пользователя.
+    С perf время экспорта записывается в журнал как этап render.
+    """
+    if filename is None:
+        filename = input("Введите имя файла для экспорта (без расширения): ")
+    
+    if format_type == 'json':
+        filename += '.json'
+        with perf.stage('render') if perf else nullcontext(), open(filename, 'w', encoding='utf-8') as f:
+            _write_json_value(f, results)
+        print(f"Результаты сохранены в {filename}")
+    
+    elif format_type == 'html':
+        filename += '.html'
+        sections = _export_sections(results)
+        total_messages = sum(len(messages) for heading, messages in sections)
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(rendered_html)
+        with perf.stage('render') if perf else nullcontext() as stage:
+            if stage is not None:
+                stage['messages'] = total_messages
+            if page_size:
+                pages = _write_html_pages(filename, results, total_messages, page_size)
+                print(f"Результаты сохранены в {filename} (страниц: {pages})")
+                return
+            
+            template = Template(_HTML_EXPORT_TEMPLATE)
+            with open(filename, 'w', encoding='utf-8') as f:
+                template.stream(title="Telegram Chat Analysis", total_messages=total_messages,
+                                sections=sections).dump(f)
         print(f"Результаты сохранены в {filename}")
 
+
+_WEEKDAYS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+
+
+def _activity_numpy(store, positions):
+    """Счетчики активности векторными операциями NumPy над колонками хранилища"""
+    authors = np.frombuffer(store.author_codes, dtype=np.uint32)
+    timestamps = np.frombuffer(store.timestamps, dtype=np.int64)
+    reply_to = np.frombuffer(store.reply_to, dtype=np.int64)
+    if positions is not None:
+        selected = np.frombuffer(positions, dtype=np.uint32)
+        authors, timestamps, reply_to = authors[selected], timestamps[selected], reply_to[selected]
+    
+    author_count = len(store.authors.values)
+    is_reply = reply_to != _NO_VALUE
+    dated = timestamps != _NO_VALUE
+    dated_authors, timestamps = authors[dated], timestamps[dated]
+    
+    first = np.full(author_count, np.iinfo(np.int64).max)
+    np.minimum.at(first, dated_authors, timestamps)
+    last = np.full(author_count, np.iinfo(np.int64).min)
+    np.maximum.at(last, dated_authors, timestamps)
+    
+    days, day_counts = np.unique(timestamps // 86400, return_counts=True)
+    hours = timestamps // 3600
+    # 1 января 1970 года - четверг, поэтому понедельник - (день + 3) % 7 == 0
+    hour_of_week = ((hours // 24 + 3) % 7) * 24 + hours % 24
+    replied, replied_counts = np.unique(reply_to[is_reply], return_counts=True)
+    
+    return {
+        'messages': np.bincount(authors, minlength=author_count).tolist(),
+        'replies': np.bincount(authors[is_reply], minlength=author_count).tolist(),
+        'first': first.tolist(),
+        'last': last.tolist(),
+        'days': dict(zip(days.tolist(), day_counts.tolist())),
+        'hour_of_week': np.bincount(hour_of_week, minlength=7 * 24).tolist(),
+        'replied': dict(zip(replied.tolist(), replied_counts.tolist())),
+    }
+
+
+def _activity_python(store, positions):
+    """Те же счетчики, что у _activity_numpy, обычным циклом (без NumPy)"""
+    author_count = len(store.authors.values)
+    counters = {
+        'messages': [0] * author_count,
+        'replies': [0] * author_count,
+        'first': [2 ** 63 - 1] * author_count,
+        'last': [-2 ** 63] * author_count,
+        'days': {},
+        'hour_of_week': [0] * (7 * 24),
+        'replied': {},
+    }
+    messages, replies, first, last = counters['messages'], counters['replies'], counters['first'], counters['last']
+    days, hour_of_week, replied = counters['days'], counters['hour_of_week'], counters['replied']
+    
+    for p in (range(len(store)) if positions is None else positions):
+        author = store.author_codes[p]
+        messages[author] += 1
+        reply_to = store.reply_to[p]
+        if reply_to != _NO_VALUE:
+            replies[author] += 1
+            replied[reply_to] = replied.get(reply_to, 0) + 1
+        timestamp = store.timestamps[p]
+        if timestamp != _NO_VALUE:
+            first[author] = min(first[author], timestamp)
+            last[author] = max(last[author], timestamp)
+            day, hour = timestamp // 86400, timestamp // 3600 % 24
+            days[day] = days.get(day, 0) + 1
+            hour_of_week[(day + 3) % 7 * 24 + hour] += 1
+    counters['days'] = dict(sorted(days.items()))
+    counters['replied'] = dict(sorted(replied.items()))
+    return counters
+
+
+def _format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def compute_analytics(parser, source_file=None, top=ANALYTICS_TOP):
+    """Аналитика активности: по пользователям, дням, часам недели и ответам
+    
+    Счетчики считаются по колонкам хранилища (коды авторов, время,
+    reply_to) - векторно через NumPy, если он установлен. Время в UTC.
+    Частые слова, упоминания и хэштеги берутся из частот, собранных при
+    загрузке; error - на сколько частота может быть занижена.
+    Результат - словарь, пригодный для экспорта в JSON.
+    """
+    names, counters = parser.activity_counters(source_file)
+    frequencies = parser.token_frequencies(source_file)
+    users = {}
+    for code in sorted(range(len(names)), key=lambda code: -counters['messages'][code]):
+        if not counters['messages'][code]:
+            break
+        dated = counters['first'][code] <= counters['last'][code]
+        users[names[code]] = {
+            'messages': counters['messages'][code],
+            'replies': counters['replies'][code],
+            'first_activity': _format_timestamp(counters['first'][code]) if dated else None,
+            'last_activity': _format_timestamp(counters['last'][code]) if dated else None,
+            'top_words': [list(item) for item in frequencies.top('words', FREQUENCY_USER_TOP, names[code])[0]],
+        }
+    
+    hour_of_week = counters['hour_of_week']
+    repliers = sorted(((name, stats['replies']) for name, stats in users.items() if stats['replies']),
+                      key=lambda item: -item[1])
+    most_replied = sorted(counters['replied'].items(), key=lambda item: -item[1])
+    dated_users = [stats for stats in users.values() if stats['first_activity']]
+    return {
+        'messages': sum(counters['messages']),
+        'users': users,
+        'per_day': {(datetime(1970, 1, 1) + timedelta(days=day)).strftime('%Y-%m-%d'): count
+                    for day, count in counters['days'].items()},
+        'per_hour_of_week': {weekday: hour_of_week[i * 24:(i + 1) * 24] for i, weekday in enumerate(_WEEKDAYS)},
+        'replies': sum(counters['replies']),
+        'top_repliers': [list(item) for item in repliers[:top]],
+        'most_replied': [list(item) for item in most_replied[:top]],
+        'first_activity': min((stats['first_activity'] for stats in dated_users), default=None),
+        'last_activity': max((stats['last_activity'] for stats in dated_users), default=None),
+        'frequencies': {kind: _frequency_summary(frequencies, kind, top) for kind in FREQUENCY_KINDS},
+    }
+
+
+def _frequency_summary(frequencies, kind, top, author=None):
+    """Самые частые токены вида kind с числом токенов и допустимой ошибкой"""
+    items, error = frequencies.top(kind, top, author)
+    sketch = frequencies.chat[kind] if author is None else frequencies.users[author][kind]
+    return {'top': [list(item) for item in items], 'total': sketch.total, 'error': error}
+
+
+def _format_frequencies(summary):
+    """Строка рейтинга частот: токен (частота), с оговоркой о точности"""
+    line = ", ".join(f"{token} ({count})" for token, count in summary['top'])
+    if summary['error']:
+        line += f" [частоты занижены не больше чем на {summary['error']}]"
+    return line
+
+
+def show_analytics(analytics, top=5):
+    """Печатает основные показатели аналитики активности"""
+    print(f"\nАктивность (время UTC):")
+    print(f"Первое сообщение: {analytics['first_activity'] or '-'}, последнее: {analytics['last_activity'] or '-'}")
+    print(f"Ответов: {analytics['replies']}")
+    
+    print("Самые активные пользователи:")
+    for name, stats in list(analytics['users'].items())[:top]:
+        print(f"  {name}: {stats['messages']} сообщений, {stats['replies']} ответов "
+              f"({stats['first_activity'] or '-'} - {stats['last_activity'] or '-'})")
+    
+    if analytics['top_repliers']:
+        print("Чаще всего отвечают:")
+        for name, count in analytics['top_repliers'][:top]:
+            print(f"  {name}: {count}")
+    
+    if analytics['per_day']:
+        busiest = sorted(analytics['per_day'].items(), key=lambda item: -item[1])[:top]
+        print("Самые активные дни: " + ", ".join(f"{day} ({count})" for day, count in busiest))
+        weekday, hour = max(((weekday, hour) for weekday in analytics['per_hour_of_week'] for hour in range(24)),
+                            key=lambda item: analytics['per_hour_of_week'][item[0]][item[1]])
+        print(f"Самый активный час недели: {weekday} {hour:02d}:00 "
+              f"({analytics['per_hour_of_week'][weekday][hour]} сообщений)")
+    
+    for kind, title in (('words', "Частые слова"), ('mentions', "Частые упоминания"), ('hashtags', "Частые хэштеги")):
+        summary = analytics['frequencies'][kind]
+        if summary['top']:
+            print(f"{title}: {_format_frequencies(dict(summary, top=summary['top'][:top]))}")
+
+
 def show_statistics(parser, results, filters):
     """Показывает статистику анализа"""
     source_file = filters.get('source_file')
@@ -492,7 +4857,16 @@ def show_statistics(parser, results, filters):
     if results:
         print(f"Сообщений пользователя: {len(results['user_messages'])}")
         print(f"Комментариев: {len(results['message_comments'])}")
+        if filters.get('thread_depth') is not None and filters.get('target_message_id'):
+            print(f"Сообщений в ветке обсуждения: {len(results['thread_messages'])}")
         print(f"Сообщений с ключевым словом: {len(results['keyword_matches'])}")
+        if results['user_messages'] and results['keyword_matches']:
+            both = results['user_messages'] & results['keyword_matches']
+            print(f"Сообщений пользователя с ключевым словом: {len(both)}")
+        for term, matches in results['term_matches'].items():
+            print(f"Сообщений со словом «{term}»: {len(matches)}")
+        if filters.get('date_from') or filters.get('date_to'):
+            print(f"Сообщений за период: {len(results['date_messages'])}")
     else:
         print("Фильтры не применены")
     
@@ -501,6 +4875,25 @@ def show_statistics(parser, results, filters):
         print(f"\nСтатистика по файлам:")
         for file, stats in parser.file_sources.items():
             print(f"  {file}: {stats['message_count']} сообщений, {len(stats['users'])} пользователей")
+    
+    show_analytics(compute_analytics(parser, source_file))
+    
+    target_user = filters.get('target_user')
+    if target_user:
+        frequencies = parser.token_frequencies(source_file)
+        if target_user in frequencies.users:
+            print(f"\nЧастоты пользователя {target_user}:")
+            for kind, title in (('words', "слова"), ('mentions', "упоминания"), ('hashtags', "хэштеги")):
+                summary = _frequency_summary(frequencies, kind, ANALYTICS_TOP, target_user)
+                if summary['top']:
+                    print(f"  {title}: {_format_frequencies(summary)}")
+    
+    threads = parser.largest_threads(5)
+    if threads:
+        print("Самые большие ветки ответов: " + ", ".join(
+            f"{thread['message_id']} ({thread['size']} ответов)" for thread in threads))
+        print("Самые глубокие ветки ответов: " + ", ".join(
+            f"{thread['message_id']} (глубина {thread['depth']})" for thread in parser.deepest_threads(5)))
 
 def show_loaded_files(parser):
     """Показывает загруженные файлы"""
@@ -521,10 +4914,366 @@ def show_loaded_files(parser):
     
     print(f"\nИтого: {len(parser.file_sources)} файлов, {total_messages} сообщений, {len(total_users)} уникальных пользователей")
 
-def main():
-    parser = TelegramChatParser()
+def show_snapshot(header):
+    """Показывает сводку снимка по заголовку, не читая сообщений"""
+    print(f"\n--- СНИМОК (узлов: {len(header['shards'])}: {', '.join(header['shards'])}) ---")
+    user_counts = Counter()
+    for entry in header['files']:
+        counts = {user: count for user, count in entry['user_counts']}
+        user_counts.update(counts)
+        print(f"* {entry['shard']}: {entry['name']} - {entry['message_count']} сообщений, {len(counts)} пользователей")
+    
+    total = sum(entry['message_count'] for entry in header['files'])
+    print(f"\nИтого: {len(header['files'])} файлов, {total} сообщений, {len(user_counts)} уникальных пользователей")
+    if user_counts:
+        print("Самые активные пользователи: " + ", ".join(
+            f"{user} ({count})" for user, count in user_counts.most_common(ANALYTICS_TOP)))
+
+def format_progress(loader):
+    """Строка с ходом фоновой загрузки"""
+    progress = loader.progress()
+    line = (f"{progress['files_done']}/{progress['files_total']} файлов, "
+            f"{progress['bytes'] / 2**20:.1f}/{progress['bytes_total'] / 2**20:.1f} МБ, "
+            f"{progress['messages']} сообщений, {progress['messages_per_second']:.0f} сообщ./с")
+    if progress['eta'] is not None:
+        line += f", осталось ~{progress['eta']:.0f} с"
+    return line
+
+def show_loading(loader):
+    """Показывает ход фоновой загрузки и позволяет ее отменить"""
+    while True:
+        clear_console()
+        print("\n=== ХОД ЗАГРУЗКИ ===")
+        for entry in loader.files:
+            percent = entry['bytes'] * 100 // entry['size'] if entry['size'] else 100
+            print(f"- {entry['filename']}: {entry['status']} ({percent}%, {entry['messages']} сообщений)")
+        print(f"\n{format_progress(loader)}")
+        
+        if loader.done():
+            print("✓ Загрузка завершена")
+            return
+        choice = input("\nEnter - обновить, c - отменить загрузку, q - назад: ").lower()
+        if choice == 'c':
+            loader.cancel()
+            print("Загрузка будет остановлена, текущий файл не будет добавлен...")
+            loader.wait()
+        elif choice == 'q':
+            return
+
+_STAGE_NAMES = {
+    'load': 'загрузка целиком',
+    'read': 'чтение файла',
+    'parse': 'разбор и индексы полей',
+    'cache': 'загрузка из кэша',
+    'merge': 'слияние в парсер',
+    'index': 'сегмент текстового индекса',
+    'write': 'запись кэша/базы',
+    'filter': 'фильтрация',
+    'render': 'экспорт',
+}
+
+def _print_stage_table(stages):
+    """Таблица замеров этапов"""
+    print(f"{'этап':<8}{'вызовов':>9}{'время, с':>10}{'ЦП, с':>9}{'сообщений':>11}{'сообщ./с':>11}{'пик, МБ':>9}")
+    for name, totals in stages.items():
+        rate = totals['messages'] / totals['wall'] if totals['messages'] and totals['wall'] else 0
+        peak = f"{totals['alloc_peak'] / 2**20:.1f}" if totals['alloc_peak'] is not None else '-'
+        print(f"{name:<8}{totals['calls']:>9}{totals['wall']:>10.3f}{totals['cpu']:>9.3f}"
+              f"{totals['messages']:>11}{rate:>11.0f}{peak:>9}  {_STAGE_NAMES.get(name, '')}")
+
+def show_performance(parser):
+    """Замеры этапов по всем файлам и по каждому файлу, профилирование операций"""
+    perf = parser.perf
+    while True:
+        clear_console()
+        print("\n=== ПРОИЗВОДИТЕЛЬНОСТЬ ===")
+        if not perf.stages:
+            print("Замеров пока нет")
+        else:
+            _print_stage_table(perf.stages)
+        for filename, stages in perf.files.items():
+            print(f"\n{filename}:")
+            _print_stage_table(stages)
+        
+        print(f"\n* Отслеживание памяти: {'включено' if perf.tracing() else 'выключено'}")
+        if perf.profile_stage:
+            print(f"* Будет профилирована следующая операция: {perf.profile_stage}")
+        for base in perf.dumps[-3:]:
+            print(f"* Профиль: {base}.txt (.prof, .tracemalloc)")
+        
+        print("\n1. Включить/выключить отслеживание памяти (замедляет работу)")
+        print("2. Профилировать следующую операцию (cProfile и tracemalloc)")
+        print("3. Сбросить замеры")
+        print("4. Назад")
+        choice = input("Выберите опцию: ")
+        
+        if choice == '1':
+            perf.set_tracing(not perf.tracing())
+        elif choice == '2':
+            print("1. Загрузка файлов  2. Фильтрация  3. Экспорт")
+            stage = {'1': 'load', '2': 'filter', '3': 'render'}.get(input("Операция: "))
+            if stage:
+                perf.profile_stage = stage
+                print(f"Профиль сохранится в {perf.profile_dir} после следующей операции")
+                input("\nНажмите Enter для продолжения...")
+        elif choice == '3':
+            perf.clear()
+        elif choice == '4':
+            return
+
+# Ключи запроса в файле пакетного режима, кроме фильтров
+BATCH_QUERY_KEYS = ('name', 'format', 'page_size')
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _batch_query_errors(query):
+    """Список ошибок в ключах запроса пакетного режима (пустой - запрос верный)"""
+    errors = []
+    unknown = set(query) - set(DEFAULT_FILTERS) - set(BATCH_QUERY_KEYS)
+    if unknown:
+        errors.append(f"неизвестные ключи {', '.join(sorted(unknown))}")
+    
+    name = query['name']
+    if not isinstance(name, str) or not name.strip():
+        errors.append("name должен быть непустой строкой")
+    elif os.path.isabs(name) or '..' in re.split(r'[\\/]', name):
+        errors.append("name должен быть путем внутри каталога результатов")
+    if query.get('format', 'json') not in ('json', 'html'):
+        errors.append("формат должен быть json или html")
+    if query.get('page_size') is not None and not (_is_int(query['page_size']) and query['page_size'] > 0):
+        errors.append("page_size должен быть положительным целым числом")
+    
+    for field in ('target_user', 'keyword', 'source_file'):
+        if query.get(field) is not None and not isinstance(query[field], str):
+            errors.append(f"{field} должен быть строкой")
+    if query.get('target_message_id') is not None and not _is_int(query['target_message_id']):
+        errors.append("target_message_id должен быть целым числом")
+    if query.get('thread_depth') is not None and not (_is_int(query['thread_depth']) and query['thread_depth'] >= 0):
+        errors.append("thread_depth должен быть неотрицательным целым числом")
+    if not isinstance(query.get('terms_regex', False), bool):
+        errors.append("terms_regex должен быть true или false")
+    
+    terms = query.get('terms')
+    if terms is not None and (not isinstance(terms, list) or not all(isinstance(term, str) for term in terms)):
+        errors.append("terms должен быть списком строк")
+    elif terms and query.get('terms_regex') is True:
+        for term in terms:
+            try:
+                re.compile(term)
+            except re.error as e:
+                errors.append(f"неверное выражение {term!r}: {e}")
+    
+    bounds = {}
+    for field in ('date_from', 'date_to'):
+        value = query.get(field)
+        if value is None or value == '':
+            continue
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            errors.append(f"{field} должен быть строкой с датой или числом секунд")
+            continue
+        try:
+            bounds[field] = _date_bound(value, end=field == 'date_to')
+        except ValueError:
+            errors.append(f"не удалось разобрать дату {field} {value!r}")
+    if len(bounds) == 2 and bounds['date_from'] > bounds['date_to']:
+        errors.append("date_from позже date_to")
+    return errors
+
+
+def read_batch_queries(filename):
+    """Читает файл запросов пакетного режима (JSON)
+    
+    Файл - список запросов или объект {"defaults": {...}, "queries": [...]},
+    где defaults дополняют каждый запрос. Запрос - объект с ключами
+    DEFAULT_FILTERS и необязательными name (имя файла результатов без
+    расширения), format (json или html) и page_size. Все запросы
+    проверяются до выполнения: типы и допустимые значения каждого ключа.
+    Возвращает список запросов с заполненным name; при ошибках -
+    ValueError со всеми найденными ошибками, по одной на строку.
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    defaults = {}
+    if isinstance(data, dict):
+        defaults = data.get('defaults') or {}
+        data = data.get('queries')
+    if not isinstance(data, list) or not isinstance(defaults, dict):
+        raise ValueError("ожидается список запросов или объект с ключом queries")
+    
+    queries = []
+    errors = []
+    names = set()
+    width = len(str(len(data)))
+    for number, query in enumerate(data, 1):
+        if not isinstance(query, dict):
+            errors.append(f"запрос {number}: ожидается объект")
+            continue
+        query = dict(defaults, **query)
+        query.setdefault('name', f"query_{number:0{width}d}")
+        label = query['name'] if isinstance(query['name'], str) else number
+        query_errors = _batch_query_errors(query)
+        if not query_errors and query['name'] in names:
+            query_errors.append("имя уже занято другим запросом")
+        errors.extend(f"запрос {label}: {error}" for error in query_errors)
+        if not query_errors:
+            names.add(query['name'])
+        queries.append(query)
+    if errors:
+        raise ValueError('\n'.join(errors))
+    return queries
+
+
+def run_batch(queries_file, filenames=(), db_path=None, output_dir='.', format_type='json', page_size=None,
+              incremental=False, snapshots=()):
+    """Пакетный режим: загрузка файлов, все запросы из файла и экспорт без вопросов
+    
+    Файлы и снимки (snapshots) загружаются один раз, запросы выполняются
+    вместе через filter_batch, результат каждого пишется через
+    export_results в output_dir под именем запроса. format_type и
+    page_size - значения по умолчанию для запросов без своих. Запрос с
+    ошибкой (файл не загружен, ошибка выборки или записи) пропускается,
+    остальные выполняются; тогда код выхода 1.
+    """
+    try:
+        queries = read_batch_queries(queries_file)
+    except (OSError, ValueError) as e:
+        print(f"✗ Файл запросов {queries_file}: {e}")
+        return 1
+    
+    parser = _open_parser(db_path)
+    try:
+        if not _load_snapshots(parser, snapshots):
+            return 1
+        if filenames:
+            parser.load_files(filenames, incremental=incremental)
+        if not parser.file_sources:
+            print("✗ Нет загруженных сообщений: укажите файлы экспорта или базу с ними")
+            return 1
+        
+        # Файл в запросе можно указать и без пути, если имя среди загруженных одно
+        by_name = {}
+        for source_file in parser.file_sources:
+            by_name.setdefault(os.path.basename(source_file), []).append(source_file)
+        failed = 0
+        runnable = []
+        for query in queries:
+            source_file = query.get('source_file')
+            if source_file and source_file not in parser.file_sources:
+                if len(by_name.get(source_file, ())) != 1:
+                    print(f"✗ Запрос {query['name']}: файл {source_file} не загружен")
+                    failed += 1
+                    continue
+                query['source_file'] = by_name[source_file][0]
+            runnable.append(query)
+        
+        filters = [{key: value for key, value in query.items() if key in DEFAULT_FILTERS} for query in runnable]
+        try:
+            batch = parser.filter_batch(filters)
+        except Exception:
+            # Ошибка одного запроса не должна останавливать остальные:
+            # пакет выполняется заново по одному запросу
+            batch = []
+            for query, query_filters in zip(runnable, filters):
+                try:
+                    batch.append(parser.filter_batch([query_filters])[0])
+                except Exception as e:
+                    print(f"✗ Запрос {query['name']}: {e}")
+                    batch.append(None)
+        
+        for query, results in zip(runnable, batch):
+            if results is None:
+                failed += 1
+                continue
+            filename = os.path.join(output_dir, query['name'])
+            try:
+                os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+                export_results(results, query.get('format', format_type),
+                               page_size=query.get('page_size', page_size), filename=filename, perf=parser.perf)
+            except (OSError, ValueError) as e:
+                print(f"✗ Запрос {query['name']}: ошибка при экспорте: {e}")
+                failed += 1
+        print(f"✓ Выполнено запросов: {len(queries) - failed}")
+        if failed:
+            print(f"✗ С ошибкой: {failed}")
+            return 1
+        return 0
+    finally:
+        if db_path:
+            parser.close()
+
+
+def _open_parser(db_path=None):
+    """Парсер для запуска из командной строки: с базой SQLite или в памяти с дисковым кэшем"""
+    if db_path:
+        # Сообщения хранятся в базе SQLite и не загружаются в память
+        return SQLiteChatParser(db_path, workers=os.cpu_count() or 1)
+    return TelegramChatParser(workers=os.cpu_count() or 1, cache_dir=DEFAULT_CACHE_DIR)
+
+
+def _load_snapshots(parser, snapshots):
+    """Загружает снимки в парсер; False - если какой-то не открылся"""
+    for path in snapshots:
+        try:
+            parser.load_snapshot(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"✗ Ошибка при чтении снимка {path}: {e}")
+            return False
+    return True
+
+
+def run_shard(output, filenames=(), db_path=None, shard=None, index=True):
+    """Режим узла: разбирает свои экспорты и записывает снимок для слияния
+    
+    С db_path в снимок попадает вся база вместе с загруженными файлами.
+    Возвращает код выхода.
+    """
+    parser = _open_parser(db_path)
+    try:
+        if filenames:
+            parser.load_files(filenames)
+        if not parser.file_sources:
+            print("✗ Нет загруженных сообщений: укажите файлы экспорта или базу с ними")
+            return 1
+        header = parser.save_snapshot(output, shard, index=index)
+        print(f"✓ Снимок узла {header['shards'][0]} сохранен в {output}")
+        return 0
+    finally:
+        if db_path:
+            parser.close()
+
+
+def run_merge(output, snapshots):
+    """Сливает снимки узлов в общий и печатает его сводку; возвращает код выхода"""
+    if not snapshots:
+        print("✗ Укажите снимки для слияния")
+        return 1
+    try:
+        header = merge_snapshots(snapshots, output)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"✗ Ошибка слияния снимков: {e}")
+        return 1
+    show_snapshot(header)
+    print(f"✓ Общий снимок сохранен в {output}")
+    return 0
+
+
+def main(db_path=None, snapshots=()):
+    parser = _open_parser(db_path)
+    if not _load_snapshots(parser, snapshots):
+        input("\nНажмите Enter для продолжения...")
+    loader = None
     
     while True:
+        # Когда фоновая загрузка закончилась, применяем текущие фильтры к новым данным
+        if loader and loader.done():
+            loader = None
+            if any(parser.current_filters.values()):
+                parser.filter_messages(**parser.current_filters)
+        loading = loader is not None
+        
         clear_console()
         print("\n" + "="*60)
         print("          TELEGRAM CHAT PARSER - МНОГОФАЙЛОВЫЙ")
@@ -535,10 +5284,14 @@ def main():
         print("4. Экспорт результатов")
         print("5. Показать статистику")
         print("6. Очистить все данные")
-        print("7. Выход")
+        print("7. Ход загрузки и отмена")
+        print("8. Производительность")
+        print("9. Выход")
         print("="*60)
         
         # Показываем статус загруженных файлов
+        if loading:
+            print(f"* Идет загрузка: {format_progress(loader)}")
         if parser.file_sources:
             print(f"* Загружено файлов: {len(parser.file_sources)}")
         else:
@@ -554,19 +5307,27 @@ def main():
         
         choice = input("Выберите опцию: ")
         
-        if choice == '1':
+        if loading and choice in ('3', '4', '5', '6'):
+            print("Дождитесь окончания загрузки или отмените ее (пункт 7)!")
+        
+        elif choice == '1':
             clear_console()
-            selected_files = choose_files()
-            if selected_files:
-                parser.load_files(selected_files)
-                # Автоматически применяем текущие фильтры к новым данным
-                if any(parser.current_filters.values()):
-                    parser.filter_messages(**parser.current_filters)
-                    print("Текущие фильтры применены к новым данным!")
+            if loading:
+                print("Загрузка уже идет, дождитесь ее окончания!")
+            else:
+                selected_files = choose_files()
+                if selected_files:
+                    incremental = False
+                    if parser.messages:
+                        incremental = input("Добавить только новые сообщения (пропустить уже загруженные)? (y/N): ").lower() == 'y'
+                    # Файлы загружаются в фоне, меню остается доступным
+                    loader = BackgroundLoader(parser, selected_files, incremental=incremental).start()
+                    print("Загрузка запущена. Ход загрузки - пункт 7")
         
         elif choice == '2':
             clear_console()
-            show_loaded_files(parser)
+            with parser.lock:
+                show_loaded_files(parser)
         
         elif choice == '3':
             if not parser.messages:
@@ -582,12 +5343,20 @@ def main():
                 print("\nФормат экспорта:")
                 print("1. JSON")
                 print("2. HTML")
+                print("3. Аналитика активности (JSON)")
                 format_choice = input("Выберите формат: ")
                 
                 if format_choice == '1':
-                    export_results(parser.current_results, 'json')
+                    export_results(parser.current_results, 'json', perf=parser.perf)
                 elif format_choice == '2':
-                    export_results(parser.current_results, 'html')
+                    page_size = input(f"Сообщений на странице (Enter - одна страница, например {EXPORT_PAGE_SIZE}): ")
+                    if page_size.isdigit() and int(page_size) > 0:
+                        export_results(parser.current_results, 'html', page_size=int(page_size), perf=parser.perf)
+                    else:
+                        export_results(parser.current_results, 'html', perf=parser.perf)
+                elif format_choice == '3':
+                    export_results(compute_analytics(parser, parser.current_filters.get('source_file')), 'json',
+                                   perf=parser.perf)
                 else:
                     print("Неверный выбор!")
         
@@ -599,10 +5368,31 @@ def main():
                 show_statistics(parser, parser.current_results, parser.current_filters)
         
         elif choice == '6':
-            parser.clear_data()
-            print("Все данные очищены!")
+            if isinstance(parser, SQLiteChatParser):
+                # База на диске очищается насовсем, а не только для этой сессии
+                confirm = input(f"Удалить все сообщения из базы {parser.db_path}? (y/N): ").lower() == 'y'
+            else:
+                confirm = True
+            if confirm:
+                parser.clear_data(confirm=True)
+                print("Все данные очищены!")
+            else:
+                print("Очистка отменена")
         
         elif choice == '7':
+            if loader:
+                show_loading(loader)
+            else:
+                print("Фоновая загрузка не идет")
+        
+        elif choice == '8':
+            show_performance(parser)
+            continue
+        
+        elif choice == '9':
+            if loading:
+                loader.cancel()
+                loader.wait()
             print("Выход из программы...")
             break
         
@@ -610,5 +5400,52 @@ def main():
             print("Неверный выбор!")
         input("\nНажмите Enter для продолжения...")
 
+
+def cli(argv=None):
+    """Разбор командной строки: интерактивное меню или пакетный режим"""
+    arg_parser = argparse.ArgumentParser(description="Анализ экспортов чатов Telegram")
+    arg_parser.add_argument('--db', help="хранить сообщения в базе SQLite")
+    arg_parser.add_argument('--batch', metavar='QUERIES',
+                            help="выполнить запросы из файла (JSON) без меню и выйти")
+    arg_parser.add_argument('files', nargs='*', help="файлы экспорта для пакетного режима")
+    arg_parser.add_argument('--output-dir', default='.', help="каталог для результатов запросов")
+    arg_parser.add_argument('--format', choices=('json', 'html'), default='json',
+                            help="формат результатов по умолчанию")
+    arg_parser.add_argument('--page-size', type=int, help="сообщений на странице HTML")
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help="добавлять только сообщения, которых еще нет")
+    arg_parser.add_argument('--shard', metavar='SNAPSHOT',
+                            help="разобрать файлы экспорта этого узла и записать снимок для слияния")
+    arg_parser.add_argument('--shard-name', help="имя узла в снимке (по умолчанию - имя машины)")
+    arg_parser.add_argument('--no-index', action='store_true',
+                            help="не сохранять в снимке текстовый индекс (он построится при открытии)")
+    arg_parser.add_argument('--merge', metavar='SNAPSHOT',
+                            help="слить снимки, перечисленные вместо файлов, в один общий")
+    arg_parser.add_argument('--open', metavar='SNAPSHOT', action='append', default=[],
+                            help="открыть снимок для меню или пакетного режима (можно несколько)")
+    args = arg_parser.parse_args(argv)
+    
+    modes = [mode for mode in ('batch', 'shard', 'merge') if getattr(args, mode) is not None]
+    if len(modes) > 1:
+        arg_parser.error("режимы --batch, --shard и --merge не совмещаются")
+    if args.open and args.db:
+        arg_parser.error("снимки открываются без базы SQLite (без --db)")
+    
+    if args.shard is not None:
+        return run_shard(args.shard, args.files, db_path=args.db, shard=args.shard_name, index=not args.no_index)
+    if args.merge is not None:
+        return run_merge(args.merge, args.files)
+    if args.batch is None:
+        if args.files:
+            arg_parser.error("файлы экспорта указываются вместе с --batch или --shard; в меню они выбираются пунктом 1")
+        main(args.db, args.open)
+        return 0
+    return run_batch(args.batch, args.files, db_path=args.db, output_dir=args.output_dir,
+                     format_type=args.format, page_size=args.page_size, incremental=args.incremental,
+                     snapshots=args.open)
+
 if __name__ == "__main__":
-    main()
+    # python telegram_analyzer.py --db archive.db - работать с базой SQLite;
+    # python telegram_analyzer.py --batch queries.json export.json ... - пакетный режим;
+    # --shard node.tgs export.json ... на каждом узле, --merge all.tgs node1.tgs node2.tgs и --open all.tgs
+    sys.exit(cli())
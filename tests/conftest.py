@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+
+def records(parser):
+    """Все сообщения парсера в памяти - словари вместе с сущностями"""
+    return [parser.messages.record_data(p) for p in range(len(parser.messages))]
+
+
+def dump_results(results):
+    """Результаты фильтров как списки словарей - для сравнения разных парсеров"""
+    dumped = {}
+    for section, value in results.items():
+        if section == 'term_matches':
+            dumped[section] = {term: [dict(m) for m in matches] for term, matches in value.items()}
+        else:
+            dumped[section] = [dict(m) for m in value]
+    return dumped
+
+
+@pytest.fixture
+def json_export(tmp_path):
+    """Создает синтетический JSON-экспорт: json_export(count, seed, name) -> путь"""
+    def make(count=300, seed=1, name='result.json'):
+        path = str(tmp_path / name)
+        benchmark.generate_json_export(path, count, seed)
+        return path
+    return make
+
+
+@pytest.fixture
+def html_export(tmp_path):
+    """Создает синтетический HTML-экспорт: html_export(count, pages, seed) -> список страниц"""
+    def make(count=300, pages=1, seed=1, directory='html'):
+        path = tmp_path / directory
+        path.mkdir(exist_ok=True)
+        return benchmark.generate_html_export(str(path), count, pages, seed)
+    return make
@@ -0,0 +1,43 @@
+import json
+from array import array
+
+import pytest
+
+import telegram_analyzer as ta
+
+
+@pytest.fixture
+def parser(json_export, html_export, tmp_path):
+    data = json.load(open(json_export(400), encoding='utf-8'))
+    # Сообщения без даты и до 1970 года (отрицательное время)
+    data['messages'] += [{'id': 1000, 'type': 'message', 'date': 'не дата', 'from': 'Алиса', 'text': 'a'},
+                         {'id': 1001, 'type': 'message', 'date': '1969-12-31T23:30:00', 'from': 'Новый',
+                          'text': 'b', 'reply_to_message_id': 1000}]
+    path = tmp_path / 'activity.json'
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+
+    parser = ta.TelegramChatParser()
+    parser.load_files([str(path), *html_export(300, pages=2)])
+    return parser
+
+
+def test_activity_numpy_matches_python(parser):
+    pytest.importorskip('numpy')
+    store = parser.messages
+    selections = [None, array('I'), array('I', [0]), array('I', range(0, len(store), 3)),
+                  *parser.indexes['source_file'].values()]
+    for positions in selections:
+        assert ta._activity_numpy(store, positions) == ta._activity_python(store, positions)
+
+    empty = ta.MessageStore()
+    assert ta._activity_numpy(empty, None) == ta._activity_python(empty, None)
+
+
+def test_analytics_without_numpy(parser, monkeypatch):
+    pytest.importorskip('numpy')
+    files = [None, *parser.file_sources]
+    with_numpy = [ta.compute_analytics(parser, source_file) for source_file in files]
+    monkeypatch.setattr(ta, 'np', None)
+    assert [ta.compute_analytics(parser, source_file) for source_file in files] == with_numpy
+    assert with_numpy[0]['messages'] == len(parser.messages)
+    assert with_numpy[0]['first_activity'] == '1969-12-31 23:30:00'
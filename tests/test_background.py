@@ -0,0 +1,191 @@
+import copy
+import json
+import threading
+
+import pytest
+
+import telegram_analyzer as ta
+
+from conftest import records
+
+
+def _load(parser, files, incremental=False):
+    loader = ta.BackgroundLoader(parser, files, incremental=incremental).start()
+    assert loader.wait(60)
+    return loader
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """Файлы тестового размера тоже делятся на куски для пула процессов"""
+    monkeypatch.setattr(ta, 'CHUNK_PARALLEL_THRESHOLD', 0)
+    submitted = []
+    submit = ta._submit_export
+
+    def recording(executor, filename, workers, stream_json):
+        futures = submit(executor, filename, workers, stream_json)
+        submitted.append((filename, len(futures)))
+        return futures
+
+    monkeypatch.setattr(ta, '_submit_export', recording)
+    return submitted
+
+
+def test_background_load_uses_worker_pool(json_export, html_export, small_chunks):
+    files = [json_export(400), *html_export(300, pages=2)]
+    serial = ta.TelegramChatParser()
+    serial.load_files(files)
+
+    parser = ta.TelegramChatParser(workers=3)
+    loader = _load(parser, files)
+
+    assert [entry['status'] for entry in loader.files] == ['загружен'] * 3
+    assert [filename for filename, _ in small_chunks] == files
+    assert all(chunks > 1 for _, chunks in small_chunks)
+    assert records(parser) == records(serial)
+    assert parser.file_sources == serial.file_sources
+    assert parser.token_frequencies().to_json() == serial.token_frequencies().to_json()
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_background_incremental_matches_load_files(json_export, tmp_path, workers, small_chunks):
+    full = json_export(300)
+    data = json.load(open(full, encoding='utf-8'))
+    head = tmp_path / 'head.json'
+    head.write_text(json.dumps(dict(data, messages=data['messages'][:120]), ensure_ascii=False), encoding='utf-8')
+
+    expected = ta.TelegramChatParser()
+    expected.load_files([str(head)], incremental=True)
+    expected.load_files([full], incremental=True)
+
+    parser = ta.TelegramChatParser(workers=workers)
+    _load(parser, [str(head)], incremental=True)
+    loader = _load(parser, [full], incremental=True)
+
+    assert loader.files[0]['status'] == 'новых 180, дубликатов 120'
+    assert parser.ingest_report == expected.ingest_report
+    assert records(parser) == records(expected)
+    assert parser.file_sources == expected.file_sources
+
+
+def test_background_incremental_reads_tail_outside_lock(json_export, tmp_path, monkeypatch):
+    full = json_export(300)
+    data = json.load(open(full, encoding='utf-8'))
+    head = tmp_path / 'head.json'
+    head.write_text(json.dumps(dict(data, messages=data['messages'][:100]), ensure_ascii=False), encoding='utf-8')
+    parser = ta.TelegramChatParser()
+    parser.load_files([str(head)], incremental=True)
+
+    lock_free = []
+    iter_tail = ta._iter_json_tail
+
+    def probe_lock():
+        acquired = parser.lock.acquire(timeout=1)
+        if acquired:
+            parser.lock.release()
+        lock_free.append(acquired)
+
+    def checking(filename, offset, *args):
+        for number, record in enumerate(iter_tail(filename, offset, *args)):
+            if number == 50:
+                # Другой поток (например, меню) может взять блокировку, пока хвост разбирается
+                probe = threading.Thread(target=probe_lock)
+                probe.start()
+                probe.join()
+            yield record
+
+    monkeypatch.setattr(ta, '_iter_json_tail', checking)
+    _load(parser, [full], incremental=True)
+    assert lock_free == [True]
+    assert parser.ingest_report[full] == {'new': 200, 'duplicates': 100}
+
+
+def test_background_incremental_failure_rolls_back(json_export, tmp_path, monkeypatch):
+    monkeypatch.setattr(ta, 'FREQUENCY_BATCH', 2000)
+    full = json_export(300)
+    data = json.load(open(full, encoding='utf-8'))
+    head = tmp_path / 'head.json'
+    head.write_text(json.dumps(dict(data, messages=data['messages'][:100]), ensure_ascii=False), encoding='utf-8')
+    parser = ta.TelegramChatParser()
+    parser.load_files([str(head)], incremental=True)
+    before = records(parser), copy.deepcopy(parser.file_sources), copy.deepcopy(parser.token_frequencies().to_json())
+
+    def failing(filename, chat, staged, duplicates, merge_new=parser._merge_new):
+        def broken():
+            for number, record in enumerate(staged):
+                if number == 150:
+                    raise ValueError('сбой слияния')
+                yield record
+        return merge_new(filename, chat, broken(), duplicates)
+
+    monkeypatch.setattr(parser, '_merge_new', failing)
+    loader = _load(parser, [full], incremental=True)
+
+    assert loader.files[0]['status'] == 'ошибка: сбой слияния'
+    assert (records(parser), parser.file_sources, parser.token_frequencies().to_json()) == before
+    assert full not in parser.file_chats
+
+
+def test_background_progress_reaches_totals(json_export, html_export):
+    files = [json_export(400), *html_export(300, pages=2)]
+    parser = ta.TelegramChatParser()
+    loader = _load(parser, files)
+
+    progress = loader.progress()
+    assert progress['files_done'] == progress['files_total'] == 3
+    assert progress['bytes'] == progress['bytes_total'] > 0
+    assert progress['messages'] == sum(stats['message_count'] for stats in parser.file_sources.values())
+    assert progress['eta'] is None
+    assert [entry['messages'] for entry in loader.files] == [parser.file_sources[f]['message_count'] for f in files]
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_background_cancel_keeps_parser_unchanged(backend, json_export, tmp_path, monkeypatch):
+    first, second = json_export(300, name='first.json'), json_export(300, seed=2, name='second.json')
+    if backend == 'sqlite':
+        parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    else:
+        parser = ta.TelegramChatParser()
+    parser.load_files([first])
+    before = records(parser) if backend == 'memory' else len(parser.messages)
+    stats = copy.deepcopy(parser.file_sources)
+    frequencies = copy.deepcopy(parser.token_frequencies().to_json())
+
+    # Отмена приходит посреди разбора второго файла
+    monkeypatch.setattr(ta, 'PROGRESS_INTERVAL', 10)
+    add_message = ta._StagingParser._add_message
+
+    def cancelling(self, msg_data):
+        if self.progress['messages'] == 150:
+            loader.cancel()
+        add_message(self, msg_data)
+
+    monkeypatch.setattr(ta._StagingParser, '_add_message', cancelling)
+    loader = ta.BackgroundLoader(parser, [second, first])
+    loader.start()
+    assert loader.wait(60)
+
+    assert [entry['status'] for entry in loader.files] == ['отменен', 'отменен']
+    assert loader.files[0]['messages'] < 300
+    assert (records(parser) if backend == 'memory' else len(parser.messages)) == before
+    assert parser.file_sources == stats
+    assert parser.token_frequencies().to_json() == frequencies
+    if backend == 'sqlite':
+        parser.close()
+
+
+def test_background_cancel_with_worker_pool(json_export, small_chunks):
+    files = [json_export(300, seed=seed, name=f'{seed}.json') for seed in range(4)]
+    parser = ta.TelegramChatParser(workers=2)
+    loader = ta.BackgroundLoader(parser, files).start()
+    loader.cancel()
+    assert loader.wait(60)
+
+    # Каждый файл либо загружен целиком, либо не оставил следов
+    for entry in loader.files:
+        if entry['status'] == 'загружен':
+            assert parser.file_sources[entry['filename']]['message_count'] == 300
+        else:
+            assert entry['status'] == 'отменен'
+            assert entry['filename'] not in parser.file_sources
+    assert len(parser.messages) == 300 * len(parser.file_sources)
@@ -0,0 +1,169 @@
+import json
+import os
+
+import pytest
+
+import telegram_analyzer as ta
+
+from conftest import dump_results
+
+
+def _queries_file(tmp_path, data):
+    path = str(tmp_path / 'queries.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    return path
+
+
+@pytest.mark.parametrize('query, error', [
+    ({'thread_depth': -1}, 'thread_depth'),
+    ({'thread_depth': '2'}, 'thread_depth'),
+    ({'thread_depth': True}, 'thread_depth'),
+    ({'page_size': 0}, 'page_size'),
+    ({'page_size': 2.5}, 'page_size'),
+    ({'target_user': 5}, 'target_user'),
+    ({'source_file': ['a.json']}, 'source_file'),
+    ({'keyword': {'x': 1}}, 'keyword'),
+    ({'target_message_id': '5'}, 'target_message_id'),
+    ({'terms': 'код'}, 'terms'),
+    ({'terms': ['(код'], 'terms_regex': True}, 'неверное выражение'),
+    ({'terms_regex': 'yes'}, 'terms_regex'),
+    ({'date_from': 'вчера'}, 'date_from'),
+    ({'date_to': [2023]}, 'date_to'),
+    ({'date_from': '2023-02-01', 'date_to': '2023-01-01'}, 'date_from позже'),
+    ({'format': 'xml'}, 'формат'),
+    ({'name': ''}, 'name'),
+    ({'name': '../out'}, 'name'),
+    ({'color': 'red'}, 'неизвестные ключи'),
+])
+def test_invalid_query_is_reported(tmp_path, query, error):
+    path = _queries_file(tmp_path, [{'keyword': 'привет'}, query])
+    with pytest.raises(ValueError, match=error):
+        ta.read_batch_queries(path)
+
+
+def test_all_errors_are_reported_together(tmp_path):
+    path = _queries_file(tmp_path, {
+        'defaults': {'thread_depth': -1},
+        'queries': [{'name': 'a'}, {'name': 'b', 'page_size': -5}, 'c', {'name': 'ok', 'thread_depth': 1}],
+    })
+    with pytest.raises(ValueError) as e:
+        ta.read_batch_queries(path)
+    lines = str(e.value).splitlines()
+    assert lines == [
+        'запрос a: thread_depth должен быть неотрицательным целым числом',
+        'запрос b: page_size должен быть положительным целым числом',
+        'запрос b: thread_depth должен быть неотрицательным целым числом',
+        'запрос 3: ожидается объект',
+    ]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def parser(request, json_export, html_export, tmp_path):
+    files = [json_export(400), *html_export(300, pages=2)]
+    if request.param == 'sqlite':
+        parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    else:
+        parser = ta.TelegramChatParser()
+    parser.load_files(files)
+    yield parser
+    if request.param == 'sqlite':
+        parser.close()
+
+
+def test_filter_batch_matches_filter_messages(parser):
+    files = list(parser.file_sources)
+    user = sorted(parser.file_sources[files[0]]['users'])[0]
+    queries = [
+        {'target_user': user},
+        {'target_user': user, 'source_file': files[1], 'keyword': 'ет'},
+        {'keyword': 'привет', 'date_from': '2023-01-02', 'date_to': '2023-01-20'},
+        {'target_message_id': 5, 'thread_depth': 0},
+        {'target_message_id': 5, 'thread_depth': 2, 'source_file': files[0]},
+        {'terms': ['встреча', 'код'], 'keyword': 'код'},
+        {'terms': [r'\bкод\w*', r'встреч[аи]'], 'terms_regex': True, 'date_from': '2023-01-05'},
+    ]
+    batch = parser.filter_batch(queries)
+    assert len(batch) == len(queries)
+    for query, results in zip(queries, batch):
+        assert dump_results(results) == dump_results(parser.filter_messages(**query)), query
+
+
+
+def test_filter_batch_serves_selective_keywords_from_index(parser, monkeypatch):
+    files = list(parser.file_sources)
+    scans, indexed = [], []
+    batch_rows, index_matches = parser._batch_rows, parser._index_matches
+
+    def recording_rows(source_files, with_text):
+        scans.append(source_files)
+        return batch_rows(source_files, with_text)
+
+    def recording_index(keyword, source_file, limit):
+        matches = index_matches(keyword, source_file, limit)
+        if matches is not None:
+            indexed.append((keyword, source_file))
+        return matches
+
+    monkeypatch.setattr(parser, '_batch_rows', recording_rows)
+    monkeypatch.setattr(parser, '_index_matches', recording_index)
+
+    # Редкие подстроки: кандидатов в индексе меньше BATCH_INDEX_SHARE сообщений
+    selective = [{'keyword': '#релиз'}, {'keyword': 'T.ME', 'source_file': files[1]}, {'keyword': 'нет такого'},
+                 {'terms': ['#релиз', 't.me'], 'source_file': files[0]}]
+    batch = parser.filter_batch(selective)
+    assert scans == []
+    assert len(indexed) == 5
+    for query, results in zip(selective, batch):
+        assert dump_results(results) == dump_results(parser.filter_messages(**query)), query
+    assert len(batch[0]['keyword_matches']) > 0
+
+    # Частые и короткие подстроки и регулярки ищутся общим проходом, редкие - по индексу
+    indexed.clear()
+    mixed = [{'keyword': 'привет'}, {'keyword': 'ет', 'source_file': files[0]}, {'keyword': '#релиз'},
+             {'terms': [r'релиз\b', 't.me'], 'terms_regex': True}]
+    batch = parser.filter_batch(mixed)
+    assert len(scans) == 1
+    assert indexed == [('#релиз', None)]
+    for query, results in zip(mixed, batch):
+        assert dump_results(results) == dump_results(parser.filter_messages(**query)), query
+
+def test_run_batch_writes_every_query(json_export, tmp_path):
+    path = json_export(300)
+    queries = _queries_file(tmp_path, {
+        'defaults': {'source_file': 'result.json'},
+        'queries': [
+            {'name': 'hello', 'keyword': 'привет'},
+            {'name': 'sub/terms', 'terms': ['встреча', 'код'], 'format': 'html', 'page_size': 20},
+        ],
+    })
+    output = str(tmp_path / 'out')
+    assert ta.run_batch(queries, [path], output_dir=output) == 0
+
+    parser = ta.TelegramChatParser()
+    parser.load_files([path])
+    ta.export_results(parser.filter_messages(keyword='привет', source_file=path), 'json',
+                      filename=str(tmp_path / 'expected'))
+    with open(os.path.join(output, 'hello.json'), encoding='utf-8') as f:
+        assert json.load(f) == json.load(open(tmp_path / 'expected.json', encoding='utf-8'))
+    assert os.path.exists(os.path.join(output, 'sub', 'terms.html'))
+
+
+def test_run_batch_failed_query_does_not_stop_others(json_export, tmp_path, monkeypatch):
+    path = json_export(300)
+    queries = _queries_file(tmp_path, [
+        {'name': 'missing', 'source_file': 'other.json'},
+        {'name': 'broken', 'keyword': 'код'},
+        {'name': 'hello', 'keyword': 'привет'},
+    ])
+    filter_batch = ta.TelegramChatParser.filter_batch
+
+    def failing(self, queries):
+        if any(query.get('keyword') == 'код' for query in queries):
+            raise RuntimeError('сбой выборки')
+        return filter_batch(self, queries)
+
+    monkeypatch.setattr(ta.TelegramChatParser, 'filter_batch', failing)
+    output = str(tmp_path / 'out')
+    assert ta.run_batch(queries, [path], output_dir=output) == 1
+    assert sorted(os.listdir(output)) == ['hello.json']
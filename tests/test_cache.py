@@ -0,0 +1,66 @@
+import os
+
+import telegram_analyzer as ta
+
+from conftest import records, dump_results
+
+
+def _entries(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.tgc'))
+
+
+def test_cache_round_trip(json_export, html_export, tmp_path):
+    files = [json_export(300), *html_export(200, pages=2)]
+    cache_dir = str(tmp_path / 'cache')
+    parsed = ta.TelegramChatParser(cache_dir=cache_dir)
+    parsed.load_files(files)
+    assert len(_entries(cache_dir)) == 3
+
+    cached = ta.TelegramChatParser(cache_dir=cache_dir)
+    cached.load_files(files)
+    assert 'cache' in cached.perf.stages and 'parse' not in cached.perf.stages
+    assert records(cached) == records(parsed)
+    assert cached.file_sources == parsed.file_sources
+    for filters in ({'keyword': 'привет'}, {'keyword': 'ет'}, {'terms': ['встреча', 'код']}):
+        assert dump_results(cached.filter_messages(**filters)) == dump_results(parsed.filter_messages(**filters))
+
+
+def test_cache_segments_release_mapping(json_export, tmp_path):
+    path = json_export(200)
+    cache_dir = str(tmp_path / 'cache')
+    ta.TelegramChatParser(cache_dir=cache_dir).load_files([path])
+
+    parser = ta.TelegramChatParser(cache_dir=cache_dir)
+    parser.load_files([path])
+    segment, = parser.text_index.segments
+    source = segment.source
+    assert source._mm is not None
+
+    parser.clear_data()
+    assert segment.source is None
+    assert source._mm is None
+
+
+def test_stale_cache_entry_is_closed_and_removed(json_export, tmp_path):
+    path = json_export(200)
+    cache = ta.ParseCache(str(tmp_path / 'cache'))
+    parser = ta.TelegramChatParser(cache_dir=cache.directory)
+    parser.load_files([path])
+    assert len(_entries(cache.directory)) == 1
+
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('\n')
+    assert cache.open(path) is None
+    assert _entries(cache.directory) == []
+
+
+def test_evict_keeps_entry_just_written(json_export, tmp_path):
+    first, second = json_export(200, name='first.json'), json_export(200, seed=2, name='second.json')
+    cache_dir = str(tmp_path / 'cache')
+    parser = ta.TelegramChatParser(cache_dir=cache_dir, cache_max_bytes=1)
+    parser.load_files([first, second])
+
+    cache = ta.ParseCache(cache_dir)
+    assert _entries(cache_dir) == [os.path.basename(cache._entry_path(second))]
+    with cache.open(second) as entry:
+        assert entry.header['messages']['count'] == 200
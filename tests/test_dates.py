@@ -0,0 +1,104 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import telegram_analyzer as ta
+
+
+def _utc(*args):
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+
+def test_parse_date_time_zones():
+    assert ta.parse_date('15.09.2023 10:30:00 UTC+03:00') == _utc(2023, 9, 15, 7, 30)
+    assert ta.parse_date('15.09.2023 10:30:00 UTC-05:30') == _utc(2023, 9, 15, 16, 0)
+    assert ta.parse_date('1.2.2023 0:05 UTC+0300') == _utc(2023, 1, 31, 21, 5)
+    assert ta.parse_date('15.09.2023 10:30:00') == _utc(2023, 9, 15, 10, 30)
+    assert ta.parse_date('2023-09-15T10:30:00') == _utc(2023, 9, 15, 10, 30)
+    assert ta.parse_date('2023-09-15T10:30:00+03:00') == _utc(2023, 9, 15, 7, 30)
+    for value in ('', None, 'вчера', '31.02.2023 10:00:00', 42):
+        assert ta.parse_date(value) is None
+
+
+def test_html_dates_are_shifted_to_utc(json_export, html_export):
+    parsed = {}
+    for kind, files in (('json', [json_export(200)]), ('html', html_export(200, pages=2))):
+        parser = ta.TelegramChatParser()
+        parser.load_files(files)
+        parsed[kind] = {msg['id']: parser.messages.timestamps[p] for p, msg in enumerate(parser.messages)}
+
+    # Генератор пишет одно и то же местное время: в JSON как UTC, в HTML с поясом UTC+03:00
+    # (у служебных сообщений HTML-экспорта даты нет)
+    dated = {message_id: timestamp for message_id, timestamp in parsed['html'].items() if timestamp != ta._NO_VALUE}
+    assert len(dated) > 150
+    assert {message_id: parsed['json'][message_id] - 3 * 60 * 60 for message_id in dated} == dated
+
+
+def test_date_bound_end_includes_whole_day():
+    assert ta._date_bound('2023-01-05') == _utc(2023, 1, 5)
+    assert ta._date_bound('2023-01-05', end=True) == _utc(2023, 1, 5, 23, 59, 59)
+    assert ta._date_bound('05.01.2023', end=True) == _utc(2023, 1, 5, 23, 59, 59)
+    assert ta._date_bound('2023-01-05 12:00', end=True) == _utc(2023, 1, 5, 12)
+    assert ta._date_bound('05.01.2023 12:00 UTC+03:00', end=True) == _utc(2023, 1, 5, 9)
+    assert ta._date_bound(datetime(2023, 1, 5), end=True) == _utc(2023, 1, 5)
+    assert ta._date_bound(1000, end=True) == 1000
+    assert ta._date_bound('') is None
+    with pytest.raises(ValueError):
+        ta._date_bound('не дата')
+
+
+@pytest.fixture
+def exports(json_export, tmp_path):
+    """Экспорт с сообщениями вне хронологического порядка и на границах суток"""
+    data = json.load(open(json_export(400), encoding='utf-8'))
+    extra = ['2023-01-05T00:00:00', '2023-01-05T23:59:59', '2023-01-06T00:00:00', '2022-12-31T23:59:59',
+             '2023-01-03T12:00:00', 'не дата']
+    for number, date in enumerate(extra):
+        data['messages'].append({'id': 1000 + number, 'type': 'message', 'date': date, 'from': 'Алиса',
+                                 'text': 'привет'})
+    path = tmp_path / 'dates.json'
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+
+    # Второй файл добавляется позже, но его сообщения раньше уже загруженных
+    early = dict(data, name='Другой чат', messages=[dict(msg, date=msg['date'].replace('2023-01-0', '2022-11-0'))
+                                                    for msg in data['messages'][:50]])
+    other = tmp_path / 'early.json'
+    other.write_text(json.dumps(early, ensure_ascii=False), encoding='utf-8')
+    return str(path), str(other)
+
+
+PERIODS = [('2023-01-05', '2023-01-05'), ('2023-01-01', None), (None, '2023-01-03'), ('2022-11-01', '2023-01-02'),
+           ('2023-01-05 23:59:59', '2023-01-06'), ('2023-01-01 09:00', '2023-01-01 10:00'), ('2024-01-01', None)]
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_period_filter_matches_linear_scan(exports, tmp_path, backend):
+    if backend == 'sqlite':
+        parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    else:
+        parser = ta.TelegramChatParser()
+    parser.load_files(exports[:1])
+    parser.filter_messages(date_from='2023-01-01')
+    parser.load_files(exports[1:], incremental=True)
+
+    messages = [dict(msg) for msg in parser.messages]
+    assert sum(msg['date'].startswith('2022-11') for msg in messages) == 50
+    for date_from, date_to in PERIODS:
+        start, end = ta._date_bound(date_from), ta._date_bound(date_to, end=True)
+        expected = [msg for msg in messages if ta.parse_date(msg['date']) is not None
+                    and (start is None or ta.parse_date(msg['date']) >= start)
+                    and (end is None or ta.parse_date(msg['date']) <= end)]
+        results = parser.filter_messages(date_from=date_from, date_to=date_to)
+        assert [dict(msg) for msg in results['date_messages']] == expected, (date_from, date_to)
+
+        results = parser.filter_messages(keyword='привет', source_file=exports[0], date_from=date_from,
+                                         date_to=date_to)
+        assert [dict(msg) for msg in results['keyword_matches']] == \
+            [msg for msg in expected if msg['source_file'] == exports[0] and 'привет' in msg['text']]
+
+    day = parser.filter_messages(date_from='2023-01-05', date_to='2023-01-05')['date_messages']
+    assert {'2023-01-05T00:00:00', '2023-01-05T23:59:59'} <= {msg['date'] for msg in day}
+    assert '2023-01-06T00:00:00' not in {msg['date'] for msg in day}
+    if backend == 'sqlite':
+        parser.close()
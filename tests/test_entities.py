@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+import telegram_analyzer as ta
+
+
+_PARTS = [
+    'Смотри ',
+    {'type': 'link', 'text': 'https://Example.com/Путь'},
+    ' и ',
+    {'type': 'text_link', 'text': 'Эту Ссылку', 'href': 'https://t.me/канал'},
+    ', ',
+    {'type': 'bold', 'text': 'ЖИРНЫЙ 😀 текст'},
+    ' ',
+    {'type': 'italic', 'text': 'Straße'},
+    ' ',
+    {'type': 'mention', 'text': '@Alice'},
+    {'type': 'hashtag', 'text': '#Тег'},
+    {'type': 'custom_emoji', 'document_id': 1},
+    {'type': 'link', 'text': ''},
+    {'type': 'text_link', 'text': 'без адреса'},
+    ' конец',
+]
+
+
+def test_flatten_text_keeps_text_and_entity_spans():
+    text, entities = ta._flatten_text(_PARTS)
+    assert text == ''.join(part if isinstance(part, str) else part.get('text', '') for part in _PARTS)
+
+    kept = [part for part in _PARTS if isinstance(part, dict) and part.get('type') in ta.TEXT_ENTITY_TYPES
+            and part.get('text')]
+    assert [entity[0] for entity in entities] == [part['type'] for part in kept]
+    assert [text[start:end] for _, start, end, *_ in entities] == [part['text'] for part in kept]
+    assert [entity[3:] for entity in entities] == [(), ('https://t.me/канал',), (), (), ()]
+
+    assert ta._flatten_text('просто текст') == ('просто текст', None)
+    assert ta._flatten_text([{'type': 'bold', 'text': 'жирный'}]) == ('жирный', None)
+    assert ta._flatten_text([]) == ('', None)
+
+
+@pytest.fixture
+def export(json_export, tmp_path):
+    data = json.load(open(json_export(100), encoding='utf-8'))
+    data['messages'] += [
+        {'id': 500, 'type': 'message', 'date': '2023-02-01T10:00:00', 'from': 'Алиса', 'text': _PARTS},
+        {'id': 501, 'type': 'message', 'date': '2023-02-01T10:01:00', 'from': 'Борис',
+         'text': [{'type': 'hashtag', 'text': '#Тег'}, ' и ', {'type': 'bold', 'text': 'ЭТУ'}]},
+    ]
+    path = tmp_path / 'entities.json'
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture(params=['memory', 'stream', 'sqlite'])
+def parser(request, export, tmp_path):
+    if request.param == 'sqlite':
+        parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    else:
+        parser = ta.TelegramChatParser(stream_json=request.param == 'stream')
+    parser.load_files([export])
+    yield parser
+    if request.param == 'sqlite':
+        parser.close()
+
+
+def _entities(parser, message_id):
+    if isinstance(parser, ta.SQLiteChatParser):
+        row, = parser.db.execute('SELECT entities FROM messages WHERE id = ?', (message_id,))
+        return [tuple(entity) for entity in json.loads(row[0])]
+    position, = parser.indexes['id'][message_id]
+    return parser.messages.record_data(position)['entities']
+
+
+def test_loaded_messages_keep_entities(parser):
+    text, entities = ta._flatten_text(_PARTS)
+    message, = [dict(msg) for msg in parser.messages if msg['id'] == 500]
+    assert message['text'] == text
+    assert _entities(parser, 500) == entities
+    assert _entities(parser, 501) == [('hashtag', 0, 4)]
+
+
+@pytest.mark.parametrize('keyword, expected', [
+    ('example.com/путь', [500]),
+    ('эту ссылку', [500]),
+    ('жирный 😀', [500]),
+    ('strasse', [500]),
+    ('@alice#тег', [500]),
+    ('#тег', [500, 501]),
+    ('тег и эту', [501]),
+    ('путь и эту', [500]),
+    ('без адреса конец', [500]),
+])
+def test_keyword_matches_inside_entities(parser, keyword, expected):
+    matches = parser.filter_messages(keyword=keyword)['keyword_matches']
+    assert [msg['id'] for msg in matches if msg['id'] >= 500] == expected
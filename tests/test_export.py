@@ -0,0 +1,62 @@
+import json
+import os
+import re
+
+import pytest
+
+import telegram_analyzer as ta
+
+from conftest import dump_results
+
+
+@pytest.fixture
+def parser(json_export):
+    parser = ta.TelegramChatParser()
+    parser.load_files([json_export(300)])
+    return parser
+
+
+def _dates(page):
+    return re.findall(r'<div class="date">(.*?)</div>', page)
+
+
+def test_json_export_matches_json_dump(parser, tmp_path):
+    for filters in ({'keyword': 'привет', 'terms': ['встреча', 'код', 'нет такого'], 'target_user': 'Алиса'},
+                    {'keyword': 'нет такого'}):
+        results = parser.filter_messages(**filters)
+        ta.export_results(results, 'json', filename=str(tmp_path / 'out'))
+
+        written = open(tmp_path / 'out.json', encoding='utf-8').read()
+        assert written == json.dumps(dump_results(results), ensure_ascii=False, indent=2)
+        assert json.loads(written) == dump_results(results)
+
+
+@pytest.mark.parametrize('page_size', [1, 7, 10, 1000])
+def test_html_pages_split_sections(parser, tmp_path, page_size):
+    results = parser.filter_messages(keyword='привет', terms=['встреча', 'код'])
+    sections = ta._export_sections(results)
+    counts = [len(messages) for _, messages in sections]
+    assert counts and all(counts)
+
+    filename = str(tmp_path / 'out')
+    ta.export_results(results, 'html', page_size=page_size, filename=filename)
+
+    index = open(filename + '.html', encoding='utf-8').read()
+    links = re.findall(r'<a href="(out\d+\.html)">', index)
+    assert links == [f'out{n}.html' for n in range(2, len(links) + 2)]
+    assert len(links) == sum(-(-count // page_size) for count in counts)
+    assert not os.path.exists(tmp_path / f'out{len(links) + 2}.html')
+
+    # Страницы раздела идут подряд и делят его сообщения на куски по page_size
+    number = 2
+    for (heading, messages), count in zip(sections, counts):
+        pages = -(-count // page_size)
+        dates = [msg['date'] for msg in messages]
+        for k in range(pages):
+            page = open(tmp_path / f'out{number}.html', encoding='utf-8').read()
+            assert heading in page
+            assert f'{k + 1} / {pages}' in page
+            assert _dates(page) == dates[k * page_size:(k + 1) * page_size]
+            assert ('Назад' in page) == (k > 0)
+            assert ('Вперед' in page) == (k + 1 < pages)
+            number += 1
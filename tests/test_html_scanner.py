@@ -0,0 +1,50 @@
+import random
+
+import telegram_analyzer as ta
+
+
+def _html_records(html, soup=False):
+    parser = ta.TelegramChatParser()
+    if soup:
+        parser._parse_html_soup(html, 'messages.html')
+    else:
+        parser.parse_html(html, 'messages.html')
+    return [dict(msg) for msg in parser.messages]
+
+
+def _fuzzed_html(rng, count):
+    """Сообщения с пробельными узлами, вложенной разметкой, pre и комментариями"""
+    spaces = ['', ' ', '\n', '\n\n', '\t', ' \n ', '\r\n', '&#32;', '&nbsp;']
+    pieces = ['in', 'слово', '<b>жирный</b>', '<br>', '<a href="#">ссылка</a>', '<!-- c -->',
+              '<pre>  \n  код\n</pre>', '<pre>\n\n</pre>', '<div>in</div>', '<i> </i>', '&amp;']
+    messages = []
+    for number in range(1, count + 1):
+        body = ''.join(rng.choice(spaces) + rng.choice(pieces) for _ in range(rng.randint(0, 6)))
+        reply = (f'<div class="reply_to details">В ответ на <a href="#go_to_message{number - 1}" '
+                 f'onclick="return GoToMessage({number - 1})">это сообщение</a></div>' if rng.random() < 0.3 else '')
+        messages.append(f'<div class="message default" id="message{number}">{rng.choice(spaces)}'
+                        f'<div class="from_name">{rng.choice(spaces)}Alice{rng.choice(spaces)}</div>\n'
+                        f'<div class="date" title="15.09.2023 10:30:00 UTC+03:00">10:30</div>{reply}'
+                        f'<div class="text">{body}{rng.choice(spaces)}</div>{rng.choice(spaces)}</div>')
+    return '<html><body><div class="history">\n' + '\n'.join(messages) + '\n</div></body></html>'
+
+
+def test_html_scanner_collapses_whitespace_like_soup():
+    html = ('<div class="message" id="message1"><div class="text">'
+            '<div>in</div>\n\n<div>in</div><pre>a\n\n</pre> \n <pre>\n\n</pre>x</div></div>')
+    scanned = _html_records(html)
+    assert scanned == _html_records(html, soup=True)
+    assert scanned[0]['text'] == 'in\nina\n\n\n\n\nx'
+
+
+def test_html_scanner_matches_soup_on_fuzzed_markup():
+    rng = random.Random(7)
+    for _ in range(400):
+        html = _fuzzed_html(rng, 5)
+        assert _html_records(html) == _html_records(html, soup=True), html
+
+
+def test_html_scanner_matches_soup_on_generated_exports(html_export):
+    for path in html_export(400, pages=2):
+        html = open(path, encoding='utf-8').read()
+        assert _html_records(html) == _html_records(html, soup=True)
@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+import telegram_analyzer as ta
+
+
+def _json_slice(source, path, ids):
+    """Копия JSON-экспорта только с сообщениями из ids, в порядке ids"""
+    data = json.load(open(source, encoding='utf-8'))
+    by_id = {msg['id']: msg for msg in data['messages']}
+    data['messages'] = [by_id[message_id] for message_id in ids]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    return str(path)
+
+
+def _make_parser(backend, tmp_path):
+    if backend == 'sqlite':
+        return ta.SQLiteChatParser(str(tmp_path / 'chat.db'), stream_json=True)
+    return ta.TelegramChatParser(stream_json=True)
+
+
+def _loaded_ids(parser):
+    if isinstance(parser, ta.SQLiteChatParser):
+        return sorted(row[0] for row in parser.db.execute('SELECT id FROM messages'))
+    return sorted(parser.messages.value(p, 'id') for p in range(len(parser.messages)))
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request):
+    return request.param
+
+
+def test_incremental_overlapping_ranges(backend, json_export, tmp_path):
+    full = json_export(300)
+    middle = _json_slice(full, tmp_path / 'middle.json', range(100, 201))
+    everything = _json_slice(full, tmp_path / 'everything.json', range(1, 301))
+
+    parser = _make_parser(backend, tmp_path)
+    parser.load_files([middle], incremental=True)
+    parser.load_files([everything], incremental=True)
+
+    assert parser.ingest_report[everything] == {'new': 199, 'duplicates': 101}
+    assert _loaded_ids(parser) == list(range(1, 301))
+
+
+def test_incremental_skips_loaded_prefix_only(backend, json_export, tmp_path):
+    full = json_export(300)
+    head = _json_slice(full, tmp_path / 'head.json', [i for i in range(1, 151) if i % 10])
+    everything = _json_slice(full, tmp_path / 'everything.json', range(1, 301))
+
+    parser = _make_parser(backend, tmp_path)
+    parser.load_files([head], incremental=True)
+    parser.load_files([everything], incremental=True)
+
+    assert parser.ingest_report[everything] == {'new': 165, 'duplicates': 135}
+    assert _loaded_ids(parser) == list(range(1, 301))
+
+
+def test_incremental_out_of_order(backend, json_export, tmp_path):
+    full = json_export(200)
+    late = _json_slice(full, tmp_path / 'late.json', range(150, 201))
+    shuffled = _json_slice(full, tmp_path / 'shuffled.json', list(range(101, 201)) + list(range(1, 101)))
+
+    parser = _make_parser(backend, tmp_path)
+    parser.load_files([late], incremental=True)
+    parser.load_files([shuffled], incremental=True)
+
+    assert parser.ingest_report[shuffled] == {'new': 149, 'duplicates': 51}
+    assert _loaded_ids(parser) == list(range(1, 201))
+
+
+def test_incremental_html_pages(backend, html_export, tmp_path):
+    pages = html_export(300, pages=3)
+    parser = _make_parser(backend, tmp_path)
+    parser.load_files([pages[1]], incremental=True)
+    parser.load_files(pages, incremental=True)
+
+    # Страница целиком загружена - пропускается без разбора, разделители дат не считаются
+    assert parser.ingest_report[pages[1]] == {'new': 0, 'duplicates': 100}
+    assert parser.ingest_report[pages[0]]['new'] > 0
+    assert len([i for i in _loaded_ids(parser) if i > 0]) == 300
+
+
+def test_json_tail_is_streamed(json_export):
+    path = json_export(300)
+    messages = json.load(open(path, encoding='utf-8'))['messages']
+    expected = [ta._json_message_record(msg, path) for msg in messages[150:]]
+
+    records, skipped = ta._read_tail(path, 150, len)
+    assert skipped == 150
+    assert not isinstance(records, list)
+    assert list(records) == expected
+
+    offset, _ = ta._json_tail(open(path, 'rb').read(), 150, len)
+    assert list(ta._iter_json_tail(path, offset, chunk_size=50)) == expected
+    assert list(ta._iter_json_tail(path, os.path.getsize(path))) == []
@@ -0,0 +1,53 @@
+import json
+import random
+from collections import Counter
+
+import telegram_analyzer as ta
+
+
+def _random_texts(rng, count):
+    alphabet = 'abcабв де ё😀#@_1́\ud800'
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))) for _ in range(count)]
+
+
+def _segment(texts, base=100):
+    segment = ta._TextSegment(base)
+    for i, text in enumerate(texts):
+        if text:
+            segment.add(base + i, text)
+    return segment
+
+
+def test_trigram_batches_match_per_message(monkeypatch):
+    texts = _random_texts(random.Random(5), 500)
+    expected = {}
+    for i, text in enumerate(texts):
+        for trigram in {text[j:j + 3] for j in range(len(text) - 2)}:
+            expected.setdefault(trigram, []).append(i)
+
+    monkeypatch.setattr(ta, 'TRIGRAM_BATCH', 700)
+    for numpy in (ta.np, None):
+        monkeypatch.setattr(ta, 'np', numpy)
+        segment = _segment(texts)
+        assert {key: list(postings) for key, postings in segment.trigrams.items()} == expected
+        assert list(segment.short) == [i for i, text in enumerate(texts) if 0 < len(text) < 3]
+
+
+def test_frequencies_match_exact_count(json_export, monkeypatch):
+    monkeypatch.setattr(ta, 'FREQUENCY_BATCH', 5000)
+    path = json_export(600)
+    parser = ta.TelegramChatParser(frequency_error=None)
+    parser.load_files([path])
+
+    words, users = Counter(), {}
+    for msg in json.load(open(path, encoding='utf-8'))['messages']:
+        text = ta._search_form(ta._json_message_record(msg, path)['text'])
+        for tag, word in ta._FREQUENCY_TOKEN_RE.findall(text):
+            if len(word) >= ta.FREQUENCY_MIN_WORD and not word.isdigit():
+                words[word] += 1
+                users.setdefault(msg.get('from', 'Unknown'), Counter())[word] += 1
+
+    frequencies = parser.frequencies[path]
+    assert dict(frequencies.chat['words'].counts) == dict(words)
+    for author, counts in users.items():
+        assert dict(frequencies.users[author]['words'].counts) == dict(counts)
@@ -0,0 +1,49 @@
+import random
+import re
+
+import telegram_analyzer as ta
+
+
+def _separately(terms, text):
+    return {i for i, term in enumerate(terms) if re.search(term, text, re.IGNORECASE)}
+
+
+def test_regex_matcher_combines_simple_terms():
+    terms = [r'\bкод\w*', 'встреч[аи]', '(да|нет)!']
+    matcher = ta.RegexPatternMatcher(terms)
+    assert matcher.combined is not None
+    for text in ('код готов', 'до встречи', 'да!', 'ничего'):
+        assert matcher.find(text) == _separately(terms, text)
+
+
+def test_regex_matcher_backreferences_and_flags():
+    cases = [
+        [r'(\w)\1', 'zz'],
+        ['(a)b', r'(c)\1'],
+        [r'(?P<w>\w+) (?P=w)', 'x'],
+        ['(?P<w>a)', '(?P<w>b)'],
+        [r'(a)?(?(1)b|c)', 'q'],
+        ['(?x) a b c', 'a b'],
+        ['(?s)a.b', 'z'],
+        ['(?i)abc', 'xyz'],
+    ]
+    texts = ['aa', 'ab', 'cc', 'abab', 'слово слово', 'a b', 'abc', 'a\nb', 'c', 'XYZ', 'b', 'q']
+    for terms in cases:
+        matcher = ta.RegexPatternMatcher(terms)
+        for text in texts:
+            assert matcher.find(text) == _separately(terms, text), (terms, text)
+
+
+def test_result_set_operations(monkeypatch):
+    store = ta.MessageStore()
+    rng = random.Random(3)
+    samples = [sorted(rng.sample(range(2000), size)) for size in (0, 1, 10, 300, 1500)]
+    for numpy in (ta.np, None):
+        monkeypatch.setattr(ta, 'np', numpy)
+        for left in samples:
+            for right in samples:
+                a, b = ta.ResultSet(store, left), ta.ResultSet(store, right)
+                assert list((a & b).positions) == sorted(set(left) & set(right))
+                assert list((a | b).positions) == sorted(set(left) | set(right))
+                assert list((a - b).positions) == sorted(set(left) - set(right))
+                assert (a & b).positions.typecode == 'I'
@@ -0,0 +1,88 @@
+import json
+import re
+
+import pytest
+
+import telegram_analyzer as ta
+
+from conftest import records
+
+
+# Длинные тексты с разделителями элементов и разметкой внутри строк: на них
+# приходится большая часть байтов файла, поэтому расчетные границы кусков
+# почти всегда попадают внутрь текста и должны сдвигаться до границы сообщения
+_JSON_TRAP = '\n },\n {\n  "id": 999, "text": "}, {" ] [ ' + 'строка 😀 ' * 120
+_HTML_TRAP = ('&lt;div class="message default" id="message999"&gt; </div> <div class="message" id="message7">\n'
+              + 'текст 😀 ' * 120)
+
+
+def _tricky_json(json_export, tmp_path):
+    data = json.load(open(json_export(300), encoding='utf-8'))
+    for number, msg in enumerate(data['messages']):
+        if number % 3 == 0:
+            msg['text'] = _JSON_TRAP + str(number)
+    path = tmp_path / 'tricky.json'
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding='utf-8')
+    return str(path)
+
+
+def _tricky_html(html_export):
+    pages = html_export(300, pages=2)
+    for path in pages:
+        page = open(path, encoding='utf-8').read()
+        # В текст сообщения попадает экранированная разметка, похожая на начало сообщения
+        page = re.sub(r'<div class="text">\n', lambda m: m.group() + _HTML_TRAP.replace('<', '&lt;').replace('>', '&gt;')
+                      + '\n', page)
+        open(path, 'w', encoding='utf-8').write(page)
+    return pages
+
+
+@pytest.fixture
+def exports(json_export, html_export, tmp_path, monkeypatch):
+    monkeypatch.setattr(ta, 'CHUNK_PARALLEL_THRESHOLD', 0)
+    return [_tricky_json(json_export, tmp_path), *_tricky_html(html_export), json_export(200, seed=5, name='plain.json')]
+
+
+def test_split_export_covers_file_on_message_bounds(exports):
+    for path in exports:
+        size = len(open(path, 'rb').read())
+        spans = ta.split_export(path, 7)
+        assert spans and len(spans) > 2, path
+        assert spans[-1][1] == size
+        assert all(end == start for (_, end), (start, _) in zip(spans, spans[1:]))
+
+        serial = ta.TelegramChatParser()
+        serial.load_files([path])
+        chunked = ta.TelegramChatParser()
+        for start, end in spans:
+            chunked._merge_batch(path, *ta._load_chunk_worker(path, start, end))
+        assert records(chunked) == records(serial), path
+
+
+@pytest.mark.parametrize('workers', [2, 5])
+def test_parallel_load_matches_serial(exports, workers):
+    serial = ta.TelegramChatParser()
+    serial.load_files(exports)
+    parallel = ta.TelegramChatParser(workers=workers)
+    parallel.load_files(exports)
+
+    assert records(parallel) == records(serial)
+    assert [parallel.messages.value(p, 'id') for p in range(len(parallel.messages))] == \
+        [serial.messages.value(p, 'id') for p in range(len(serial.messages))]
+    assert parallel.file_sources == serial.file_sources
+    assert list(parallel.file_sources) == exports
+    assert parallel.token_frequencies().to_json() == serial.token_frequencies().to_json()
+    assert len(parallel.filter_messages(keyword='строка')['keyword_matches']) == 100
+
+
+def test_parallel_load_sqlite_matches_serial(exports, tmp_path):
+    serial = ta.TelegramChatParser()
+    serial.load_files(exports)
+    parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'), workers=3)
+    parser.load_files(exports)
+
+    assert [dict(m) for m in parser.messages] == [dict(m) for m in serial.messages]
+    for name in exports:
+        assert parser.file_sources[name]['message_count'] == serial.file_sources[name]['message_count']
+        assert parser.file_sources[name]['users'] == serial.file_sources[name]['users']
+    parser.close()
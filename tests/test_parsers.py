@@ -0,0 +1,70 @@
+import telegram_analyzer as ta
+
+from conftest import records
+
+
+def test_json_stream_matches_full_parse(json_export):
+    path = json_export(500)
+    full = ta.TelegramChatParser(stream_json=False)
+    full.load_files([path])
+    stream = ta.TelegramChatParser(stream_json=True)
+    stream.load_files([path])
+
+    assert records(stream) == records(full)
+    assert stream.file_sources == full.file_sources
+    assert stream.token_frequencies().to_json() == full.token_frequencies().to_json()
+
+
+def test_truncated_json_stream_leaves_nothing(json_export, tmp_path):
+    path = json_export(500)
+    data = open(path, encoding='utf-8').read()
+    broken = tmp_path / 'broken.json'
+    broken.write_text(data[:len(data) // 2], encoding='utf-8')
+
+    parser = ta.TelegramChatParser(stream_json=True)
+    parser.load_files([str(broken)])
+
+    assert len(parser.messages) == 0
+    assert parser.file_sources == {}
+    assert parser.frequencies == {}
+    assert all(not index for index in parser.indexes.values())
+    assert parser.reply_graph == {}
+    assert parser.text_index.segments == []
+    assert len(parser.filter_messages(keyword='привет')['keyword_matches']) == 0
+
+
+def test_failed_reload_keeps_earlier_load(json_export, tmp_path, monkeypatch):
+    # Маленькая пачка частот: оборванный разбор успевает учесть часть текстов
+    monkeypatch.setattr(ta, 'FREQUENCY_BATCH', 2000)
+    path = json_export(400)
+    parser = ta.TelegramChatParser(stream_json=True)
+    parser.load_files([path])
+    before = records(parser), {name: dict(stats) for name, stats in parser.file_sources.items()}
+    frequencies = parser.token_frequencies().to_json()
+    keyword_matches = [dict(m) for m in parser.filter_messages(keyword='привет')['keyword_matches']]
+
+    # Тот же файл, но оборванный на середине
+    data = open(path, encoding='utf-8').read()
+    open(path, 'w', encoding='utf-8').write(data[:len(data) // 2])
+    parser.load_files([path])
+
+    assert (records(parser), {name: dict(stats) for name, stats in parser.file_sources.items()}) == before
+    assert [dict(m) for m in parser.filter_messages(keyword='привет')['keyword_matches']] == keyword_matches
+    assert parser.token_frequencies().to_json() == frequencies
+    words = parser.frequencies[path].chat['words']
+    assert sum(words.counts.values()) <= words.total
+
+
+def test_truncated_json_stream_sqlite(json_export, tmp_path):
+    path = json_export(300)
+    data = open(path, encoding='utf-8').read()
+    broken = tmp_path / 'broken.json'
+    broken.write_text(data[:len(data) // 2], encoding='utf-8')
+
+    parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'), stream_json=True)
+    parser.load_files([path, str(broken)])
+
+    assert len(parser.messages) == 300
+    assert list(parser.file_sources) == [path]
+    assert list(parser.frequencies) == [path]
+    parser.close()
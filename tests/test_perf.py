@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+
+import pytest
+
+import telegram_analyzer as ta
+
+
+@pytest.fixture
+def tracing():
+    started = not ta.PerformanceLog.tracing()
+    ta.PerformanceLog.set_tracing(True)
+    yield
+    if started:
+        ta.PerformanceLog.set_tracing(False)
+
+
+def test_stage_records_calls_time_and_messages():
+    perf = ta.PerformanceLog()
+    for count in (3, 4):
+        with perf.stage('parse', 'a.json') as stage:
+            time.sleep(0.01)
+            stage['messages'] = count
+    with perf.stage('parse', 'b.json'):
+        pass
+
+    totals = perf.stages['parse']
+    assert totals['calls'] == 3 and totals['messages'] == 7
+    assert totals['wall'] >= 0.02 and 0 <= totals['cpu'] < totals['wall']
+    assert totals['alloc_peak'] is None
+    assert perf.files['a.json']['parse']['calls'] == 2 and perf.files['a.json']['parse']['messages'] == 7
+    assert perf.files['b.json']['parse']['calls'] == 1
+
+    # Этап с исключением тоже записывается
+    with pytest.raises(ValueError):
+        with perf.stage('write'):
+            raise ValueError
+    assert perf.stages['write']['calls'] == 1
+
+    perf.clear()
+    assert perf.stages == {} and perf.files == {}
+
+
+def test_nested_stages_each_get_their_time_and_peak(tracing):
+    perf = ta.PerformanceLog()
+    with perf.stage('load'):
+        before = bytearray(2 * 1024 * 1024)
+        del before
+        with perf.stage('parse'):
+            time.sleep(0.01)
+            inner = bytearray(1024 * 1024)
+            del inner
+        with perf.stage('index'):
+            pass
+
+    load, parse, index = perf.stages['load'], perf.stages['parse'], perf.stages['index']
+    assert load['wall'] >= parse['wall'] + index['wall']
+    assert parse['alloc_peak'] >= 1024 * 1024
+    # Вложенный этап сбрасывает пик, но внешний учитывает и свой пик до него, и пик вложенного
+    assert load['alloc_peak'] >= 2 * 1024 * 1024
+    assert index['alloc_peak'] < 1024 * 1024
+
+
+def test_stages_nest_per_thread(tracing):
+    perf = ta.PerformanceLog()
+    inside = threading.Event()
+    done = threading.Event()
+
+    def worker():
+        with perf.stage('worker'):
+            inside.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    inside.wait(5)
+    with perf.stage('main'):
+        pass
+    done.set()
+    thread.join()
+    assert perf.stages['main']['calls'] == perf.stages['worker']['calls'] == 1
+    assert perf.stages['worker']['wall'] > perf.stages['main']['wall']
+
+
+def test_profile_next_stage(tmp_path):
+    perf = ta.PerformanceLog(profile_dir=str(tmp_path))
+    perf.profile_stage = 'filter'
+    with perf.stage('load'):
+        pass
+    assert perf.dumps == []
+    with perf.stage('filter'):
+        sum(range(1000))
+    with perf.stage('filter'):
+        pass
+
+    base, = perf.dumps
+    assert perf.profile_stage is None
+    assert all(os.path.exists(base + ext) for ext in ('.prof', '.txt', '.tracemalloc'))
+    assert not ta.PerformanceLog.tracing()
+
+
+def test_parser_load_records_nested_stages(json_export):
+    path = json_export(300)
+    parser = ta.TelegramChatParser()
+    parser.load_files([path])
+
+    stages = parser.perf.stages
+    assert stages['load']['messages'] == stages['parse']['messages'] == 300
+    assert stages['load']['wall'] >= stages['read']['wall'] + stages['parse']['wall'] + stages['index']['wall']
+    assert set(parser.perf.files[path]) == {'read', 'parse', 'index'}
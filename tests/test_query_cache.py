@@ -0,0 +1,103 @@
+import pytest
+
+import telegram_analyzer as ta
+
+from conftest import dump_results
+
+
+QUERIES = [{'keyword': 'привет'}, {'keyword': 'код'}, {'terms': ['встреча']}, {'target_user': 'Алиса'}]
+
+
+def _filter_calls(parser):
+    return parser.perf.stages.get('filter', {}).get('calls', 0)
+
+
+def _cached(parser, filters):
+    """Запрос отвечен из кэша: фильтрация не запускалась"""
+    calls = _filter_calls(parser)
+    results = parser.filter_messages(**filters)
+    return _filter_calls(parser) == calls, results
+
+
+@pytest.fixture
+def files(json_export):
+    return [json_export(300, name='first.json'), json_export(200, seed=2, name='second.json')]
+
+
+def test_repeated_query_is_served_from_cache(files):
+    parser = ta.TelegramChatParser()
+    parser.load_files(files[:1])
+    first = parser.filter_messages(keyword='Привет')
+    hit, second = _cached(parser, {'keyword': 'ПРИВЕТ'})
+
+    assert hit
+    assert second['keyword_matches'] is first['keyword_matches']
+    assert second is not first and second['term_matches'] is not first['term_matches']
+    assert not _cached(parser, {'keyword': 'привет', 'source_file': files[0]})[0]
+
+
+def test_load_and_clear_invalidate_cache(files):
+    parser = ta.TelegramChatParser()
+    parser.load_files(files[:1])
+    before = dump_results(parser.filter_messages(keyword='привет'))
+
+    generation = parser.data_generation
+    parser.load_files(files[1:])
+    assert parser.data_generation > generation and not parser.query_cache.entries
+    hit, results = _cached(parser, {'keyword': 'привет'})
+    assert not hit
+    assert len(results['keyword_matches']) > len(before['keyword_matches'])
+
+    fresh = ta.TelegramChatParser()
+    fresh.load_files(files)
+    assert dump_results(results) == dump_results(fresh.filter_messages(keyword='привет'))
+
+    parser.clear_data()
+    hit, results = _cached(parser, {'keyword': 'привет'})
+    assert not hit and len(results['keyword_matches']) == 0
+
+
+def test_stale_generation_entry_is_dropped():
+    cache = ta.QueryCache()
+    results = {'keyword_matches': ta.ResultSet(None, [1, 2]), 'term_matches': {}}
+    cache.put('key', 1, results)
+    assert cache.get('key', 1) is results
+    assert cache.get('key', 2) is None
+    assert not cache.entries and cache.size == 0
+
+
+def test_eviction_by_entry_count(files):
+    parser = ta.TelegramChatParser(query_cache_entries=2)
+    parser.load_files(files)
+    for filters in QUERIES[:3]:
+        parser.filter_messages(**filters)
+    assert len(parser.query_cache.entries) == 2
+
+    # Последний запрошенный становится самым свежим, вытесняется самый старый
+    assert _cached(parser, QUERIES[1])[0]
+    parser.filter_messages(**QUERIES[3])
+    assert _cached(parser, QUERIES[1])[0]
+    assert not _cached(parser, QUERIES[2])[0]
+    assert not _cached(parser, QUERIES[0])[0]
+
+
+def test_eviction_by_byte_budget(files):
+    probe = ta.TelegramChatParser()
+    probe.load_files(files)
+    sizes = [ta.QueryCache._result_bytes(probe.filter_messages(**filters)) for filters in QUERIES[:3]]
+    assert all(sizes)
+
+    parser = ta.TelegramChatParser(query_cache_bytes=sizes[1] + sizes[2])
+    parser.load_files(files)
+    for filters in QUERIES[:3]:
+        parser.filter_messages(**filters)
+    assert parser.query_cache.size <= parser.query_cache.max_bytes
+    assert parser.query_cache.size == sum(entry[2] for entry in parser.query_cache.entries.values())
+    assert _cached(parser, QUERIES[2])[0]
+    assert not _cached(parser, QUERIES[0])[0]
+
+    # Выборка больше всего бюджета не кэшируется
+    small = ta.TelegramChatParser(query_cache_bytes=min(sizes) - 1)
+    small.load_files(files)
+    small.filter_messages(**QUERIES[0])
+    assert not small.query_cache.entries and small.query_cache.size == 0
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+import telegram_analyzer as ta
+
+
+_TEXTS = [
+    'ok', 'Ё', 'ё', 'ёлка', 'ПрИвЕт мир', 'привет', 'Straße', 'STRASSE', 'ǅemal', 'Σίσυφος', 'ΣΊΣΥΦΟΣ',
+    [{'type': 'link', 'text': 'https://Example.com/Привет'}, ' и ', {'type': 'bold', 'text': 'ЖИРНЫЙ'}],
+    [{'type': 'text_link', 'text': 'Ссылка', 'href': 'https://t.me/x'}, ' ', {'type': 'hashtag', 'text': '#Тег'}],
+    [{'type': 'mention', 'text': '@Alice'}, ' ok'],
+    '', 'a', 'аб',
+]
+_KEYWORDS = ['ok', 'o', 'ё', 'Ё', 'ёл', 'при', 'ПРИВЕТ', 'strasse', 'ß', 'ǆ', 'σίσυφος', 'ς', 'example.com/привет',
+             'жирн', 'ссылка', '#тег', '@alice', 'к #', 'и ж', 'а', 'аб', 'нет такого']
+
+
+@pytest.fixture
+def export(json_export, tmp_path):
+    """Сгенерированный экспорт с добавленными сообщениями на регистр, Unicode и сущности"""
+    data = json.load(open(json_export(300), encoding='utf-8'))
+    authors = ['Алиса', 'Борис', 'Вера']
+    for number, text in enumerate(_TEXTS):
+        data['messages'].append({'id': 1000 + number, 'type': 'message', 'date': '2023-02-01T10:00:00',
+                                 'from': authors[number % 3], 'text': text,
+                                 **({'reply_to_message_id': 5} if number % 2 else {})})
+    path = tmp_path / 'search.json'
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding='utf-8')
+    return str(path), data['messages']
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def parser(request, export, tmp_path):
+    path, _ = export
+    if request.param == 'sqlite':
+        parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    else:
+        parser = ta.TelegramChatParser()
+    parser.load_files([path])
+    yield parser
+    if request.param == 'sqlite':
+        parser.close()
+
+
+def _scan(parser, predicate):
+    """Сообщения по линейному просмотру всех записей"""
+    return [dict(msg) for msg in parser.messages if predicate(msg)]
+
+
+def _dump(results):
+    return [dict(msg) for msg in results]
+
+
+def _text(msg):
+    text = msg['text']
+    return ''.join(part if isinstance(part, str) else part['text'] for part in text) if isinstance(text, list) else text
+
+
+def test_keyword_search_matches_linear_scan(parser, export):
+    path, messages = export
+    assert len(parser.messages) == len(messages)
+    for keyword in _KEYWORDS:
+        form = ta.unicodedata.normalize('NFC', keyword).casefold()
+        expected = _scan(parser, lambda msg: form in ta.unicodedata.normalize('NFC', _text(msg) or '').casefold())
+        assert _dump(parser.filter_messages(keyword=keyword)['keyword_matches']) == expected, keyword
+        assert _dump(parser.filter_messages(keyword=keyword, source_file=path)['keyword_matches']) == \
+            expected, keyword
+
+
+def test_casefold_semantics(parser):
+    def texts(keyword):
+        # Только добавленные сообщения: в сгенерированных тоже есть straße
+        return [_text(msg) for msg in parser.filter_messages(keyword=keyword)['keyword_matches'] if msg['id'] >= 1000]
+
+    assert texts('strasse') == ['Straße', 'STRASSE']
+    assert texts('ёлка') == ['ёлка']
+    assert texts('σίσυφος') == ['Σίσυφος', 'ΣΊΣΥΦΟΣ']
+
+
+def test_field_indexes_match_linear_scan(parser, export):
+    path, messages = export
+    for author in ('Алиса', 'Борис', 'Вера', 'Никто'):
+        assert _dump(parser.filter_messages(target_user=author)['user_messages']) == \
+            _scan(parser, lambda msg: msg['from'] == author), author
+        assert _dump(parser.filter_messages(target_user=author, source_file=path)['user_messages']) == \
+            _scan(parser, lambda msg: msg['from'] == author), author
+        assert _dump(parser.filter_messages(target_user=author, source_file='other.json')['user_messages']) == []
+
+    for message_id in (1, 5, 10, 1003, 4242):
+        assert _dump(parser.filter_messages(target_message_id=message_id)['message_comments']) == \
+            _scan(parser, lambda msg: msg['reply_to'] == message_id), message_id
+        assert _dump(parser._lookup('id', message_id)) == _scan(parser, lambda msg: msg['id'] == message_id)
+
+    assert _dump(parser._lookup('source_file', path)) == _scan(parser, lambda msg: True)
+    assert _dump(parser._lookup('source_file', 'other.json')) == []
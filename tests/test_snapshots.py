@@ -0,0 +1,85 @@
+import pytest
+
+import telegram_analyzer as ta
+
+from conftest import records, dump_results
+
+
+FILTER_SETS = [
+    {'keyword': 'привет'},
+    {'keyword': 'ет', 'date_from': '2023-01-02', 'date_to': '2023-01-20'},
+    {'terms': ['встреча', 'код']},
+    {'target_message_id': 5, 'thread_depth': 2},
+]
+
+
+def _shard(files, path, name, index=True, backend='memory'):
+    """Снимок узла из парсера в памяти или из базы SQLite рядом со снимком"""
+    if backend == 'sqlite':
+        parser = ta.SQLiteChatParser(str(path) + '.db')
+    else:
+        parser = ta.TelegramChatParser()
+    parser.load_files(files)
+    parser.save_snapshot(str(path), name, index=index)
+    if backend == 'sqlite':
+        parser.close()
+    return str(path)
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+@pytest.mark.parametrize('index', [True, False])
+def test_merged_snapshot_matches_direct_load(json_export, html_export, tmp_path, backend, index):
+    first, second = [json_export(300)], html_export(200, pages=2)
+    shards = [_shard(first, tmp_path / 'a.tgs', 'a', index, backend),
+              _shard(second, tmp_path / 'b.tgs', 'b', index, backend)]
+    header = ta.merge_snapshots(shards, str(tmp_path / 'all.tgs'))
+    assert header['shards'] == ['a', 'b']
+    assert [entry['name'] for entry in header['files']] == first + second
+
+    direct = ta.TelegramChatParser()
+    direct.load_files(first + second)
+    merged = ta.TelegramChatParser()
+    merged.load_snapshot(str(tmp_path / 'all.tgs'))
+    assert records(merged) == records(direct)
+    assert merged.file_sources == direct.file_sources
+    for filters in FILTER_SETS:
+        assert dump_results(merged.filter_messages(**filters)) == \
+            dump_results(direct.filter_messages(**filters)), filters
+    assert merged.token_frequencies().to_json() == direct.token_frequencies().to_json()
+
+
+def test_sqlite_parser_does_not_open_snapshots(json_export, tmp_path):
+    path = _shard([json_export(100)], tmp_path / 'a.tgs', 'a')
+    parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    with pytest.raises(ValueError):
+        parser.load_snapshot(path)
+    assert parser.file_sources == {}
+    parser.close()
+
+
+def test_duplicate_names_get_shard_prefix_and_overlaps_are_reported(json_export, tmp_path, capsys):
+    path = json_export(200)
+    shards = [_shard([path], tmp_path / 'a.tgs', 'a'), _shard([path], tmp_path / 'b.tgs', 'b')]
+    ta.merge_snapshots(shards, str(tmp_path / 'all.tgs'))
+    output = capsys.readouterr().out
+    assert '200 сообщений с одинаковыми id есть в нескольких файлах' in output
+
+    parser = ta.TelegramChatParser()
+    parser.load_snapshot(str(tmp_path / 'all.tgs'))
+    assert list(parser.file_sources) == [path, f"b:{path}"]
+    assert parser.file_sources[path]['message_count'] == parser.file_sources[f"b:{path}"]['message_count']
+    assert len(parser.filter_messages(source_file=f"b:{path}", keyword='привет')['keyword_matches']) == \
+        len(parser.filter_messages(source_file=path, keyword='привет')['keyword_matches'])
+
+
+def test_merging_merged_snapshot_skips_known_files(json_export, tmp_path, capsys):
+    first, second = json_export(150, name='first.json'), json_export(150, seed=2, name='second.json')
+    a, b = _shard([first], tmp_path / 'a.tgs', 'a'), _shard([second], tmp_path / 'b.tgs', 'b')
+    ta.merge_snapshots([a, b], str(tmp_path / 'ab.tgs'))
+    header = ta.merge_snapshots([str(tmp_path / 'ab.tgs'), b], str(tmp_path / 'all.tgs'))
+
+    assert [entry['name'] for entry in header['files']] == [first, second]
+    assert 'уже есть в снимке, пропущен' in capsys.readouterr().out
+    parser = ta.TelegramChatParser()
+    parser.load_snapshot(str(tmp_path / 'all.tgs'))
+    assert len(parser.messages) == 300
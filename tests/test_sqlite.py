@@ -0,0 +1,66 @@
+import pytest
+
+import telegram_analyzer as ta
+
+from conftest import dump_results
+
+
+@pytest.fixture
+def loaded(json_export, html_export, tmp_path):
+    """Одни и те же файлы в парсере в памяти и в базе SQLite"""
+    files = [json_export(400), *html_export(300, pages=2)]
+    memory = ta.TelegramChatParser()
+    memory.load_files(files)
+    sqlite = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    sqlite.load_files(files)
+    yield files, memory, sqlite
+    sqlite.close()
+
+
+def test_sqlite_matches_memory(loaded):
+    files, memory, sqlite = loaded
+    user = sorted(memory.file_sources[files[0]]['users'])[0]
+    filter_sets = [
+        {'target_user': user},
+        {'target_user': user, 'source_file': files[1]},
+        {'keyword': 'привет'},
+        {'keyword': 'ет', 'date_from': '2023-01-02', 'date_to': '2023-01-20'},
+        {'target_message_id': 5, 'thread_depth': 0},
+        {'target_message_id': 5, 'thread_depth': 2, 'source_file': files[0]},
+        {'terms': ['встреча', 'код']},
+        {'terms': [r'\bкод\w*', r'встреч[аи]'], 'terms_regex': True},
+    ]
+    for filters in filter_sets:
+        assert dump_results(sqlite.filter_messages(**filters)) == dump_results(memory.filter_messages(**filters)), filters
+
+    assert len(sqlite.messages) == len(memory.messages)
+    for name in files:
+        assert sqlite.file_sources[name]['message_count'] == memory.file_sources[name]['message_count']
+        assert sqlite.file_sources[name]['users'] == memory.file_sources[name]['users']
+    assert sqlite.token_frequencies().to_json() == memory.token_frequencies().to_json()
+
+
+def test_sqlite_reopen_keeps_data(loaded, tmp_path):
+    files, memory, sqlite = loaded
+    sqlite.close()
+    reopened = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    reopened.load_files(files)
+
+    assert len(reopened.messages) == len(memory.messages)
+    assert dump_results(reopened.filter_messages(keyword='привет')) == \
+        dump_results(memory.filter_messages(keyword='привет'))
+    reopened.close()
+
+
+def test_sqlite_clear_requires_confirmation(loaded):
+    files, memory, sqlite = loaded
+    with pytest.raises(ValueError):
+        sqlite.clear_data()
+    assert len(sqlite.messages) == len(memory.messages)
+
+    sqlite.clear_data(confirm=True)
+    assert len(sqlite.messages) == 0
+    assert sqlite.file_sources == {}
+
+    memory.clear_data()
+    assert len(memory.messages) == 0
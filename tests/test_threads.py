@@ -0,0 +1,167 @@
+import json
+import random
+
+import pytest
+
+import telegram_analyzer as ta
+
+
+def _write(path, data, name, messages):
+    path.write_text(json.dumps(dict(data, name=name, messages=messages), ensure_ascii=False), encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture
+def exports(json_export, tmp_path):
+    """Два экспорта одного чата с ответами между файлами и чат с теми же id и циклом ответов"""
+    rng = random.Random(7)
+    first = json.load(open(json_export(300), encoding='utf-8'))
+    messages = first['messages']
+    # Цепочка ответов, чтобы были глубокие ветки
+    for message_id in range(41, 60):
+        messages[message_id - 1]['reply_to_message_id'] = message_id - 1
+    messages.append({'id': 400, 'type': 'message', 'from': 'Алиса', 'text': 'нет родителя',
+                     'reply_to_message_id': 5000})
+
+    later = [{'id': message_id, 'type': 'message', 'from': 'Борис', 'text': f'ответ {message_id}',
+              'reply_to_message_id': rng.choice([5, 59, 250, rng.randint(1, message_id - 1)])}
+             for message_id in range(401, 460)]
+
+    other = json.load(open(json_export(200, seed=2, name='other.json'), encoding='utf-8'))['messages']
+    other += [{'id': 900, 'type': 'message', 'from': 'Вера', 'text': 'цикл', 'reply_to_message_id': 901},
+              {'id': 901, 'type': 'message', 'from': 'Вера', 'text': 'цикл', 'reply_to_message_id': 900},
+              {'id': 902, 'type': 'message', 'from': 'Вера', 'text': 'в цикл', 'reply_to_message_id': 900},
+              {'id': 903, 'type': 'message', 'from': 'Вера', 'text': 'на 5', 'reply_to_message_id': 5}]
+    return [_write(tmp_path / 'a1.json', first, 'Чат А', messages),
+            _write(tmp_path / 'a2.json', first, 'Чат А', later),
+            _write(tmp_path / 'b.json', first, 'Чат Б', other)]
+
+
+class Reference:
+    """Ветки линейным просмотром всех сообщений"""
+
+    def __init__(self, parser, files):
+        chats = {filename: ta.export_chat_key(filename) for filename in files}
+        self.records = [dict(msg) for msg in parser.messages]
+        self.chats = [chats[msg['source_file']] for msg in self.records]
+        self.file_chats = chats
+
+    def positions(self, chat, message_id):
+        return [p for p, msg in enumerate(self.records) if self.chats[p] == chat and msg['id'] == message_id]
+
+    def replies(self, chat, message_id, max_depth=None):
+        found, frontier, depth = {}, {message_id}, 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            children = [p for p, msg in enumerate(self.records)
+                        if self.chats[p] == chat and msg['reply_to'] in frontier and p not in found]
+            found.update((p, depth) for p in children)
+            frontier = {self.records[p]['id'] for p in children}
+        return found
+
+    def thread(self, message_id, source_file=None, max_depth=None):
+        if source_file:
+            chats = {self.file_chats[source_file]}
+        else:
+            chats = {self.chats[p] for p, msg in enumerate(self.records)
+                     if message_id in (msg['id'], msg['reply_to'])}
+        found = set()
+        for chat in chats:
+            found.update(self.positions(chat, message_id))
+            found.update(self.replies(chat, message_id, max_depth))
+        return [self.records[p] for p in sorted(found)
+                if not source_file or self.records[p]['source_file'] == source_file]
+
+    def root(self, message_id, source_file=None):
+        positions = [p for p, msg in enumerate(self.records)
+                     if msg['id'] == message_id and (not source_file or msg['source_file'] == source_file)]
+        if not positions:
+            return None
+        position, seen = positions[0], {positions[0]}
+        while True:
+            parent_id = self.records[position]['reply_to']
+            parents = self.positions(self.chats[position], parent_id) if parent_id is not None else []
+            if not parents or parents[0] in seen:
+                return self.records[position]
+            position = parents[0]
+            seen.add(position)
+
+    def stats(self):
+        stats = []
+        for chat, message_id in dict.fromkeys((self.chats[p], msg['reply_to']) for p, msg in enumerate(self.records)
+                                              if msg['reply_to'] is not None):
+            parents = self.positions(chat, message_id)
+            if parents and self.records[parents[0]]['reply_to'] is not None:
+                continue
+            replies = self.replies(chat, message_id)
+            stats.append({'chat': chat, 'message_id': message_id, 'size': len(replies),
+                          'depth': max(replies.values())})
+        return stats
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def loaded(request, exports, tmp_path):
+    if request.param == 'sqlite':
+        parser = ta.SQLiteChatParser(str(tmp_path / 'chat.db'))
+    else:
+        parser = ta.TelegramChatParser()
+    parser.load_files(exports)
+    yield parser, Reference(parser, exports)
+    if request.param == 'sqlite':
+        parser.close()
+
+
+MESSAGE_IDS = [1, 5, 40, 45, 59, 60, 150, 250, 251, 400, 430, 900, 901, 903, 5000, 7777]
+
+
+def test_thread_matches_linear_scan(loaded, exports):
+    parser, reference = loaded
+    for message_id in MESSAGE_IDS:
+        for source_file in (None, *exports):
+            for max_depth in (None, 0, 1, 2, 10):
+                assert [dict(msg) for msg in parser.get_thread(message_id, source_file, max_depth)] == \
+                    reference.thread(message_id, source_file, max_depth), (message_id, source_file, max_depth)
+
+
+def test_thread_replies_stay_in_their_chat(loaded, exports):
+    parser, reference = loaded
+    a1, a2, b = exports
+
+    # Ответы из второго экспорта того же чата входят в ветку сообщения первого,
+    # а с source_file остаются только сообщения этого файла
+    assert {msg['source_file'] for msg in parser.get_thread(250)} == {a1, a2}
+    assert {msg['source_file'] for msg in parser.get_thread(250, a1)} == {a1}
+
+    # id 5 есть в обоих чатах: без файла ветки объединяются, с файлом - нет
+    assert {msg['source_file'] for msg in parser.get_thread(5)} == {a1, a2, b}
+    assert {msg['source_file'] for msg in parser.get_thread(5, b)} == {b}
+    assert [dict(msg) for msg in parser.get_thread(903, b, 1)] == [msg for msg in reference.records
+                                                                   if msg['id'] == 903 and msg['source_file'] == b]
+
+
+def test_thread_root_matches_linear_scan(loaded, exports):
+    parser, reference = loaded
+    for message_id in MESSAGE_IDS + list(range(401, 460, 7)):
+        for source_file in (None, *exports):
+            root = parser.get_thread_root(message_id, source_file)
+            expected = reference.root(message_id, source_file)
+            assert (dict(root) if root is not None else None) == expected, (message_id, source_file)
+
+    assert dict(parser.get_thread_root(59))['id'] == 40
+    assert dict(parser.get_thread_root(400))['id'] == 400
+    assert dict(parser.get_thread_root(902))['id'] == 901
+
+
+def test_thread_stats_match_linear_scan(loaded):
+    parser, reference = loaded
+    key = lambda thread: (thread['chat'], thread['message_id'])
+    expected = reference.stats()
+    assert sorted(parser.thread_stats(), key=key) == sorted(expected, key=key)
+    assert ('Чат Б', 900) not in {key(thread) for thread in expected}
+    assert ('Чат А', 5000) in {key(thread) for thread in expected}
+
+    largest, deepest = parser.largest_threads(3), parser.deepest_threads(3)
+    assert [thread['size'] for thread in largest] == sorted((thread['size'] for thread in expected), reverse=True)[:3]
+    assert [(thread['depth'], thread['size']) for thread in deepest] == \
+        sorted(((thread['depth'], thread['size']) for thread in expected), reverse=True)[:3]
+    assert deepest[0]['chat'] == 'Чат А' and deepest[0]['depth'] >= 19